@@ -0,0 +1,173 @@
+"""Alert state per (rule, device), so alerts are written on transitions only.
+
+A rule whose condition starts matching on a device goes `pending`; it turns
+`firing` once the condition has held for the rule's `for_readings`
+consecutive readings and `for_seconds`, and no earlier firing on that device
+is within `cooldown`. A firing rule `resolves` when a reading no longer
+satisfies it even with `hysteresis` applied (see rules.still_holds). Only the
+pending -> firing and firing -> resolved steps are reported; a device stuck
+above a threshold produces one alert, not one per heartbeat. Windowed rules
+(app/windows.py) and anomaly rules (app/anomaly.py) go through the same
+states.
+
+State lives in process memory and is only touched by the alert worker, so
+it needs no locking. Firing alerts survive restarts through their open
+`notification_alerts` rows (resolved_at IS NULL), which `restore` reloads.
+
+Alert evaluation assumes a single API process. Heartbeats are evaluated by
+the worker that received them, so with several workers one device's
+readings are split between trackers: `for_readings` counts and cooldowns
+only see part of them, the same condition can fire once per worker, and
+every worker restores every open alert. The backplane only fans out the
+resulting messages; it doesn't route readings to an owning worker.
+"""
+from collections import namedtuple
+from typing import Dict, List, Optional
+import uuid
+from .rules import RuleSet, is_derived, still_holds
+
+PENDING = "pending"
+FIRING = "firing"
+RESOLVED = "resolved"
+
+# `rule` is None when a firing rule was deleted or deactivated meanwhile
+Transition = namedtuple("Transition", ["state", "rule", "rule_id", "value", "alert_id"])
+
+class AlertState:
+    __slots__ = ("status", "since", "readings", "fired_at", "alert_id")
+
+    def __init__(self, since: float):
+        self.status = PENDING
+        self.since = since
+        self.readings = 0
+        self.fired_at = None
+        self.alert_id = None
+
+    def copy(self) -> "AlertState":
+        state = AlertState(self.since)
+        state.status = self.status
+        state.readings = self.readings
+        state.fired_at = self.fired_at
+        state.alert_id = self.alert_id
+        return state
+
+class AlertTracker:
+    """Pending, firing and cooling-down rules keyed by device, then rule id.
+
+    Devices with nothing in progress have no entry, so memory follows the
+    number of active alerts, not the fleet size.
+    """
+
+    def __init__(self):
+        self._devices: Dict[uuid.UUID, Dict[uuid.UUID, AlertState]] = {}
+        self.restored = False
+
+    def restore(self, open_alerts, now: float):
+        """Mark (rule, device) pairs with an unresolved alert row as firing."""
+        for alert in open_alerts:
+            state = AlertState(now)
+            state.status = FIRING
+            state.fired_at = now
+            state.alert_id = alert.id
+            self._devices.setdefault(alert.device_id, {})[alert.notification_id] = state
+        self.restored = True
+
+    def firing(self) -> int:
+        return sum(
+            state.status == FIRING for states in self._devices.values() for state in states.values()
+        )
+
+    def clear(self):
+        self._devices.clear()
+        self.restored = False
+
+    def snapshot(self, device_id) -> Optional[Dict[uuid.UUID, AlertState]]:
+        """A copy of the device's states, for `rollback`."""
+        states = self._devices.get(device_id)
+        if not states:
+            return None
+        return {rule_id: state.copy() for rule_id, state in states.items()}
+
+    def rollback(self, snapshots: dict):
+        """Put devices back to their {device_id: snapshot} states, when the
+        transitions evaluated since couldn't be saved; the next reading of
+        each device goes through them again."""
+        for device_id, states in snapshots.items():
+            if states:
+                self._devices[device_id] = states
+            else:
+                self._devices.pop(device_id, None)
+
+    def evaluate(self, ruleset: RuleSet, device_id, values: dict, now: float, derived: Optional[dict] = None) -> List[Transition]:
+        """Advance the states of one device by one reading taken at `now`.
+
+        `derived` holds the results of the windowed and anomaly rules for
+        the same reading, as WindowStore.update returns them.
+        """
+        states = self._devices.get(device_id)
+        matched = ruleset.match(device_id, values)
+        if derived:
+            matched.extend(
+                (ruleset.rules[rule_id], value) for rule_id, (value, matches, _) in derived.items() if matches
+            )
+        if not matched and not states:
+            return []
+        if states is None:
+            states = self._devices[device_id] = {}
+
+        transitions = []
+        seen = set()
+        for rule, value in matched:
+            seen.add(rule.id)
+            state = states.get(rule.id)
+            if state is None:
+                state = states[rule.id] = AlertState(now)
+            elif state.status == FIRING:
+                continue
+            elif state.status == RESOLVED:
+                state.status = PENDING
+                state.since = now
+                state.readings = 0
+            state.readings += 1
+            if state.readings < rule.for_readings or now - state.since < rule.for_seconds:
+                continue
+            if state.fired_at is not None and now - state.fired_at < rule.cooldown:
+                continue
+            state.status = FIRING
+            state.fired_at = now
+            # The id of the alert row the pipeline writes for this firing
+            state.alert_id = uuid.uuid4()
+            transitions.append(Transition(FIRING, rule, rule.id, value, state.alert_id))
+
+        for rule_id, state in list(states.items()):
+            if rule_id in seen:
+                continue
+            rule = ruleset.rules.get(rule_id)
+            if rule is not None and is_derived(rule):
+                if not derived or rule_id not in derived:
+                    # The window or the anomaly score has no value yet
+                    continue
+                value, _, holds = derived[rule_id]
+            else:
+                value = values.get(rule.metric) if rule is not None else None
+                if rule is not None and value is None:
+                    # This reading doesn't carry the rule's metric
+                    continue
+                holds = rule is not None and still_holds(rule, value)
+            if state.status == FIRING:
+                if holds:
+                    continue
+                state.status = RESOLVED
+                transitions.append(Transition(RESOLVED, rule, rule_id, value, state.alert_id))
+                state.alert_id = None
+            elif state.status == PENDING:
+                state.status = RESOLVED
+            # Resolved states are only kept to enforce the cooldown
+            if rule is None or state.fired_at is None or now - state.fired_at >= rule.cooldown:
+                del states[rule_id]
+
+        if not states:
+            del self._devices[device_id]
+        return transitions
+
+alert_tracker = AlertTracker()
@@ -0,0 +1,215 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+import asyncio
+import json
+import logging
+import os
+import time
+from . import anomaly, crud, database, models, rules
+from .alert_state import RESOLVED, alert_tracker
+from .anomaly import anomaly_detector
+from .windows import window_store
+from .cache import CachedDevice
+from .backplane import backplane
+
+logger = logging.getLogger(__name__)
+
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "10000"))
+ALERT_BATCH_SIZE = int(os.getenv("ALERT_BATCH_SIZE", "500"))
+ALERT_DRAIN_TIMEOUT = float(os.getenv("ALERT_DRAIN_TIMEOUT", "10"))
+
+# Immutable copy of the values rules look at, safe to hand to another thread
+Reading = namedtuple("Reading", ("device_id",) + rules.METRICS + ("created_at",), defaults=(None,))
+
+def snapshot(heartbeat) -> Reading:
+    return Reading(
+        heartbeat.device_id, *(getattr(heartbeat, metric) for metric in rules.METRICS), heartbeat.created_at
+    )
+
+class AlertPipeline:
+    """Evaluates rules, persists alerts and fans them out off the ingest path.
+
+    Ingest only enqueues a reading; a single worker task drains the queue in
+    batches, evaluates and writes each batch in a worker thread with one
+    commit, then publishes the new alerts once to the broadcast backplane. When the queue is full readings
+    are dropped (and counted) rather than slowing ingest down. Only alerts
+    that start firing or resolve are written and published (see alert_state).
+    """
+
+    def __init__(self, maxsize: int = ALERT_QUEUE_SIZE, batch_size: int = ALERT_BATCH_SIZE):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.session_factory = database.SessionLocal
+        self.queue = None
+        self._worker = None
+        self.submitted = 0
+        self.dropped = 0
+        self.processed = 0
+        self.batches = 0
+        self.alerts_written = 0
+        self.alerts_resolved = 0
+        self.max_depth = 0
+
+    @property
+    def running(self):
+        return self._worker is not None and not self._worker.done()
+
+    def start(self):
+        if self.running:
+            return
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = ALERT_DRAIN_TIMEOUT):
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Alert pipeline stopped with %d readings pending", self.queue.qsize())
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self.queue = None
+
+    async def join(self):
+        if self.running:
+            await self.queue.join()
+
+    def submit(self, device: CachedDevice, heartbeat) -> bool:
+        # Started lazily so ingest works even where no lifespan ran
+        self.start()
+        try:
+            self.queue.put_nowait((device, snapshot(heartbeat)))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                messages = await asyncio.to_thread(self.process_batch, batch)
+                if messages:
+                    await backplane.publish_many(messages)
+            except Exception:
+                logger.exception("Failed to process %d readings for alerts", len(batch))
+            finally:
+                self.processed += len(batch)
+                self.batches += 1
+                for _ in batch:
+                    self.queue.task_done()
+
+    def process_batch(self, batch):
+        db = self.session_factory()
+        try:
+            if not alert_tracker.restored:
+                alert_tracker.restore(crud.get_open_notification_alerts(db), time.time())
+            timestamp = datetime.now(timezone.utc)
+            # One vectorized pass over the whole batch
+            scores = anomaly_detector.score([reading for _, reading in batch])
+            db_alerts = []
+            resolved_ids = []
+            messages = []
+            # Alert states and windows as the batch found them. Unless its
+            # transitions are saved, they are put back, so the next readings
+            # of each device go through them again instead of being lost to
+            # a state that says FIRING with no alert row behind it
+            alert_states = {}
+            windows = {}
+            try:
+                for i, (device, reading) in enumerate(batch):
+                    if reading.device_id not in alert_states:
+                        alert_states[reading.device_id] = alert_tracker.snapshot(reading.device_id)
+                        windows[reading.device_id] = window_store.snapshot(reading.device_id)
+                    ruleset = rules.rule_engine.rules_for_user(db, device.user_id)
+                    values = reading._asdict()
+                    # Durations and windows follow the readings' own timestamps
+                    now = reading.created_at.timestamp() if reading.created_at is not None else time.time()
+                    derived = window_store.update(ruleset, reading.device_id, values, now)
+                    if scores is not None:
+                        derived.update(anomaly.evaluate(ruleset, reading.device_id, values, scores[i]))
+                    for transition in alert_tracker.evaluate(ruleset, reading.device_id, values, now, derived):
+                        rule, metric_value = transition.rule, transition.value
+                        if transition.state == RESOLVED:
+                            resolved_ids.append(transition.alert_id)
+                            messages.append((device.user_id, json.dumps({
+                                "type": "resolved",
+                                "alert": {
+                                    "id": str(transition.alert_id),
+                                    "device_name": device.name,
+                                    "metric": rule.metric if rule is not None else None,
+                                    "value": metric_value,
+                                    "resolved_at": timestamp.isoformat()
+                                }
+                            })))
+                            continue
+                        if rule.condition == rules.ANOMALY:
+                            z = scores[i][anomaly.METRIC_INDEX[rule.metric]]
+                            message = f"Device {device.name} - {rule.metric} is {metric_value}, z-score {z:.1f} (threshold: {rule.threshold})"
+                        elif rule.aggregate:
+                            metric_value = round(metric_value, 3)
+                            threshold = rule.window_count if rule.aggregate == "count" else rule.threshold
+                            message = f"Device {device.name} - {rules.describe(rule)} is {metric_value} (threshold: {threshold})"
+                        else:
+                            message = f"Device {device.name} - {rule.metric} is {metric_value} (threshold: {rule.threshold})"
+                        db_alert = models.NotificationAlert(
+                            id=transition.alert_id,
+                            notification_id=rule.id,
+                            device_id=reading.device_id,
+                            message=message,
+                            value=metric_value,
+                            created_at=timestamp
+                        )
+                        db_alerts.append(db_alert)
+                        messages.append((device.user_id, json.dumps({
+                            "type": "notification",
+                            "alert": {
+                                "id": str(db_alert.id),
+                                "message": message,
+                                "device_name": device.name,
+                                "metric": rule.metric,
+                                "value": metric_value,
+                                "threshold": rule.threshold,
+                                "created_at": db_alert.created_at.isoformat()
+                            }
+                        })))
+                if db_alerts or resolved_ids:
+                    crud.save_alert_transitions(db, db_alerts, resolved_ids, timestamp)
+            except Exception:
+                alert_tracker.rollback(alert_states)
+                window_store.rollback(windows)
+                raise
+            self.alerts_written += len(db_alerts)
+            self.alerts_resolved += len(resolved_ids)
+            return messages
+        finally:
+            db.close()
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize() if self.queue is not None else 0,
+            "maxsize": self.maxsize,
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "batches": self.batches,
+            "alerts_written": self.alerts_written,
+            "alerts_resolved": self.alerts_resolved,
+            "firing": alert_tracker.firing(),
+            "windowed_devices": window_store.devices(),
+        }
+
+alert_pipeline = AlertPipeline()
@@ -0,0 +1,147 @@
+"""Fleet-wide anomaly scores for the alert pipeline.
+
+With ANOMALY_DETECTION=true every batch of readings the alert worker takes
+off the queue is scored against per-device, per-metric exponentially
+weighted mean and variance, then folded into them:
+
+    z = (x - mean) / max(std, ANOMALY_MIN_STD)
+    mean += alpha * (x - mean)
+    var = (1 - alpha) * (var + alpha * (x - mean_before)**2)
+
+Readings are scored before they are folded in, so a spike doesn't hide
+itself. Scores start once a device has ANOMALY_WARMUP readings of a metric.
+
+The statistics live in NumPy arrays with one row per device slot, so a
+batch is scored and updated with a handful of array operations however many
+devices it holds. Notifications with condition "anomaly" fire when the
+absolute z-score of their metric reaches their threshold and go through the
+same alert state as any other rule. Statistics are per process and start
+over after a restart.
+"""
+import math
+import os
+import numpy as np
+from .rules import METRICS, RuleSet
+
+ANOMALY_DETECTION = os.getenv("ANOMALY_DETECTION", "false").lower() == "true"
+ANOMALY_ALPHA = float(os.getenv("ANOMALY_ALPHA", "0.05"))
+ANOMALY_WARMUP = int(os.getenv("ANOMALY_WARMUP", "30"))
+# Floor for the standard deviation, in the metric's own units, so a metric
+# that has been nearly constant doesn't flag every small change
+ANOMALY_MIN_STD = float(os.getenv("ANOMALY_MIN_STD", "0.5"))
+ANOMALY_INITIAL_SLOTS = 1024
+
+METRIC_INDEX = {metric: i for i, metric in enumerate(METRICS)}
+
+class FleetStats:
+    """EWMA mean and variance of every metric of every device seen so far."""
+
+    def __init__(
+        self,
+        alpha: float = ANOMALY_ALPHA,
+        warmup: int = ANOMALY_WARMUP,
+        min_std: float = ANOMALY_MIN_STD,
+        slots: int = ANOMALY_INITIAL_SLOTS,
+    ):
+        self.alpha = alpha
+        # The first reading only sets the mean, so it can't be scored
+        self.warmup = max(warmup, 1)
+        self.min_std = min_std
+        self.slots = {}
+        self.mean = np.zeros((slots, len(METRICS)))
+        self.var = np.zeros((slots, len(METRICS)))
+        self.count = np.zeros((slots, len(METRICS)), dtype=np.int64)
+        self.scored = 0
+
+    def slot(self, device_id) -> int:
+        slot = self.slots.get(device_id)
+        if slot is None:
+            slot = self.slots[device_id] = len(self.slots)
+            if slot == len(self.mean):
+                self._grow()
+        return slot
+
+    def _grow(self):
+        extra = len(self.mean)
+        self.mean = np.concatenate([self.mean, np.zeros_like(self.mean[:extra])])
+        self.var = np.concatenate([self.var, np.zeros_like(self.var[:extra])])
+        self.count = np.concatenate([self.count, np.zeros_like(self.count[:extra])])
+
+    def update(self, device_ids, values: np.ndarray) -> np.ndarray:
+        """Score a batch and fold it into the statistics.
+
+        `values` has one row per reading and one column per METRICS entry,
+        NaN where a reading lacks the metric. Returns z-scores of the same
+        shape, NaN where there is no score (missing value or warm-up).
+        """
+        slots = np.fromiter((self.slot(device_id) for device_id in device_ids), dtype=np.intp, count=len(device_ids))
+        scores = np.full(values.shape, np.nan)
+        if not len(slots):
+            return scores
+        # Fancy-index assignment keeps only one of several rows with the same
+        # slot, so a device with several readings in the batch is updated in
+        # rounds: its first reading in the first round, and so on
+        order = np.argsort(slots, kind="stable")
+        ordered = slots[order]
+        starts = np.r_[True, ordered[1:] != ordered[:-1]]
+        positions = np.arange(len(slots))
+        occurrence = np.empty(len(slots), dtype=np.intp)
+        occurrence[order] = positions - np.maximum.accumulate(np.where(starts, positions, 0))
+        for round_ in range(occurrence.max() + 1):
+            rows = np.flatnonzero(occurrence == round_)
+            scores[rows] = self._update_rows(slots[rows], values[rows])
+        self.scored += len(slots)
+        return scores
+
+    def _update_rows(self, slots: np.ndarray, x: np.ndarray) -> np.ndarray:
+        mean = self.mean[slots]
+        var = self.var[slots]
+        count = self.count[slots]
+        valid = ~np.isnan(x)
+
+        scores = (x - mean) / np.maximum(np.sqrt(var), self.min_std)
+        scores[~valid | (count < self.warmup)] = np.nan
+
+        delta = np.where(valid, x - mean, 0.0)
+        first = valid & (count == 0)
+        self.mean[slots] = np.where(first, x, mean + self.alpha * delta)
+        self.var[slots] = np.where(first, 0.0, np.where(valid, (1 - self.alpha) * (var + self.alpha * delta * delta), var))
+        self.count[slots] = count + valid
+        return scores
+
+    def stats(self):
+        return {"devices": len(self.slots), "capacity": len(self.mean), "scored": self.scored}
+
+class AnomalyDetector:
+    """The pipeline's entry point: scores batches when enabled."""
+
+    def __init__(self, enabled: bool = ANOMALY_DETECTION, fleet: FleetStats = None):
+        self.enabled = enabled
+        self.fleet = fleet or FleetStats()
+
+    def score(self, readings):
+        """z-scores for a batch of alerts.Reading, as one list per reading
+        ordered like METRICS, or None when detection is off."""
+        if not self.enabled or not readings:
+            return None
+        values = np.array(
+            [[getattr(reading, metric) for metric in METRICS] for reading in readings], dtype=np.float64
+        )
+        return self.fleet.update([reading.device_id for reading in readings], values).tolist()
+
+    def reset(self):
+        self.fleet = FleetStats(self.fleet.alpha, self.fleet.warmup, self.fleet.min_std)
+
+def evaluate(ruleset: RuleSet, device_id, values: dict, scores) -> dict:
+    """Anomaly rules of one device for one scored reading, in the
+    {rule_id: (value, matches, holds)} form WindowStore.update returns."""
+    results = {}
+    for rule in ruleset.anomaly_for(device_id):
+        score = scores[METRIC_INDEX[rule.metric]]
+        if math.isnan(score):
+            continue
+        score = abs(score)
+        results[rule.id] = (values[rule.metric], score >= rule.threshold, score >= rule.threshold - rule.hysteresis)
+    return results
+
+anomaly_detector = AnomalyDetector()
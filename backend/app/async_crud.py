@@ -0,0 +1,241 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from typing import List, Optional
+import uuid
+from datetime import datetime, timedelta
+from . import models, schemas, cache, timeseries, rollups, pagination
+from .hashing import password_hasher
+from .rules import METRICS
+from .crud import _cache_device, derived_statements
+
+# Async counterparts of the crud functions used on the hot routes, so that
+# ingest and history queries never block the event loop.
+
+# Users: bcrypt runs on the password hasher's pool, never on the event loop
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    hashed_password = await password_hasher.hash(user.password)
+    db_user = models.User(
+        id=uuid.uuid4(),
+        email=user.email,
+        name=user.name,
+        hashed_password=hashed_password,
+        created_at=models.utcnow()
+    )
+    db.add(db_user)
+    await db.commit()
+    return db_user
+
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await get_user_by_email(db, email)
+    if not user:
+        return False
+    if not await password_hasher.verify(password, user.hashed_password):
+        return False
+    return user
+
+# Device resolution
+async def get_device_by_sn(db: AsyncSession, sn: str):
+    result = await db.execute(select(models.Device).where(models.Device.sn == sn))
+    return result.scalars().first()
+
+async def get_devices_by_sns(db: AsyncSession, sns: List[str]):
+    result = await db.execute(select(models.Device).where(models.Device.sn.in_(sns)))
+    return result.scalars().all()
+
+async def resolve_device(db: AsyncSession, sn: str):
+    cached = cache.device_cache.get(sn)
+    if cached is None:
+        device = await get_device_by_sn(db, sn)
+        if not device:
+            return None
+        cached = _cache_device(device)
+    return cached
+
+async def resolve_device_token(db: AsyncSession, device_id: str, sn: str):
+    # A token outlives its device: if the SN was re-registered since, the
+    # device under it has another id and the token is no good
+    device = await db.get(models.Device, uuid.UUID(device_id))
+    if device is None or device.sn != sn:
+        return None
+    return _cache_device(device)
+
+async def resolve_devices(db: AsyncSession, sns: List[str]):
+    resolved = {}
+    missing = []
+    for sn in set(sns):
+        cached = cache.device_cache.get(sn)
+        if cached is None:
+            missing.append(sn)
+        else:
+            resolved[sn] = cached
+    if missing:
+        for device in await get_devices_by_sns(db, missing):
+            resolved[device.sn] = _cache_device(device)
+    return resolved
+
+# Heartbeat CRUD
+def heartbeat_rows(heartbeats: List[schemas.HeartbeatCreate], devices: dict):
+    # Insert parameters for the known SNs, plus a list aligned with
+    # `heartbeats` holding the new Heartbeat, or None where the SN is unknown
+    now = models.utcnow()
+    rows = []
+    results = []
+    for heartbeat in heartbeats:
+        device = devices.get(heartbeat.device_sn)
+        if not device:
+            results.append(None)
+            continue
+        row = heartbeat.dict(exclude={"device_sn"})
+        row["id"] = uuid.uuid4()
+        row["device_id"] = device.id
+        row["created_at"] = now
+        rows.append(row)
+        results.append(models.Heartbeat(**row))
+    return rows, results
+
+async def insert_heartbeat_rows(db: AsyncSession, rows: List[dict], skip_existing: bool = False):
+    # One multi-row INSERT plus rollups and latest status, in one commit.
+    # skip_existing makes replays and retries idempotent: rows already
+    # stored are left out, and out of the rollups too.
+    dialect_name = db.bind.dialect.name
+    if skip_existing and dialect_name in ("postgresql", "sqlite"):
+        insert_fn = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+        stmt = insert_fn(models.Heartbeat).on_conflict_do_nothing().returning(models.Heartbeat.id)
+        inserted = set((await db.execute(stmt, rows)).scalars())
+        rows = [row for row in rows if row["id"] in inserted]
+    else:
+        await db.execute(insert(models.Heartbeat), rows)
+    for stmt in derived_statements(dialect_name, [models.Heartbeat(**row) for row in rows]):
+        await db.execute(stmt)
+    await db.commit()
+    return len(rows)
+
+async def create_heartbeats_bulk(db: AsyncSession, heartbeats: List[schemas.HeartbeatCreate], devices: Optional[dict] = None):
+    # One SN lookup, one multi-row INSERT and one commit for the whole batch.
+    # Returns a list aligned with `heartbeats`, None where the SN is unknown.
+    if devices is None:
+        devices = await resolve_devices(db, [h.device_sn for h in heartbeats])
+
+    rows, results = heartbeat_rows(heartbeats, devices)
+    if rows:
+        await insert_heartbeat_rows(db, rows)
+    return results
+
+def _heartbeat_window(device_id: uuid.UUID, start_date: datetime, end_date: datetime):
+    return select(models.Heartbeat).where(
+        and_(
+            models.Heartbeat.device_id == device_id,
+            models.Heartbeat.created_at >= start_date,
+            models.Heartbeat.created_at <= end_date
+        )
+    )
+
+async def get_heartbeats(db: AsyncSession, device_id: uuid.UUID, start_date: datetime, end_date: datetime, limit: Optional[int] = None, cursor: Optional[str] = None):
+    query = _heartbeat_window(device_id, start_date, end_date)
+    result = await db.execute(pagination.keyset(query, models.Heartbeat, cursor, limit, descending=True))
+    return result.scalars().all()
+
+async def get_heartbeat_columns(db: AsyncSession, device_id: uuid.UUID, start_date: datetime, end_date: datetime, limit: Optional[int] = None, cursor: Optional[str] = None):
+    # Plain (created_at, id, *METRICS) rows for columnar payloads, skipping
+    # ORM object construction entirely
+    columns = [getattr(models.Heartbeat, metric) for metric in METRICS]
+    query = select(models.Heartbeat.created_at, models.Heartbeat.id, *columns).where(
+        and_(
+            models.Heartbeat.device_id == device_id,
+            models.Heartbeat.created_at >= start_date,
+            models.Heartbeat.created_at <= end_date
+        )
+    )
+    result = await db.execute(pagination.keyset(query, models.Heartbeat, cursor, limit, descending=True))
+    return result.all()
+
+async def stream_heartbeats(db: AsyncSession, device_id: uuid.UUID, start_date: datetime, end_date: datetime):
+    # Server-side cursor: rows arrive in chunks instead of one materialized list
+    query = pagination.keyset(_heartbeat_window(device_id, start_date, end_date), models.Heartbeat, descending=True)
+    return await db.stream_scalars(query.execution_options(yield_per=pagination.STREAM_CHUNK_SIZE))
+
+async def get_heartbeat_series(db: AsyncSession, device_id: uuid.UUID, start_date: datetime, end_date: datetime, bucket: str, agg: str):
+    # Downsampled history computed in SQL: one row per bucket, one column per metric
+    if agg != "p95":
+        return await get_rollup_series(db, device_id, start_date, end_date, bucket, agg)
+
+    dialect = db.bind.dialect.name
+    bucket_start = timeseries.bucket_expr(dialect, models.Heartbeat.created_at, timeseries.BUCKETS[bucket])
+    window = and_(
+        models.Heartbeat.device_id == device_id,
+        models.Heartbeat.created_at >= start_date,
+        models.Heartbeat.created_at <= end_date
+    )
+    series = timeseries.empty_series()
+
+    if dialect != "postgresql":
+        # No percentile aggregate in SQLite: group the ordered rows here
+        columns = [getattr(models.Heartbeat, metric) for metric in METRICS]
+        result = await db.execute(select(bucket_start, *columns).where(window).order_by(bucket_start))
+        groups = {}
+        for row in result:
+            groups.setdefault(row[0], []).append(row[1:])
+        for start, rows in groups.items():
+            series["timestamps"].append(timeseries.to_datetime(start))
+            series["count"].append(len(rows))
+            for i, metric in enumerate(METRICS):
+                series[metric].append(timeseries.percentile([r[i] for r in rows], 0.95))
+        return series
+
+    aggregates = [
+        func.percentile_cont(0.95).within_group(getattr(models.Heartbeat, metric))
+        for metric in METRICS
+    ]
+    result = await db.execute(
+        select(bucket_start, func.count(), *aggregates)
+        .where(window)
+        .group_by(bucket_start)
+        .order_by(bucket_start)
+    )
+    for row in result:
+        series["timestamps"].append(timeseries.to_datetime(row[0]))
+        series["count"].append(row[1])
+        for i, metric in enumerate(METRICS):
+            value = row[2 + i]
+            series[metric].append(float(value) if value is not None else None)
+    return series
+
+async def get_rollup_series(db: AsyncSession, device_id: uuid.UUID, start_date: datetime, end_date: datetime, bucket: str, agg: str):
+    # avg/min/max read from the coarsest rollup table that divides the bucket,
+    # so the cost is per bucket, not per raw reading. The range is widened to
+    # whole buckets, so the ones at its edges cover their whole width.
+    _, _, rollup = rollups.ROLLUP_FOR_BUCKET[bucket]
+    width = timeseries.BUCKETS[bucket]
+    bucket_start = timeseries.bucket_expr(db.bind.dialect.name, rollup.bucket_start, width)
+    if agg == "avg":
+        aggregates = [func.sum(getattr(rollup, f"{m}_sum")) / func.sum(rollup.count) for m in METRICS]
+    elif agg == "min":
+        aggregates = [func.min(getattr(rollup, f"{m}_min")) for m in METRICS]
+    else:
+        aggregates = [func.max(getattr(rollup, f"{m}_max")) for m in METRICS]
+
+    result = await db.execute(
+        select(bucket_start, func.sum(rollup.count), *aggregates)
+        .where(
+            and_(
+                rollup.device_id == device_id,
+                rollup.bucket_start >= rollups.bucket_start(start_date, width),
+                rollup.bucket_start < rollups.bucket_start(end_date, width) + timedelta(seconds=width)
+            )
+        )
+        .group_by(bucket_start)
+        .order_by(bucket_start)
+    )
+    series = timeseries.empty_series()
+    for row in result:
+        series["timestamps"].append(timeseries.to_datetime(row[0]))
+        series["count"].append(int(row[1]))
+        for i, metric in enumerate(METRICS):
+            value = row[2 + i]
+            series[metric].append(float(value) if value is not None else None)
+    return series
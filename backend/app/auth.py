@@ -1,15 +1,20 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
+import os
+import time
+import uuid
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy import event
 from sqlalchemy.orm import Session
-from . import models, database
+from . import models, database, cache
 
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+DEVICE_TOKEN_EXPIRE_DAYS = int(os.getenv("DEVICE_TOKEN_EXPIRE_DAYS", "365"))
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
@@ -30,6 +35,77 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def _verify_token(token: str) -> Optional[cache.TokenClaims]:
+    claims = cache.token_cache.get(token)
+    if claims is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            return None
+        email: str = payload.get("sub")
+        # Device tokens never authenticate a user
+        if email is None or payload.get("typ") == "device":
+            return None
+        claims = cache.TokenClaims(payload.get("uid"), email, payload.get("exp"))
+        cache.token_cache.set(token, claims)
+    # A cached token must not outlive its own expiry
+    if claims.expires_at is not None and claims.expires_at <= time.time():
+        cache.token_cache.invalidate(token)
+        return None
+    return claims
+
+def _cache_user(user: models.User, key: str) -> cache.CachedUser:
+    cached = cache.CachedUser(user.id, user.email, user.name, user.created_at)
+    cache.user_cache.set(key, cached)
+    return cached
+
+def get_user_from_token(db: Session, token: str):
+    # Common path: token and user both cached, no JWT decode and no query.
+    # Tokens issued before the `uid` claim fall back to a lookup by email.
+    claims = _verify_token(token)
+    if claims is None:
+        return None
+    key = claims.user_id or claims.email
+    user = cache.user_cache.get(key)
+    if user is not None:
+        return user
+    if claims.user_id:
+        try:
+            db_user = db.get(models.User, uuid.UUID(claims.user_id))
+        except ValueError:
+            return None
+    else:
+        db_user = db.query(models.User).filter(models.User.email == claims.email).first()
+    if db_user is None:
+        return None
+    return _cache_user(db_user, key)
+
+def invalidate_user(user):
+    cache.user_cache.invalidate(str(user.id))
+    cache.user_cache.invalidate(user.email)
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _user_changed(mapper, connection, target):
+    invalidate_user(target)
+
+def create_device_token(device: models.Device) -> str:
+    return create_access_token(
+        {"sub": device.sn, "did": str(device.id), "typ": "device"},
+        expires_delta=timedelta(days=DEVICE_TOKEN_EXPIRE_DAYS)
+    )
+
+def get_device_claims_from_token(token: str) -> Optional[Tuple[str, str]]:
+    # (device id, serial number); the id is what identifies the device, since
+    # an SN can be deleted and registered again by anyone
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    if payload.get("typ") != "device" or not payload.get("did") or not payload.get("sub"):
+        return None
+    return payload["did"], payload["sub"]
+
 def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(database.get_db)
@@ -39,16 +115,7 @@ def get_current_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    user = db.query(models.User).filter(models.User.email == email).first()
+    user = get_user_from_token(db, credentials.credentials)
     if user is None:
         raise credentials_exception
     return user
\ No newline at end of file
@@ -0,0 +1,104 @@
+from typing import Callable, Iterable, List, Tuple
+import asyncio
+import json
+import logging
+import os
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+# memory:// delivers within this process only; redis://host:6379/0 fans out
+# across every worker and replica subscribed to the same channel.
+BROADCAST_URL = os.getenv("BROADCAST_URL", "memory://")
+BROADCAST_CHANNEL = os.getenv("BROADCAST_CHANNEL", "iot:alerts")
+
+Handler = Callable[[str, str], None]
+
+class MemoryBackplane:
+    """In-process backplane, used for single-worker deployments and tests."""
+
+    def __init__(self):
+        self.handlers: List[Handler] = []
+
+    def subscribe(self, handler: Handler):
+        self.handlers.append(handler)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, user_id, message: str):
+        await self.publish_many([(user_id, message)])
+
+    async def publish_many(self, items: Iterable[Tuple[str, str]]):
+        for user_id, message in items:
+            for handler in self.handlers:
+                handler(str(user_id), message)
+
+class RedisBackplane:
+    """Redis pub/sub backplane: every worker publishes alerts once and each
+    worker hands the ones it receives to its local subscribers."""
+
+    def __init__(self, url: str, channel: str = BROADCAST_CHANNEL, reconnect_delay: float = 1.0):
+        self.url = url
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.handlers: List[Handler] = []
+        self._redis = None
+        self._listener = None
+
+    def subscribe(self, handler: Handler):
+        self.handlers.append(handler)
+
+    async def start(self):
+        self._redis = aioredis.from_url(self.url)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    async def publish(self, user_id, message: str):
+        await self.publish_many([(user_id, message)])
+
+    async def publish_many(self, items: Iterable[Tuple[str, str]]):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for user_id, message in items:
+                pipe.publish(self.channel, json.dumps({"user_id": str(user_id), "message": message}))
+            await pipe.execute()
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for item in pubsub.listen():
+                        if item["type"] != "message":
+                            continue
+                        data = json.loads(item["data"])
+                        for handler in self.handlers:
+                            handler(data["user_id"], data["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Lost broadcast subscription, reconnecting")
+                await asyncio.sleep(self.reconnect_delay)
+
+def create_backplane(url: str = BROADCAST_URL):
+    if url.startswith("memory://"):
+        return MemoryBackplane()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackplane(url)
+    raise ValueError(f"Unsupported BROADCAST_URL: {url}")
+
+backplane = create_backplane()
@@ -0,0 +1,70 @@
+from collections import OrderedDict, namedtuple
+import os
+import threading
+import time
+
+DEVICE_CACHE_SIZE = int(os.getenv("DEVICE_CACHE_SIZE", "10000"))
+DEVICE_CACHE_TTL = float(os.getenv("DEVICE_CACHE_TTL", "300"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+
+# What the ingest path needs to know about a device, keyed by serial number
+CachedDevice = namedtuple("CachedDevice", ["id", "user_id", "name"])
+
+# Verified JWT claims, keyed by the raw token
+TokenClaims = namedtuple("TokenClaims", ["user_id", "email", "expires_at"])
+
+# Authenticated user as the routes see it, keyed by user id
+CachedUser = namedtuple("CachedUser", ["id", "email", "name", "created_at"])
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+device_cache = TTLCache(DEVICE_CACHE_SIZE, DEVICE_CACHE_TTL)
+token_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+user_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
@@ -0,0 +1,68 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import json
+import msgpack
+from fastapi import Response
+from .rules import METRICS
+
+# Columnar history payloads: one array per metric plus epoch-ms timestamps,
+# instead of one object per reading with its ids and ISO dates repeated.
+# Clients opt in through the Accept header; plain JSON stays the default.
+
+COLUMNAR_JSON = "application/vnd.iot.columnar+json"
+MSGPACK = "application/msgpack"
+MEDIA_TYPES = {
+    COLUMNAR_JSON: COLUMNAR_JSON,
+    MSGPACK: MSGPACK,
+    "application/x-msgpack": MSGPACK,
+}
+
+def negotiate(accept: Optional[str]) -> Optional[str]:
+    """Columnar media type preferred by an Accept header, None for plain JSON."""
+    if not accept:
+        return None
+    choices = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            choices.append((-quality, position, media_type.lower()))
+    for _, _, media_type in sorted(choices):
+        if media_type in MEDIA_TYPES:
+            return MEDIA_TYPES[media_type]
+        if media_type in ("application/json", "*/*", "application/*"):
+            return None
+    return None
+
+def to_epoch_ms(timestamp: datetime) -> int:
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1000)
+
+def series_payload(device_id, bucket: str, agg: str, series: Dict[str, List]) -> dict:
+    payload = {"device_id": str(device_id), "bucket": bucket, "agg": agg}
+    payload.update(series)
+    payload["timestamps"] = [to_epoch_ms(t) for t in series["timestamps"]]
+    return payload
+
+def rows_payload(device_id, rows) -> dict:
+    # `rows` are (created_at, id, *METRICS) tuples from get_heartbeat_columns
+    payload = {"device_id": str(device_id), "bucket": None, "agg": None}
+    payload["timestamps"] = [to_epoch_ms(row[0]) for row in rows]
+    for i, metric in enumerate(METRICS):
+        payload[metric] = [row[2 + i] for row in rows]
+    return payload
+
+def render(payload: dict, media_type: str, headers: Optional[dict] = None) -> Response:
+    headers = dict(headers or {}, Vary="Accept")
+    if media_type == MSGPACK:
+        content = msgpack.packb(payload, use_bin_type=True)
+    else:
+        content = json.dumps(payload, separators=(",", ":"))
+    return Response(content=content, media_type=media_type, headers=headers)
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import time
+from . import auth
+
+# bcrypt costs hundreds of milliseconds of CPU per call. It runs on a small
+# dedicated pool (the C extension releases the GIL), so a login storm uses at
+# most PASSWORD_HASH_WORKERS cores and never blocks the event loop or the
+# threadpool the other routes share.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", "32"))
+
+class HasherBusy(Exception):
+    """Raised when the hashing queue is full; callers should answer 503."""
+
+class PasswordHasher:
+    """Bounded executor for password hashing and verification.
+
+    At most `workers` hashes run at once and `queue_size` more may wait;
+    beyond that calls fail fast with HasherBusy instead of piling up.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, queue_size: int = PASSWORD_HASH_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = None
+        self.pending = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise HasherBusy()
+        self.pending += 1
+        self.submitted += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            # Includes time spent waiting in the queue
+            elapsed = time.perf_counter() - start
+            self.pending -= 1
+            self.completed += 1
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(auth.get_password_hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(auth.verify_password, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_ms": round(self.total_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+            "max_ms": round(self.max_seconds * 1000, 2),
+        }
+
+password_hasher = PasswordHasher()
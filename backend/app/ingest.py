@@ -0,0 +1,424 @@
+"""Write-ahead ingest buffer with group commit.
+
+With INGEST_DURABILITY=sync (the default) every request writes its
+heartbeats to the database before it is answered. The other modes answer as
+soon as the rows are in an in-process buffer, and a flusher task writes the
+buffer every INGEST_FLUSH_INTERVAL_MS or INGEST_FLUSH_ROWS rows, whichever
+comes first, as one INSERT and one commit:
+
+    memory  rows only live in the buffer; a crash loses up to one interval
+    log     rows are also appended to a segment file under INGEST_WAL_DIR
+            and fsync'd before the answer (one fsync covers every request
+            waiting at that moment); segments are deleted once their rows
+            are committed and replayed on startup if they weren't
+
+Each process logs to its own subdirectory of INGEST_WAL_DIR and holds an
+flock on it while it runs, so workers sharing the directory only replay the
+logs of processes that are gone.
+
+History reads lag ingest by up to one flush interval in the buffered modes.
+"""
+from collections import deque
+from datetime import datetime
+from typing import List, Optional
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from sqlalchemy.exc import IntegrityError
+from . import async_crud, database, models, schemas
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_MODES = ("memory", "log", "sync")
+INGEST_DURABILITY = os.getenv("INGEST_DURABILITY", "sync")
+INGEST_FLUSH_INTERVAL_MS = float(os.getenv("INGEST_FLUSH_INTERVAL_MS", "50"))
+INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", "5000"))
+INGEST_BUFFER_SIZE = int(os.getenv("INGEST_BUFFER_SIZE", "100000"))
+INGEST_WAL_DIR = os.getenv("INGEST_WAL_DIR", "./ingest-wal")
+INGEST_REPLAY_CHUNK = 10000
+
+if INGEST_DURABILITY not in DURABILITY_MODES:
+    raise ValueError(f"INGEST_DURABILITY must be one of {', '.join(DURABILITY_MODES)}")
+
+class IngestBufferFull(Exception):
+    """Raised when the buffer can't take more rows; callers should answer 503."""
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return value.hex
+    raise TypeError(f"Cannot encode {type(value).__name__}")
+
+def _lock(directory: str):
+    """The directory's lock file, locked, or None when another process holds it."""
+    try:
+        lock_file = open(os.path.join(directory, SegmentLog.LOCK_FILE), "a")
+    except FileNotFoundError:
+        # Replayed and removed by another process meanwhile
+        return None
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+def _decode(row: dict) -> dict:
+    row["id"] = uuid.UUID(row["id"])
+    row["device_id"] = uuid.UUID(row["device_id"])
+    row["boot_time"] = datetime.fromisoformat(row["boot_time"])
+    row["created_at"] = datetime.fromisoformat(row["created_at"])
+    return row
+
+class SegmentLog:
+    """Append-only segment files of JSON lines, one segment per flush.
+
+    Appends are written straight away and made durable by `sync`, which
+    runs one fsync for every append that arrived while the previous fsync
+    was in progress. `create` and `orphans` hand out logs whose directory
+    lock the caller holds until `close`.
+    """
+    LOCK_FILE = "lock"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock_file = None
+        self._file = None
+        self._path = None
+        self._next = 0
+        self._waiter = None
+        self._lock = asyncio.Lock()
+        self.fsyncs = 0
+
+    @classmethod
+    def create(cls, root: str) -> "SegmentLog":
+        """A fresh log for this process under `root`."""
+        log = cls(os.path.join(root, f"{os.getpid()}-{uuid.uuid4().hex[:8]}"))
+        os.makedirs(log.directory)
+        log._lock_file = _lock(log.directory)
+        return log
+
+    @classmethod
+    def orphans(cls, root: str) -> List["SegmentLog"]:
+        """Logs under `root` whose process is gone; a running one holds its lock."""
+        if not os.path.isdir(root):
+            return []
+        logs = []
+        for name in sorted(os.listdir(root)):
+            directory = os.path.join(root, name)
+            if not os.path.isdir(directory):
+                continue
+            lock_file = _lock(directory)
+            if lock_file is not None:
+                log = cls(directory)
+                log._lock_file = lock_file
+                logs.append(log)
+        return logs
+
+    def segments(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        existing = self.segments()
+        if existing:
+            self._next = int(os.path.basename(existing[-1]).split(".")[0]) + 1
+        self._open_next()
+
+    def _open_next(self):
+        self._path = os.path.join(self.directory, f"{self._next:012d}.log")
+        self._next += 1
+        self._file = open(self._path, "ab")
+
+    def write(self, rows: List[dict]):
+        self._file.write(b"".join(json.dumps(row, default=_encode).encode() + b"\n" for row in rows))
+
+    async def sync(self):
+        if self._waiter is None:
+            self._waiter = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._fsync())
+        await asyncio.shield(self._waiter)
+
+    async def _fsync(self):
+        async with self._lock:
+            waiter, self._waiter = self._waiter, None
+            if waiter is None:
+                # rotate() already made these writes durable
+                return
+            try:
+                self._file.flush()
+                await asyncio.to_thread(os.fsync, self._file.fileno())
+                self.fsyncs += 1
+                waiter.set_result(None)
+            except Exception as e:
+                waiter.set_exception(e)
+
+    async def rotate(self) -> str:
+        """Close the current segment and start a new one; returns the closed path."""
+        async with self._lock:
+            waiter, self._waiter = self._waiter, None
+            self._file.flush()
+            if waiter is not None:
+                await asyncio.to_thread(os.fsync, self._file.fileno())
+                self.fsyncs += 1
+            self._file.close()
+            closed = self._path
+            self._open_next()
+            if waiter is not None:
+                waiter.set_result(None)
+            return closed
+
+    def remove(self, paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            empty = os.path.getsize(self._path) == 0
+            if empty:
+                os.remove(self._path)
+            self._file = None
+        if self._lock_file is not None:
+            if not self.segments():
+                # Nothing left to replay; removed while still locked
+                os.remove(os.path.join(self.directory, self.LOCK_FILE))
+                try:
+                    os.rmdir(self.directory)
+                except OSError:
+                    # Another process recreated the lock file in between
+                    pass
+            # Closing releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    @staticmethod
+    def read(path: str) -> List[dict]:
+        rows = []
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    rows.append(_decode(json.loads(line)))
+                except (ValueError, KeyError):
+                    # A torn last line from a crash mid-write; it was never acknowledged
+                    logger.warning("Skipping unreadable line in %s", path)
+        return rows
+
+class IngestBuffer:
+    """Buffers heartbeat rows and commits them in groups (see module docstring)."""
+
+    def __init__(
+        self,
+        durability: str = INGEST_DURABILITY,
+        flush_interval_ms: float = INGEST_FLUSH_INTERVAL_MS,
+        flush_rows: int = INGEST_FLUSH_ROWS,
+        maxsize: int = INGEST_BUFFER_SIZE,
+        wal_dir: str = INGEST_WAL_DIR,
+    ):
+        self.durability = durability
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_rows = flush_rows
+        self.maxsize = maxsize
+        self.wal_dir = wal_dir
+        self.session_factory = database.AsyncSessionLocal
+        self.rows = deque()
+        self.wal = None
+        self._unflushed_segments = []
+        # Rows at the front of `rows` put back by a failed flush
+        self._retrying = 0
+        self._flusher = None
+        self._wake = None
+        self._flush_lock = None
+        self.appended = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.replayed = 0
+        self.last_flush_ms = 0.0
+
+    @property
+    def buffered(self):
+        return self.durability != "sync"
+
+    @property
+    def running(self):
+        return self._flusher is not None and not self._flusher.done()
+
+    async def start(self):
+        if self.running:
+            return
+        # Segments left by a crash are replayed whatever the current mode
+        await self.replay()
+        if self.buffered:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        if self.durability == "log":
+            self.wal = SegmentLog.create(self.wal_dir)
+            self.wal.open()
+        self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Final ingest flush failed")
+        if self.rows:
+            logger.warning("Ingest buffer stopped with %d rows not committed", len(self.rows))
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+
+    async def append(self, rows: List[dict]):
+        """Buffer rows; returns once they are as durable as the mode promises."""
+        if not self.running:
+            # Started lazily so ingest works even where no lifespan ran
+            self._start_flusher()
+        if len(self.rows) + len(rows) > self.maxsize:
+            self.rejected += len(rows)
+            raise IngestBufferFull()
+        if self.wal is not None:
+            self.wal.write(rows)
+        self.rows.extend(rows)
+        self.appended += len(rows)
+        if len(self.rows) >= self.flush_rows:
+            self._wake.set()
+        if self.wal is not None:
+            await self.wal.sync()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Ingest flush failed")
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.rows:
+                return
+            # Taking the rows and rotating happen with no await in between, so
+            # the closed segments hold exactly the rows being written
+            batch = list(self.rows)
+            self.rows.clear()
+            if self.wal is not None:
+                self._unflushed_segments.append(await self.wal.rotate())
+            retrying, self._retrying = self._retrying, 0
+            start = time.perf_counter()
+            committed = 0
+            try:
+                for i in range(0, len(batch), self.flush_rows):
+                    chunk = batch[i:i + self.flush_rows]
+                    try:
+                        async with self.session_factory() as db:
+                            # A failed commit may have gone through anyway, so
+                            # retried rows skip the ones already stored
+                            await async_crud.insert_heartbeat_rows(db, chunk, skip_existing=i < retrying)
+                    except IntegrityError:
+                        await self._insert_each(chunk)
+                    committed = i + len(chunk)
+            except Exception:
+                # Keep the rows not committed yet at the front and retry on the
+                # next tick; their segments stay on disk until a flush succeeds
+                self.failed_flushes += 1
+                pending = batch[committed:]
+                self.rows.extendleft(reversed(pending))
+                self._retrying = len(pending)
+                raise
+            self.last_flush_ms = round((time.perf_counter() - start) * 1000, 2)
+            self.flushed += len(batch)
+            self.flushes += 1
+            if self.wal is not None:
+                self.wal.remove(self._unflushed_segments)
+                self._unflushed_segments = []
+
+    async def _insert_each(self, rows: List[dict]) -> int:
+        # One bad row, say for a device deleted while it was buffered, fails
+        # its whole chunk; write the chunk row by row and drop the bad ones
+        stored = 0
+        for row in rows:
+            try:
+                async with self.session_factory() as db:
+                    stored += await async_crud.insert_heartbeat_rows(db, [row], skip_existing=True)
+            except IntegrityError as e:
+                self.dropped += 1
+                logger.warning("Dropping heartbeat %s of device %s: %s", row["id"], row["device_id"], e.orig)
+        return stored
+
+    async def replay(self):
+        for log in SegmentLog.orphans(self.wal_dir):
+            try:
+                for path in log.segments():
+                    rows = SegmentLog.read(path)
+                    stored = 0
+                    for i in range(0, len(rows), INGEST_REPLAY_CHUNK):
+                        chunk = rows[i:i + INGEST_REPLAY_CHUNK]
+                        try:
+                            async with self.session_factory() as db:
+                                # A crash between commit and segment removal leaves
+                                # rows that are already stored; those are skipped
+                                stored += await async_crud.insert_heartbeat_rows(db, chunk, skip_existing=True)
+                        except IntegrityError:
+                            stored += await self._insert_each(chunk)
+                    log.remove([path])
+                    self.replayed += stored
+                    logger.info("Replayed %d of %d heartbeats from %s", stored, len(rows), path)
+            finally:
+                log.close()
+
+    def stats(self):
+        return {
+            "durability": self.durability,
+            "buffered": len(self.rows),
+            "maxsize": self.maxsize,
+            "appended": self.appended,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "replayed": self.replayed,
+            "fsyncs": self.wal.fsyncs if self.wal is not None else 0,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+ingest_buffer = IngestBuffer()
+
+async def store(db, heartbeats: List[schemas.HeartbeatCreate], devices: dict) -> List[Optional[models.Heartbeat]]:
+    """Ingest entry point for every route: writes through in sync mode,
+    buffers otherwise. Returns a list aligned with `heartbeats`, None where
+    the SN is unknown."""
+    if not ingest_buffer.buffered:
+        return await async_crud.create_heartbeats_bulk(db=db, heartbeats=heartbeats, devices=devices)
+    rows, results = async_crud.heartbeat_rows(heartbeats, devices)
+    if rows:
+        await ingest_buffer.append(rows)
+    return results
@@ -0,0 +1,68 @@
+"""The `device_latest_status` table: each device's most recent heartbeat.
+
+Ingest upserts it next to the raw rows, so fleet status is one row per
+device instead of a scan over `heartbeats`. Fill it for data ingested before
+it existed with `python -m app.latest`.
+"""
+from typing import List
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from . import models
+
+COLUMNS = (
+    "cpu_usage", "ram_usage", "disk_free", "temperature", "dns_latency",
+    "connectivity", "boot_time", "created_at",
+)
+
+def latest_per_device(heartbeats: List[models.Heartbeat]) -> List[dict]:
+    latest = {}
+    for heartbeat in heartbeats:
+        current = latest.get(heartbeat.device_id)
+        if current is None or heartbeat.created_at > current.created_at:
+            latest[heartbeat.device_id] = heartbeat
+    values = []
+    for device_id in sorted(latest, key=str):
+        heartbeat = latest[device_id]
+        row = {"device_id": device_id, "heartbeat_id": heartbeat.id}
+        row.update({column: getattr(heartbeat, column) for column in COLUMNS})
+        values.append(row)
+    return values
+
+def latest_statements(dialect_name: str, heartbeats: List[models.Heartbeat]):
+    if dialect_name not in ("postgresql", "sqlite") or not heartbeats:
+        return []
+    insert_fn = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+    stmt = insert_fn(models.DeviceLatestStatus).values(latest_per_device(heartbeats))
+    table = models.DeviceLatestStatus.__table__
+    set_ = {column: stmt.excluded[column] for column in ("heartbeat_id",) + COLUMNS}
+    # Readings that arrive out of order never replace a newer one
+    return [stmt.on_conflict_do_update(
+        index_elements=["device_id"],
+        set_=set_,
+        where=table.c.created_at < stmt.excluded.created_at
+    )]
+
+def rebuild(engine: Engine):
+    # Latest heartbeat per device straight from history (one window query)
+    ranked = select(
+        models.Heartbeat,
+        func.row_number().over(
+            partition_by=models.Heartbeat.device_id,
+            order_by=models.Heartbeat.created_at.desc()
+        ).label("rank")
+    ).subquery()
+    columns = [ranked.c.device_id, ranked.c.id] + [ranked.c[column] for column in COLUMNS]
+    with Session(engine) as db:
+        db.execute(delete(models.DeviceLatestStatus))
+        db.execute(insert(models.DeviceLatestStatus).from_select(
+            ["device_id", "heartbeat_id"] + list(COLUMNS),
+            select(*columns).where(ranked.c.rank == 1)
+        ))
+        db.commit()
+        return db.query(models.DeviceLatestStatus).count()
+
+if __name__ == "__main__":
+    from .database import engine
+    print(f"Latest status rebuilt for {rebuild(engine)} devices")
@@ -1,12 +1,53 @@
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .database import engine
-from . import models
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from .database import engine, async_engine
+from . import models, cache, metrics, retention, pagination
+from .alerts import alert_pipeline
+from .ingest import ingest_buffer
+from .backplane import MemoryBackplane, backplane
+from .hashing import password_hasher
+from .websocket import manager
 from .routes import auth, devices, heartbeat, notifications
 
 models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="IoT Device Monitoring API", version="1.0.0")
+HEALTH_DB_TIMEOUT = float(os.getenv("HEALTH_DB_TIMEOUT", "2"))
+
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Alerts published by any worker reach the sockets held by this one
+    backplane.subscribe(manager.send_to_user)
+    await backplane.start()
+    if not isinstance(backplane, MemoryBackplane):
+        # A shared backplane means several workers, and alert state is per
+        # process (see app/alert_state.py)
+        logger.warning("Alert rules are evaluated per worker: run a single worker for exact for_readings, cooldowns and windows")
+    alert_pipeline.start()
+    # Heartbeat partitions must exist before the first insert of the day,
+    # including the ones replayed from the write-ahead log just below
+    await asyncio.to_thread(retention.ensure_partitions, engine)
+    # Replays heartbeats a crash left in the write-ahead log
+    await ingest_buffer.start()
+    retention_task = asyncio.create_task(retention.retention_loop(engine))
+    yield
+    retention_task.cancel()
+    # Commit buffered heartbeats first; alerts for them are already queued
+    await ingest_buffer.stop()
+    # Let queued readings finish so no alert is lost on shutdown
+    await alert_pipeline.stop()
+    await backplane.stop()
+    backplane.handlers.remove(manager.send_to_user)
+    password_hasher.shutdown()
+
+app = FastAPI(title="IoT Device Monitoring API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -14,8 +55,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[pagination.NEXT_CURSOR_HEADER],
 )
 
+if metrics.METRICS_ENABLED:
+    # Added last so it wraps CORS too and times the whole request
+    app.add_middleware(metrics.MetricsMiddleware, router=app.router)
+    metrics.instrument(engine)
+    metrics.instrument(async_engine.sync_engine)
+
 app.include_router(auth.router, prefix="/api/auth", tags=["authentication"])
 app.include_router(devices.router, prefix="/api/devices", tags=["devices"])
 app.include_router(heartbeat.router, prefix="/api/heartbeat", tags=["heartbeat"])
@@ -27,4 +75,36 @@ def read_root():
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy"}
\ No newline at end of file
+    ready, checks = metrics.readiness()
+    return {
+        "status": "healthy",
+        "ready": ready,
+        "checks": checks,
+        "device_cache": cache.device_cache.stats(),
+        "alert_pipeline": alert_pipeline.stats(),
+        "ingest": ingest_buffer.stats(),
+        "websockets": manager.stats(),
+        "password_hasher": password_hasher.stats(),
+    }
+
+async def ping_database():
+    async with async_engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+@app.get("/health/ready")
+async def readiness_check():
+    # 503 takes the instance out of the load balancer until it catches up
+    ready, checks = metrics.readiness()
+    # Skip the probe query when the pool is saturated, it would only queue
+    if ready:
+        try:
+            await asyncio.wait_for(ping_database(), HEALTH_DB_TIMEOUT)
+            checks["database"] = {"ok": True}
+        except Exception as e:
+            checks["database"] = {"ok": False, "error": type(e).__name__}
+            ready = False
+    return JSONResponse({"ready": ready, "checks": checks}, status_code=200 if ready else 503)
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    return metrics.render()
\ No newline at end of file
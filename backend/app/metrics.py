@@ -0,0 +1,266 @@
+"""Prometheus metrics for requests, database work and background queues.
+
+MetricsMiddleware times every HTTP request under its route template (not
+the raw path, which would give one series per device id) and keeps the
+in-flight count. Engines passed to `instrument` report every query; queries
+made while serving a request are also added up per request, and a request
+that runs the same statement N_PLUS_ONE_THRESHOLD times or more is counted
+(and logged) as a likely N+1. Pool, WebSocket and alert queue gauges are
+read on each scrape. Values are per process; scrape every worker.
+"""
+from contextvars import ContextVar
+from typing import Optional
+import logging
+import os
+import time
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from starlette.responses import Response
+from starlette.routing import Match
+from . import cache, database
+from .alerts import alert_pipeline
+from .anomaly import anomaly_detector
+from .ingest import ingest_buffer
+from .websocket import manager
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+# /health/ready fails once this share of a pool's connections is checked out
+READY_POOL_SATURATION = float(os.getenv("READY_POOL_SATURATION", "0.9"))
+
+UNMATCHED_ROUTE = "unmatched"
+
+registry = CollectorRegistry()
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route",
+    ["method", "route", "status"], registry=registry,
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests being served",
+    ["method", "route"], registry=registry,
+)
+REQUEST_QUERIES = Histogram(
+    "db_queries_per_request", "SQL statements executed per HTTP request",
+    ["route"], registry=registry,
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250),
+)
+REQUEST_DB_SECONDS = Histogram(
+    "db_seconds_per_request", "Time spent in SQL statements per HTTP request",
+    ["route"], registry=registry,
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Duration of single SQL statements",
+    registry=registry,
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5),
+)
+N_PLUS_ONE = Counter(
+    "db_n_plus_one_total", "Requests that repeated one SQL statement at least N_PLUS_ONE_THRESHOLD times",
+    ["route"], registry=registry,
+)
+
+class RequestStats:
+    """Database work done on behalf of one request."""
+
+    __slots__ = ("queries", "seconds", "statements", "active")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements = {}
+        self.active = True
+
+    def record(self, statement: str, seconds: float):
+        self.queries += 1
+        self.seconds += seconds
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+
+    def repeated(self, threshold: int = N_PLUS_ONE_THRESHOLD):
+        """Statements executed at least `threshold` times, most repeated first."""
+        return sorted(
+            ((count, statement) for statement, count in self.statements.items() if count >= threshold),
+            reverse=True
+        )
+
+# Shared by the threadpool and greenlets serving the request, which run in
+# copies of its context
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    QUERY_DURATION.observe(elapsed)
+    stats = request_stats.get()
+    # Tasks started during a request (the alert worker) keep its context
+    # after it has finished; their queries are not the request's
+    if stats is not None and stats.active:
+        stats.record(statement, elapsed)
+
+def instrument(engine):
+    """Time every statement run on `engine` (a sync Engine or async_engine.sync_engine)."""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+def uninstrument(engine):
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.remove(engine, "before_cursor_execute", _before_cursor_execute)
+        event.remove(engine, "after_cursor_execute", _after_cursor_execute)
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, in-flight requests and DB work per route.
+
+    Written against raw ASGI rather than BaseHTTPMiddleware so it adds no
+    task per request and leaves streaming responses alone.
+    """
+
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+        self._warned = set()
+
+    def route_of(self, scope) -> str:
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", UNMATCHED_ROUTE)
+        return UNMATCHED_ROUTE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = self.route_of(scope)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+        in_progress.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats.active = False
+            request_stats.reset(token)
+            in_progress.dec()
+            REQUEST_DURATION.labels(method, route, str(status)).observe(elapsed)
+            REQUEST_QUERIES.labels(route).observe(stats.queries)
+            REQUEST_DB_SECONDS.labels(route).observe(stats.seconds)
+            self._check_n_plus_one(method, route, stats)
+
+    def _check_n_plus_one(self, method, route, stats):
+        repeated = stats.repeated()
+        if not repeated:
+            return
+        N_PLUS_ONE.labels(route).inc()
+        count, statement = repeated[0]
+        key = (method, route, statement)
+        if key not in self._warned:
+            self._warned.add(key)
+            logger.warning(
+                "Possible N+1 in %s %s: statement ran %d times in one request: %s",
+                method, route, count, " ".join(statement.split())[:200]
+            )
+
+def pool_stats(engine):
+    """Checked-out connections against what the pool can hand out, or None
+    for pools that don't limit connections (NullPool, SQLite's static pools)."""
+    pool = engine.pool
+    if not hasattr(pool, "checkedout"):
+        return None
+    # QueuePool keeps max_overflow private; -1 means unbounded overflow
+    max_overflow = getattr(pool, "_max_overflow", 0)
+    capacity = pool.size() + max_overflow if max_overflow >= 0 else None
+    checked_out = pool.checkedout()
+    return {
+        "size": pool.size(),
+        "checked_out": checked_out,
+        "overflow": max(0, pool.overflow()),
+        "capacity": capacity,
+        "saturation": round(checked_out / capacity, 3) if capacity else 0.0,
+    }
+
+def pools():
+    return {"sync": database.engine, "async": database.async_engine.sync_engine}
+
+class AppCollector:
+    """Gauges read from the pools, sockets and queues at scrape time."""
+
+    def collect(self):
+        checked_out = GaugeMetricFamily("db_pool_checked_out", "Connections checked out of the pool", labels=["engine"])
+        size = GaugeMetricFamily("db_pool_size", "Connections kept open by the pool", labels=["engine"])
+        saturation = GaugeMetricFamily("db_pool_saturation", "Checked-out share of the pool capacity", labels=["engine"])
+        for name, engine in pools().items():
+            stats = pool_stats(engine)
+            if stats is None:
+                continue
+            checked_out.add_metric([name], stats["checked_out"])
+            size.add_metric([name], stats["size"])
+            saturation.add_metric([name], stats["saturation"])
+        yield checked_out
+        yield size
+        yield saturation
+
+        websockets = manager.stats()
+        yield GaugeMetricFamily("websocket_connections", "Open notification WebSockets", value=websockets["connections"])
+        yield CounterMetricFamily("websocket_dropped_messages", "Messages dropped for slow WebSocket clients", value=websockets["dropped_messages"])
+
+        alerts = alert_pipeline.stats()
+        yield GaugeMetricFamily("alert_queue_depth", "Readings waiting for rule evaluation", value=alerts["depth"])
+        yield CounterMetricFamily("alert_readings_dropped", "Readings dropped because the alert queue was full", value=alerts["dropped"])
+        yield CounterMetricFamily("alert_readings_processed", "Readings evaluated against rules", value=alerts["processed"])
+        yield GaugeMetricFamily("alerts_firing", "Rule and device pairs currently firing", value=alerts["firing"])
+        yield CounterMetricFamily("alerts_written", "Alerts that started firing", value=alerts["alerts_written"])
+        yield CounterMetricFamily("alerts_resolved", "Firing alerts that resolved", value=alerts["alerts_resolved"])
+
+        scored = anomaly_detector.fleet.stats()
+        yield GaugeMetricFamily("anomaly_devices", "Devices with anomaly statistics", value=scored["devices"])
+        yield CounterMetricFamily("anomaly_readings_scored", "Readings scored for anomalies", value=scored["scored"])
+
+        buffered = ingest_buffer.stats()
+        yield GaugeMetricFamily("ingest_buffer_rows", "Heartbeats acknowledged but not yet committed", value=buffered["buffered"])
+        yield CounterMetricFamily("ingest_flushed_rows", "Heartbeats committed by the ingest flusher", value=buffered["flushed"])
+        yield CounterMetricFamily("ingest_failed_flushes", "Ingest flushes that failed and were retried", value=buffered["failed_flushes"])
+        yield CounterMetricFamily("ingest_dropped_rows", "Buffered heartbeats the database refused, e.g. for deleted devices", value=buffered["dropped"])
+        yield CounterMetricFamily("ingest_rejected_rows", "Heartbeats rejected because the ingest buffer was full", value=buffered["rejected"])
+
+        devices = cache.device_cache.stats()
+        yield CounterMetricFamily("device_cache_hits", "Device lookups served from cache", value=devices["hits"])
+        yield CounterMetricFamily("device_cache_misses", "Device lookups that went to the database", value=devices["misses"])
+
+registry.register(AppCollector())
+
+def render() -> Response:
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+def readiness(threshold: Optional[float] = None):
+    """Pool saturation checks; a saturated pool can't serve new requests in time."""
+    if threshold is None:
+        threshold = READY_POOL_SATURATION
+    checks = {}
+    ready = True
+    for name, engine in pools().items():
+        stats = pool_stats(engine)
+        if stats is None:
+            continue
+        stats["ok"] = stats["saturation"] < threshold
+        ready = ready and stats["ok"]
+        checks[f"db_pool_{name}"] = stats
+    return ready, checks
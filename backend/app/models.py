@@ -1,10 +1,25 @@
-from sqlalchemy import Column, String, DateTime, Float, Integer, ForeignKey, Boolean
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, DateTime, Float, Integer, ForeignKey, Boolean, Index, TypeDecorator, Uuid
+from sqlalchemy.orm import relationship, declared_attr
 from sqlalchemy.sql import func
 import uuid
+from datetime import datetime, timezone
 from .database import Base
 
+def utcnow():
+    return datetime.now(timezone.utc)
+
+class UUID(TypeDecorator):
+    """Native UUID on PostgreSQL, CHAR(32) elsewhere (SQLite in tests and
+    benchmarks). Also accepts ids as strings, as the routes pass them."""
+
+    impl = Uuid
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return uuid.UUID(value)
+        return value
+
 class User(Base):
     __tablename__ = "users"
 
@@ -12,8 +27,8 @@ class User(Base):
     email = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
     name = Column(String, nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    created_at = Column(DateTime(timezone=True), default=utcnow, server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=utcnow)
 
     devices = relationship("Device", back_populates="owner")
     notifications = relationship("Notification", back_populates="user")
@@ -27,14 +42,20 @@ class Device(Base):
     sn = Column(String(12), unique=True, nullable=False)
     description = Column(String)
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    # Timestamps are set client-side so writes never need a SELECT to read
+    # them back, and because keyset pagination orders on (created_at, id)
+    # while SQLite's CURRENT_TIMESTAMP only has second precision
+    created_at = Column(DateTime(timezone=True), default=utcnow, server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=utcnow)
 
     owner = relationship("User", back_populates="devices")
     heartbeats = relationship("Heartbeat", back_populates="device")
 
 class Heartbeat(Base):
     __tablename__ = "heartbeats"
+    # On PostgreSQL the table is range-partitioned by created_at (see
+    # app/retention.py), which is why created_at is part of the primary key.
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     device_id = Column(UUID(as_uuid=True), ForeignKey("devices.id"), nullable=False)
@@ -45,10 +66,64 @@ class Heartbeat(Base):
     dns_latency = Column(Float, nullable=False)
     connectivity = Column(Integer, nullable=False)  # 0 or 1
     boot_time = Column(DateTime(timezone=True), nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(DateTime(timezone=True), primary_key=True, default=utcnow, server_default=func.now())
 
     device = relationship("Device", back_populates="heartbeats")
 
+Index("ix_heartbeats_device_id_created_at", Heartbeat.device_id, Heartbeat.created_at.desc())
+
+class DeviceLatestStatus(Base):
+    # Most recent heartbeat of each device, upserted at ingest (app/latest.py)
+    __tablename__ = "device_latest_status"
+
+    device_id = Column(UUID(as_uuid=True), ForeignKey("devices.id"), primary_key=True)
+    heartbeat_id = Column(UUID(as_uuid=True), nullable=False)
+    cpu_usage = Column(Float, nullable=False)
+    ram_usage = Column(Float, nullable=False)
+    disk_free = Column(Float, nullable=False)
+    temperature = Column(Float, nullable=False)
+    dns_latency = Column(Float, nullable=False)
+    connectivity = Column(Integer, nullable=False)
+    boot_time = Column(DateTime(timezone=True), nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+class HeartbeatRollupMixin:
+    # Per-device aggregates of every metric over one fixed-width bucket,
+    # kept up to date at ingest by app/rollups.py
+    @declared_attr
+    def device_id(cls):
+        return Column(UUID(as_uuid=True), ForeignKey("devices.id"), primary_key=True)
+
+    bucket_start = Column(DateTime(timezone=True), primary_key=True)
+    count = Column(Integer, nullable=False)
+    cpu_usage_sum = Column(Float, nullable=False)
+    cpu_usage_min = Column(Float, nullable=False)
+    cpu_usage_max = Column(Float, nullable=False)
+    ram_usage_sum = Column(Float, nullable=False)
+    ram_usage_min = Column(Float, nullable=False)
+    ram_usage_max = Column(Float, nullable=False)
+    disk_free_sum = Column(Float, nullable=False)
+    disk_free_min = Column(Float, nullable=False)
+    disk_free_max = Column(Float, nullable=False)
+    temperature_sum = Column(Float, nullable=False)
+    temperature_min = Column(Float, nullable=False)
+    temperature_max = Column(Float, nullable=False)
+    dns_latency_sum = Column(Float, nullable=False)
+    dns_latency_min = Column(Float, nullable=False)
+    dns_latency_max = Column(Float, nullable=False)
+    connectivity_sum = Column(Float, nullable=False)
+    connectivity_min = Column(Float, nullable=False)
+    connectivity_max = Column(Float, nullable=False)
+
+class HeartbeatRollup1m(HeartbeatRollupMixin, Base):
+    __tablename__ = "heartbeat_rollups_1m"
+
+class HeartbeatRollup1h(HeartbeatRollupMixin, Base):
+    __tablename__ = "heartbeat_rollups_1h"
+
+class HeartbeatRollup1d(HeartbeatRollupMixin, Base):
+    __tablename__ = "heartbeat_rollups_1d"
+
 class Notification(Base):
     __tablename__ = "notifications"
 
@@ -59,9 +134,19 @@ class Notification(Base):
     condition = Column(String, nullable=False)  # >, <, >=, <=, ==
     threshold = Column(Float, nullable=False)
     device_ids = Column(String)  # JSON string of device IDs, empty for all devices
+    # Alert state per (rule, device), see app/alert_state.py
+    for_seconds = Column(Float, nullable=False, default=0.0, server_default="0")
+    for_readings = Column(Integer, nullable=False, default=1, server_default="1")
+    cooldown_seconds = Column(Float, nullable=False, default=0.0, server_default="0")
+    hysteresis = Column(Float, nullable=False, default=0.0, server_default="0")
+    # Rolling-window rules, see app/windows.py; NULL aggregate compares each reading
+    aggregate = Column(String)  # avg, min, max, rate, count
+    window_seconds = Column(Float)
+    window_readings = Column(Integer)
+    window_count = Column(Integer)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    created_at = Column(DateTime(timezone=True), default=utcnow, server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=utcnow)
 
     user = relationship("User", back_populates="notifications")
 
@@ -73,4 +158,8 @@ class NotificationAlert(Base):
     device_id = Column(UUID(as_uuid=True), ForeignKey("devices.id"), nullable=False)
     message = Column(String, nullable=False)
     value = Column(Float, nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
+    created_at = Column(DateTime(timezone=True), default=utcnow, server_default=func.now())
+    resolved_at = Column(DateTime(timezone=True))  # NULL while the alert is firing
+
+# Serves the keyset-paginated alert feed, newest first
+Index("ix_notification_alerts_created_at_id", NotificationAlert.created_at.desc(), NotificationAlert.id.desc())
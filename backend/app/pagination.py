@@ -0,0 +1,89 @@
+from datetime import datetime
+from itertools import islice
+from typing import Iterable, Optional, Tuple
+import base64
+import csv
+import io
+import json
+import uuid
+from fastapi import HTTPException, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import tuple_
+
+# Keyset pagination on (created_at, id): a cursor is the position of the last
+# row of the previous page, so every page is an index range scan no matter
+# how deep it is, and rows inserted meanwhile don't shift pages.
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+STREAM_CHUNK_SIZE = 500
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def encode_cursor(created_at: datetime, id) -> str:
+    raw = json.dumps([created_at.isoformat(), str(id)]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, id = json.loads(raw)
+        return datetime.fromisoformat(created_at), uuid.UUID(id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset(stmt, model, cursor: Optional[str] = None, limit: Optional[int] = None, descending: bool = False):
+    position = tuple_(model.created_at, model.id)
+    if cursor:
+        after = tuple_(*decode_cursor(cursor))
+        stmt = stmt.where(position < after if descending else position > after)
+    if descending:
+        stmt = stmt.order_by(model.created_at.desc(), model.id.desc())
+    else:
+        stmt = stmt.order_by(model.created_at, model.id)
+    if limit is not None:
+        # One extra row tells whether there is a next page
+        stmt = stmt.limit(limit + 1)
+    return stmt
+
+def page(items, limit: Optional[int], response: Response):
+    if limit is None or len(items) <= limit:
+        return items
+    items = items[:limit]
+    response.headers[NEXT_CURSOR_HEADER] = encode_cursor(items[-1].created_at, items[-1].id)
+    return items
+
+def _serialize(rows: Iterable, schema, fmt: str, header: bool) -> str:
+    records = [schema.model_validate(row).model_dump(mode="json") for row in rows]
+    if fmt == "ndjson":
+        return "".join(json.dumps(record) + "\n" for record in records)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(schema.model_fields))
+    if header:
+        writer.writeheader()
+    writer.writerows(records)
+    return buffer.getvalue()
+
+def stream(rows: Iterable, schema, fmt: str) -> StreamingResponse:
+    # `rows` comes from a server-side cursor (yield_per) and is serialized a
+    # chunk at a time, so memory stays constant however large the export is
+    def body():
+        iterator = iter(rows)
+        header = True
+        while True:
+            chunk = list(islice(iterator, STREAM_CHUNK_SIZE))
+            if chunk or header:
+                yield _serialize(chunk, schema, fmt, header)
+            if len(chunk) < STREAM_CHUNK_SIZE:
+                break
+            header = False
+    return StreamingResponse(body(), media_type=STREAM_MEDIA_TYPES[fmt])
+
+def astream(result, schema, fmt: str) -> StreamingResponse:
+    # Same for an AsyncScalarResult from AsyncSession.stream_scalars
+    async def body():
+        header = True
+        async for chunk in result.partitions(STREAM_CHUNK_SIZE):
+            yield _serialize(chunk, schema, fmt, header)
+            header = False
+        if header:
+            yield _serialize([], schema, fmt, header)
+    return StreamingResponse(body(), media_type=STREAM_MEDIA_TYPES[fmt])
@@ -0,0 +1,120 @@
+"""Partition maintenance and retention for the `heartbeats` table.
+
+On PostgreSQL `heartbeats` is range-partitioned by `created_at` into one
+partition per day (`heartbeats_pYYYYMMDD`) plus a default partition. This
+module creates partitions ahead of time and expires old data by dropping
+whole partitions, which is instant and leaves no bloat, instead of running
+row DELETEs. On other databases (SQLite in tests) it does nothing.
+
+Run once from cron with `python -m app.retention`, or let the API run it
+periodically (see `retention_loop`).
+"""
+from datetime import date, datetime, time, timedelta, timezone
+from typing import List, Optional
+import asyncio
+import logging
+import os
+import re
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_RETENTION_DAYS = int(os.getenv("HEARTBEAT_RETENTION_DAYS", "90"))
+HEARTBEAT_PARTITIONS_AHEAD = int(os.getenv("HEARTBEAT_PARTITIONS_AHEAD", "7"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+
+PARTITION_PATTERN = re.compile(r"^heartbeats_p(\d{8})$")
+
+def partition_name(day: date) -> str:
+    return f"heartbeats_p{day:%Y%m%d}"
+
+def _bound(day: date) -> str:
+    return datetime.combine(day, time(0), tzinfo=timezone.utc).isoformat()
+
+def is_partitioned(conn) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt "
+        "JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = 'heartbeats'"
+    )).first() is not None
+
+def list_partitions(conn) -> List[str]:
+    rows = conn.execute(text(
+        "SELECT child.relname FROM pg_inherits i "
+        "JOIN pg_class parent ON parent.oid = i.inhparent "
+        "JOIN pg_class child ON child.oid = i.inhrelid "
+        "WHERE parent.relname = 'heartbeats' ORDER BY child.relname"
+    ))
+    return [row[0] for row in rows]
+
+def ensure_partitions(engine: Engine, today: Optional[date] = None, days_ahead: int = HEARTBEAT_PARTITIONS_AHEAD) -> List[str]:
+    today = today or datetime.now(timezone.utc).date()
+    created = []
+    with engine.connect() as conn:
+        if not is_partitioned(conn):
+            return created
+        existing = set(list_partitions(conn))
+        if "heartbeats_default" not in existing:
+            conn.execute(text("CREATE TABLE heartbeats_default PARTITION OF heartbeats DEFAULT"))
+            conn.commit()
+            created.append("heartbeats_default")
+        for offset in range(days_ahead + 1):
+            day = today + timedelta(days=offset)
+            name = partition_name(day)
+            if name in existing:
+                continue
+            try:
+                conn.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF heartbeats "
+                    f"FOR VALUES FROM ('{_bound(day)}') TO ('{_bound(day + timedelta(days=1))}')"
+                ))
+                conn.commit()
+                created.append(name)
+            except DBAPIError:
+                # Usually rows for that day already landed in the default partition
+                conn.rollback()
+                logger.exception("Could not create partition %s", name)
+    return created
+
+def drop_expired_partitions(engine: Engine, retention_days: int = HEARTBEAT_RETENTION_DAYS, today: Optional[date] = None) -> List[str]:
+    today = today or datetime.now(timezone.utc).date()
+    cutoff = today - timedelta(days=retention_days)
+    dropped = []
+    with engine.connect() as conn:
+        if not is_partitioned(conn):
+            return dropped
+        for name in list_partitions(conn):
+            match = PARTITION_PATTERN.match(name)
+            if not match:
+                continue
+            day = datetime.strptime(match.group(1), "%Y%m%d").date()
+            # A partition holds [day, day + 1); drop it once all of it is expired
+            if day + timedelta(days=1) <= cutoff:
+                conn.execute(text(f"ALTER TABLE heartbeats DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+                conn.commit()
+                dropped.append(name)
+    if dropped:
+        logger.info("Dropped expired heartbeat partitions: %s", ", ".join(dropped))
+    return dropped
+
+def run_retention(engine: Engine):
+    created = ensure_partitions(engine)
+    dropped = drop_expired_partitions(engine)
+    return {"created": created, "dropped": dropped}
+
+async def retention_loop(engine: Engine, interval: float = RETENTION_INTERVAL):
+    while True:
+        try:
+            await asyncio.to_thread(run_retention, engine)
+        except Exception:
+            logger.exception("Heartbeat retention run failed")
+        await asyncio.sleep(interval)
+
+if __name__ == "__main__":
+    from .database import engine
+    logging.basicConfig(level=logging.INFO)
+    print(run_retention(engine))
@@ -0,0 +1,120 @@
+"""Per-device 1-minute, 1-hour and 1-day rollups of heartbeat metrics.
+
+Every ingest path upserts count/sum/min/max for each metric into all three
+tables in the same transaction as the raw rows, so aggregated history can be
+read without scanning `heartbeats`. Rollups for data ingested before they
+existed can be rebuilt with `python -m app.rollups --days 90`.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List
+import argparse
+import logging
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from . import models
+from .rules import METRICS
+
+logger = logging.getLogger(__name__)
+
+# (name, width in seconds, table), finest first
+ROLLUPS = (
+    ("1m", 60, models.HeartbeatRollup1m),
+    ("1h", 3600, models.HeartbeatRollup1h),
+    ("1d", 86400, models.HeartbeatRollup1d),
+)
+
+# Rollup table serving each history bucket: the coarsest one that divides it
+ROLLUP_FOR_BUCKET = {
+    "1m": ROLLUPS[0],
+    "5m": ROLLUPS[0],
+    "1h": ROLLUPS[1],
+    "1d": ROLLUPS[2],
+}
+
+# Keeps multi-row upserts under SQLite's bound parameter limit
+UPSERT_CHUNK_SIZE = 500
+
+def bucket_start(timestamp: datetime, seconds: int) -> datetime:
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    epoch = timestamp.timestamp()
+    return datetime.fromtimestamp(epoch - epoch % seconds, tz=timezone.utc)
+
+def aggregate(heartbeats: Iterable[models.Heartbeat], seconds: int) -> List[dict]:
+    buckets = {}
+    for heartbeat in heartbeats:
+        key = (heartbeat.device_id, bucket_start(heartbeat.created_at, seconds))
+        values = buckets.get(key)
+        if values is None:
+            values = buckets[key] = {"device_id": key[0], "bucket_start": key[1], "count": 0}
+            for metric in METRICS:
+                value = getattr(heartbeat, metric)
+                values[f"{metric}_sum"] = 0.0
+                values[f"{metric}_min"] = value
+                values[f"{metric}_max"] = value
+        values["count"] += 1
+        for metric in METRICS:
+            value = getattr(heartbeat, metric)
+            values[f"{metric}_sum"] += value
+            values[f"{metric}_min"] = min(values[f"{metric}_min"], value)
+            values[f"{metric}_max"] = max(values[f"{metric}_max"], value)
+    # Sorted so concurrent upserts lock rows in the same order
+    return [buckets[key] for key in sorted(buckets, key=lambda k: (str(k[0]), k[1]))]
+
+def upsert(dialect_name: str, model, values: List[dict]):
+    if dialect_name == "postgresql":
+        stmt = postgresql.insert(model).values(values)
+        smallest, largest = func.least, func.greatest
+    else:
+        stmt = sqlite.insert(model).values(values)
+        smallest, largest = func.min, func.max
+    table = model.__table__
+    excluded = stmt.excluded
+    set_ = {"count": table.c.count + excluded.count}
+    for metric in METRICS:
+        set_[f"{metric}_sum"] = table.c[f"{metric}_sum"] + excluded[f"{metric}_sum"]
+        set_[f"{metric}_min"] = smallest(table.c[f"{metric}_min"], excluded[f"{metric}_min"])
+        set_[f"{metric}_max"] = largest(table.c[f"{metric}_max"], excluded[f"{metric}_max"])
+    return stmt.on_conflict_do_update(index_elements=["device_id", "bucket_start"], set_=set_)
+
+def rollup_statements(dialect_name: str, heartbeats: List[models.Heartbeat]):
+    # Upserts folding `heartbeats` into every rollup table; run them in the
+    # same transaction as the raw insert
+    if dialect_name not in ("postgresql", "sqlite"):
+        logger.warning("Heartbeat rollups are not supported on %s", dialect_name)
+        return []
+    statements = []
+    for _, seconds, model in ROLLUPS:
+        values = aggregate(heartbeats, seconds)
+        for i in range(0, len(values), UPSERT_CHUNK_SIZE):
+            statements.append(upsert(dialect_name, model, values[i:i + UPSERT_CHUNK_SIZE]))
+    return statements
+
+def rebuild(engine: Engine, days: int, chunk_size: int = 10000):
+    # Recompute rollups for the last `days` complete days from raw heartbeats.
+    # Today is left alone so live ingest can't be counted twice.
+    end = bucket_start(datetime.now(timezone.utc), 86400)
+    start = end - timedelta(days=days)
+    with Session(engine) as db:
+        for _, _, model in ROLLUPS:
+            db.execute(delete(model).where(model.bucket_start >= start, model.bucket_start < end))
+        query = select(models.Heartbeat).where(
+            models.Heartbeat.created_at >= start,
+            models.Heartbeat.created_at < end
+        ).execution_options(yield_per=chunk_size)
+        rows = 0
+        for heartbeats in db.scalars(query).partitions():
+            for stmt in rollup_statements(engine.dialect.name, heartbeats):
+                db.execute(stmt)
+            rows += len(heartbeats)
+        db.commit()
+    return rows
+
+if __name__ == "__main__":
+    from .database import engine
+    parser = argparse.ArgumentParser(description="Rebuild heartbeat rollups from raw data")
+    parser.add_argument("--days", type=int, default=7, help="complete days to rebuild, ending yesterday")
+    args = parser.parse_args()
+    print(f"Rolled up {rebuild(engine, args.days)} heartbeats")
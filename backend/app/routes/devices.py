@@ -1,16 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from sqlalchemy.orm import Session
-from typing import List
-from .. import schemas, crud, auth, database
+from typing import List, Literal, Optional
+from .. import schemas, crud, auth, database, pagination
 
 router = APIRouter()
 
 @router.get("/", response_model=List[schemas.Device])
 def read_devices(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = Query(None),
+    fmt: Literal["json", "ndjson", "csv"] = Query("json", alias="format"),
     current_user: schemas.User = Depends(auth.get_current_user),
     db: Session = Depends(database.get_db)
 ):
-    return crud.get_devices(db, current_user.id)
+    if fmt != "json":
+        return pagination.stream(crud.stream_devices(db, current_user.id), schemas.Device, fmt)
+    devices = crud.get_devices(db, current_user.id, limit, cursor)
+    return pagination.page(devices, limit, response)
+
+@router.get("/status", response_model=List[schemas.DeviceStatus])
+def read_device_statuses(
+    current_user: schemas.User = Depends(auth.get_current_user),
+    db: Session = Depends(database.get_db)
+):
+    return crud.get_device_statuses(db, current_user.id)
 
 @router.post("/", response_model=schemas.Device)
 def create_device(
@@ -37,6 +51,18 @@ def read_device(
         raise HTTPException(status_code=404, detail="Device not found")
     return db_device
 
+@router.post("/{device_id}/token", response_model=schemas.Token)
+def create_device_token(
+    device_id: str,
+    current_user: schemas.User = Depends(auth.get_current_user),
+    db: Session = Depends(database.get_db)
+):
+    # Long-lived credential for the device's heartbeat channel
+    db_device = crud.get_device(db, device_id, str(current_user.id))
+    if db_device is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    return {"access_token": auth.create_device_token(db_device), "token_type": "bearer"}
+
 @router.put("/{device_id}", response_model=schemas.Device)
 def update_device(
     device_id: str,
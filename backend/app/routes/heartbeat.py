@@ -1,119 +1,168 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, WebSocket, WebSocketDisconnect, status
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Literal, Optional, Union
 from datetime import datetime, timedelta
-import asyncio
 import json
-from .. import schemas, crud, database, models
+import logging
+import uuid
+from .. import schemas, async_crud, auth, columnar, database, ingest, pagination
+from ..alerts import alert_pipeline
 
-router = APIRouter()
-
-# WebSocket manager for real-time notifications
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List = []
-
-    async def connect(self, websocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+logger = logging.getLogger(__name__)
 
-    def disconnect(self, websocket):
-        self.active_connections.remove(websocket)
-
-    async def send_personal_message(self, message: str, websocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                pass
+router = APIRouter()
 
-manager = ConnectionManager()
+def ingest_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Ingest buffer is full, retry shortly",
+        headers={"Retry-After": "1"},
+    )
 
 @router.post("/", response_model=schemas.Heartbeat)
 async def create_heartbeat(
     heartbeat: schemas.HeartbeatCreate,
-    db: Session = Depends(database.get_db)
+    db: AsyncSession = Depends(database.get_async_db)
 ):
-    db_heartbeat = crud.create_heartbeat(db=db, heartbeat=heartbeat)
-    if db_heartbeat is None:
+    device = await async_crud.resolve_device(db, heartbeat.device_sn)
+    if device is None:
         raise HTTPException(status_code=404, detail="Device not found")
+    try:
+        [db_heartbeat] = await ingest.store(db, [heartbeat], {heartbeat.device_sn: device})
+    except ingest.IngestBufferFull:
+        raise ingest_busy()
     
-    # Check notifications
-    await check_notifications(db, db_heartbeat)
+    # Check notifications in the background
+    alert_pipeline.submit(device, db_heartbeat)
     
     return db_heartbeat
 
-@router.get("/{device_id}/history", response_model=List[schemas.Heartbeat])
-def read_heartbeat_history(
-    device_id: str,
+@router.post("/batch", response_model=schemas.HeartbeatBatchResult)
+async def create_heartbeat_batch(
+    batch: schemas.HeartbeatBatchCreate,
+    db: AsyncSession = Depends(database.get_async_db)
+):
+    devices = await async_crud.resolve_devices(db, [h.device_sn for h in batch.heartbeats])
+    try:
+        stored = await ingest.store(db, batch.heartbeats, devices)
+    except ingest.IngestBufferFull:
+        raise ingest_busy()
+
+    results = []
+    for index, (heartbeat, db_heartbeat) in enumerate(zip(batch.heartbeats, stored)):
+        if db_heartbeat is None:
+            results.append(schemas.HeartbeatBatchItem(
+                index=index, device_sn=heartbeat.device_sn, success=False, error="Device not found"
+            ))
+            continue
+        results.append(schemas.HeartbeatBatchItem(
+            index=index, device_sn=heartbeat.device_sn, success=True, id=db_heartbeat.id
+        ))
+        alert_pipeline.submit(devices[heartbeat.device_sn], db_heartbeat)
+
+    accepted = sum(1 for item in results if item.success)
+    return schemas.HeartbeatBatchResult(
+        accepted=accepted, rejected=len(results) - accepted, results=results
+    )
+
+async def ingest_frame(db: AsyncSession, device, sn: str, raw: str) -> schemas.HeartbeatAck:
+    seq = None
+    try:
+        data = json.loads(raw)
+        if isinstance(data, dict):
+            seq = data.get("seq")
+            if "heartbeats" not in data:
+                data = {"seq": data.pop("seq", None), "heartbeats": [data]}
+        frame = schemas.HeartbeatFrame.model_validate(data)
+    except ValueError:
+        return schemas.HeartbeatAck(seq=seq if isinstance(seq, int) else None, accepted=0, error="Invalid frame")
+
+    heartbeats = [schemas.HeartbeatCreate(device_sn=sn, **h.dict()) for h in frame.heartbeats]
+    try:
+        stored = await ingest.store(db, heartbeats, {sn: device})
+    except ingest.IngestBufferFull:
+        return schemas.HeartbeatAck(seq=frame.seq, accepted=0, error="Server busy, retry shortly")
+    except SQLAlchemyError:
+        await db.rollback()
+        logger.exception("Could not store heartbeats from device %s", sn)
+        return schemas.HeartbeatAck(seq=frame.seq, accepted=0, error="Could not store heartbeats")
+    for db_heartbeat in stored:
+        alert_pipeline.submit(device, db_heartbeat)
+    return schemas.HeartbeatAck(seq=frame.seq, accepted=len(stored), ids=[h.id for h in stored])
+
+@router.websocket("/ws")
+async def heartbeat_channel(
+    websocket: WebSocket,
+    token: str = Query(""),
+    db: AsyncSession = Depends(database.get_async_db)
+):
+    # Persistent device channel: authenticated once with a device token, then
+    # every frame goes straight to the same bulk ingest path as POST /batch
+    # and is acknowledged with its seq. The session only holds a pooled
+    # connection while a frame is being written.
+    claims = auth.get_device_claims_from_token(token)
+    device = await async_crud.resolve_device_token(db, *claims) if claims else None
+    if device is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    _, sn = claims
+
+    await websocket.accept()
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            ack = await ingest_frame(db, device, sn, raw)
+            await websocket.send_text(ack.model_dump_json())
+    except WebSocketDisconnect:
+        pass
+    except Exception:
+        logger.exception("Device channel of %s failed", sn)
+        try:
+            await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        except RuntimeError:
+            # The socket is already gone
+            pass
+
+@router.get("/{device_id}/history", response_model=Union[List[schemas.Heartbeat], schemas.HeartbeatSeries])
+async def read_heartbeat_history(
+    device_id: uuid.UUID,
+    response: Response,
     start_date: Optional[datetime] = Query(None),
     end_date: Optional[datetime] = Query(None),
-    db: Session = Depends(database.get_db)
+    bucket: Optional[Literal["1m", "5m", "1h", "1d"]] = Query(None),
+    agg: Literal["avg", "min", "max", "p95"] = Query("avg"),
+    limit: Optional[int] = Query(None, ge=1, le=10000),
+    cursor: Optional[str] = Query(None),
+    fmt: Literal["json", "ndjson", "csv"] = Query("json", alias="format"),
+    accept: Optional[str] = Header(None),
+    db: AsyncSession = Depends(database.get_async_db)
 ):
     if not start_date:
         start_date = datetime.utcnow() - timedelta(days=7)
     if not end_date:
         end_date = datetime.utcnow()
-    
-    return crud.get_heartbeats(db, device_id, start_date, end_date)
+    # Accept: application/vnd.iot.columnar+json or application/msgpack gets
+    # one array per metric with epoch-ms timestamps instead of row objects
+    media_type = columnar.negotiate(accept)
 
-async def check_notifications(db: Session, heartbeat: models.Heartbeat):
-    # Get device info
-    device = db.query(models.Device).filter(models.Device.id == heartbeat.device_id).first()
-    if not device:
-        return
-    
-    # Get active notifications for this user
-    notifications = db.query(models.Notification).filter(
-        models.Notification.user_id == device.user_id,
-        models.Notification.is_active == True
-    ).all()
+    # With a bucket, return one aggregated point per bucket instead of raw rows
+    if bucket:
+        if fmt != "json":
+            raise HTTPException(status_code=400, detail="Streaming formats are only available for raw history")
+        series = await async_crud.get_heartbeat_series(db, device_id, start_date, end_date, bucket, agg)
+        if media_type:
+            return columnar.render(columnar.series_payload(device_id, bucket, agg, series), media_type)
+        return schemas.HeartbeatSeries(device_id=device_id, bucket=bucket, agg=agg, **series)
     
-    for notification in notifications:
-        # Check if this device should be monitored
-        if notification.device_ids:
-            device_ids = json.loads(notification.device_ids)
-            if str(heartbeat.device_id) not in device_ids:
-                continue
-        
-        # Get the metric value
-        metric_value = getattr(heartbeat, notification.metric, None)
-        if metric_value is None:
-            continue
-        
-        # Check condition
-        threshold_met = False
-        if notification.condition == ">":
-            threshold_met = metric_value > notification.threshold
-        elif notification.condition == "<":
-            threshold_met = metric_value < notification.threshold
-        elif notification.condition == ">=":
-            threshold_met = metric_value >= notification.threshold
-        elif notification.condition == "<=":
-            threshold_met = metric_value <= notification.threshold
-        elif notification.condition == "==":
-            threshold_met = metric_value == notification.threshold
-        
-        if threshold_met:
-            # Create alert
-            message = f"Device {device.name} - {notification.metric} is {metric_value} (threshold: {notification.threshold})"
-            alert = crud.create_notification_alert(
-                db, str(notification.id), str(heartbeat.device_id), message, metric_value
-            )
-            
-            # Broadcast to WebSocket connections
-            await manager.broadcast(json.dumps({
-                "type": "notification",
-                "alert": {
-                    "id": str(alert.id),
-                    "message": message,
-                    "device_name": device.name,
-                    "metric": notification.metric,
-                    "value": metric_value,
-                    "threshold": notification.threshold,
-                    "created_at": alert.created_at.isoformat()
-                }
-            }))
\ No newline at end of file
+    if fmt != "json":
+        rows = await async_crud.stream_heartbeats(db, device_id, start_date, end_date)
+        return pagination.astream(rows, schemas.Heartbeat, fmt)
+
+    if media_type:
+        rows = await async_crud.get_heartbeat_columns(db, device_id, start_date, end_date, limit, cursor)
+        rows = pagination.page(rows, limit, response)
+        return columnar.render(columnar.rows_payload(device_id, rows), media_type, response.headers)
+
+    heartbeats = await async_crud.get_heartbeats(db, device_id, start_date, end_date, limit, cursor)
+    return pagination.page(heartbeats, limit, response)
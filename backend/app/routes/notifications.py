@@ -1,18 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, WebSocket, WebSocketDisconnect, status
 from sqlalchemy.orm import Session
-from typing import List
+from starlette.concurrency import run_in_threadpool
+from typing import List, Literal, Optional
 import json
-from .. import schemas, crud, auth, database
-from .heartbeat import manager
+from .. import schemas, crud, auth, database, pagination
+from ..websocket import manager
 
 router = APIRouter()
 
 @router.get("/", response_model=List[schemas.Notification])
 def read_notifications(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = Query(None),
+    fmt: Literal["json", "ndjson", "csv"] = Query("json", alias="format"),
     current_user: schemas.User = Depends(auth.get_current_user),
     db: Session = Depends(database.get_db)
 ):
-    return crud.get_notifications(db, str(current_user.id))
+    if fmt != "json":
+        return pagination.stream(crud.stream_notifications(db, str(current_user.id)), schemas.Notification, fmt)
+    notifications = crud.get_notifications(db, str(current_user.id), limit, cursor)
+    return pagination.page(notifications, limit, response)
 
 @router.post("/", response_model=schemas.Notification)
 def create_notification(
@@ -46,17 +54,38 @@ def delete_notification(
 
 @router.get("/alerts", response_model=List[schemas.NotificationAlert])
 def read_notification_alerts(
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None),
+    fmt: Literal["json", "ndjson", "csv"] = Query("json", alias="format"),
     current_user: schemas.User = Depends(auth.get_current_user),
     db: Session = Depends(database.get_db)
 ):
-    return crud.get_notification_alerts(db, str(current_user.id))
+    if fmt != "json":
+        return pagination.stream(crud.stream_notification_alerts(db, str(current_user.id)), schemas.NotificationAlert, fmt)
+    alerts = crud.get_notification_alerts(db, str(current_user.id), limit, cursor)
+    return pagination.page(alerts, limit, response)
 
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(
+    websocket: WebSocket,
+    token: str = Query(""),
+    db: Session = Depends(database.get_db)
+):
+    # A token or user cache miss queries the database; keep it off the event loop
+    user = await run_in_threadpool(auth.get_user_from_token, db, token)
+    # Don't hold a pooled DB connection for the lifetime of the socket
+    db.close()
+    if user is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    connection = await manager.connect(websocket, user.id)
     try:
         while True:
             data = await websocket.receive_text()
             # Keep connection alive
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
\ No newline at end of file
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        manager.disconnect(connection)
\ No newline at end of file
@@ -0,0 +1,231 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+import json
+import logging
+import operator
+import os
+import threading
+from sqlalchemy.orm import Session
+from . import models
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+RULE_CACHE_SIZE = int(os.getenv("RULE_CACHE_SIZE", "10000"))
+RULE_CACHE_TTL = float(os.getenv("RULE_CACHE_TTL", "60"))
+
+METRICS = ("cpu_usage", "ram_usage", "disk_free", "temperature", "dns_latency", "connectivity")
+
+# Windowed rules compare a rolling aggregate of the metric instead of the
+# reading itself (see app/windows.py): avg/min/max over the last
+# window_seconds, rate of change per hour over the last window_seconds, or
+# count, which fires when at least window_count of the last window_readings
+# readings satisfied the condition
+AGGREGATES = ("avg", "min", "max", "rate", "count")
+
+# Condition of rules that fire on a reading's anomaly score (see
+# app/anomaly.py); their threshold is the absolute z-score
+ANOMALY = "anomaly"
+
+# for_seconds/for_readings: how long the condition must hold before the rule
+# fires; cooldown: minimum seconds between two firings on one device;
+# hysteresis: how far back past the threshold a firing rule's metric must go
+# before it resolves (in readings for count rules)
+Rule = namedtuple(
+    "Rule",
+    [
+        "id", "name", "metric", "condition", "threshold", "for_seconds", "for_readings", "cooldown", "hysteresis",
+        "aggregate", "window_seconds", "window_readings", "window_count",
+    ],
+    defaults=(0.0, 1, 0.0, 0.0, None, None, None, None)
+)
+
+# Given the thresholds of one (metric, condition) group sorted ascending, each
+# matcher returns the slice of rules that fire for `value`, so the cost is a
+# binary search plus the number of rules that actually match.
+_MATCHERS = {
+    ">": lambda thresholds, value: slice(0, bisect_left(thresholds, value)),
+    ">=": lambda thresholds, value: slice(0, bisect_right(thresholds, value)),
+    "<": lambda thresholds, value: slice(bisect_right(thresholds, value), None),
+    "<=": lambda thresholds, value: slice(bisect_left(thresholds, value), None),
+    "==": lambda thresholds, value: slice(bisect_left(thresholds, value), bisect_right(thresholds, value)),
+}
+
+_OPERATORS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le, "==": operator.eq}
+
+def satisfies(rule: Rule, value) -> bool:
+    return _OPERATORS[rule.condition](value, rule.threshold)
+
+def still_holds(rule: Rule, value) -> bool:
+    """Whether a firing rule stays firing at `value`: its condition checked
+    against the threshold moved `hysteresis` towards the clearing side."""
+    if rule.condition == "==":
+        return abs(value - rule.threshold) <= rule.hysteresis
+    if rule.condition in (">", ">="):
+        return _OPERATORS[rule.condition](value, rule.threshold - rule.hysteresis)
+    return _OPERATORS[rule.condition](value, rule.threshold + rule.hysteresis)
+
+def is_derived(rule: Rule) -> bool:
+    """Whether the rule compares something derived from the readings (a
+    window or an anomaly score) rather than the reading itself."""
+    return bool(rule.aggregate) or rule.condition == ANOMALY
+
+def describe(rule: Rule) -> str:
+    """What a rule compares, as shown in alert messages."""
+    if rule.aggregate == "count":
+        return f"readings with {rule.metric} {rule.condition} {rule.threshold:g} among the last {rule.window_readings}"
+    if rule.aggregate == "rate":
+        return f"{rule.metric} change per hour over {rule.window_seconds:g}s"
+    if rule.aggregate:
+        return f"{rule.aggregate} {rule.metric} over {rule.window_seconds:g}s"
+    return rule.metric
+
+class ThresholdIndex:
+    """All rules sharing a metric and a condition, sorted by threshold."""
+
+    def __init__(self, condition: str, rules):
+        self.rules = sorted(rules, key=lambda rule: rule.threshold)
+        self.thresholds = [rule.threshold for rule in self.rules]
+        self._matcher = _MATCHERS[condition]
+
+    def match(self, value):
+        return self.rules[self._matcher(self.thresholds, value)]
+
+class RuleSet:
+    """A user's active rules indexed by device and metric.
+
+    Rules without a device filter live under the `None` device key.
+    """
+
+    def __init__(self, index, rules=None, windowed=None, anomaly=None):
+        self.index = index
+        self.rules = rules or {}
+        # Windowed and anomaly rules by device key, evaluated by
+        # app/windows.py and app/anomaly.py
+        self.windowed = windowed or {}
+        self.anomaly = anomaly or {}
+
+    def windowed_for(self, device_id):
+        if not self.windowed:
+            return []
+        return self.windowed.get(None, []) + self.windowed.get(str(device_id), [])
+
+    def anomaly_for(self, device_id):
+        if not self.anomaly:
+            return []
+        return self.anomaly.get(None, []) + self.anomaly.get(str(device_id), [])
+
+    def match(self, device_id, values):
+        matches = []
+        for device_key in (None, str(device_id)):
+            for metric, indexes in self.index.get(device_key, {}).items():
+                value = values.get(metric)
+                if value is None:
+                    continue
+                for threshold_index in indexes:
+                    for rule in threshold_index.match(value):
+                        matches.append((rule, value))
+        return matches
+
+def _rule_devices(notification: models.Notification):
+    if not notification.device_ids:
+        return [None]
+    try:
+        return [str(device_id) for device_id in json.loads(notification.device_ids)]
+    except (TypeError, ValueError):
+        logger.warning("Ignoring notification %s with invalid device_ids", notification.id)
+        return []
+
+def _valid_window(notification: models.Notification) -> bool:
+    if notification.aggregate not in AGGREGATES:
+        return False
+    if notification.aggregate == "count":
+        readings = notification.window_readings or 0
+        return readings >= 1 and 1 <= (notification.window_count or 0) <= readings
+    return (notification.window_seconds or 0) > 0
+
+def compile_rules(notifications) -> RuleSet:
+    groups = defaultdict(list)
+    windowed = defaultdict(list)
+    anomaly = defaultdict(list)
+    by_id = {}
+    for notification in notifications:
+        if notification.condition not in _MATCHERS and notification.condition != ANOMALY:
+            continue
+        if notification.metric not in METRICS:
+            continue
+        if notification.aggregate and (notification.condition == ANOMALY or not _valid_window(notification)):
+            logger.warning("Ignoring notification %s with an invalid window", notification.id)
+            continue
+        rule = Rule(
+            notification.id,
+            notification.name,
+            notification.metric,
+            notification.condition,
+            notification.threshold,
+            notification.for_seconds or 0.0,
+            notification.for_readings or 1,
+            notification.cooldown_seconds or 0.0,
+            notification.hysteresis or 0.0,
+            notification.aggregate or None,
+            notification.window_seconds,
+            notification.window_readings,
+            notification.window_count,
+        )
+        by_id[rule.id] = rule
+        for device_key in _rule_devices(notification):
+            if rule.condition == ANOMALY:
+                anomaly[device_key].append(rule)
+            elif rule.aggregate:
+                windowed[device_key].append(rule)
+            else:
+                groups[(device_key, rule.metric, rule.condition)].append(rule)
+
+    index = defaultdict(lambda: defaultdict(list))
+    for (device_key, metric, condition), rules in groups.items():
+        index[device_key][metric].append(ThresholdIndex(condition, rules))
+    return RuleSet({key: dict(metrics) for key, metrics in index.items()}, by_id, dict(windowed), dict(anomaly))
+
+class RuleEngine:
+    """Compiled rule sets per user, rebuilt only when the user's rules change.
+
+    The TTL bounds staleness when another process changed the rules.
+    """
+
+    def __init__(self, maxsize: int = RULE_CACHE_SIZE, ttl: float = RULE_CACHE_TTL):
+        self._cache = TTLCache(maxsize, ttl)
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def rules_for_user(self, db: Session, user_id) -> RuleSet:
+        key = str(user_id)
+        ruleset = self._cache.get(key)
+        if ruleset is None:
+            with self._lock:
+                generation = self._generations[key]
+            notifications = db.query(models.Notification).filter(
+                models.Notification.user_id == user_id,
+                models.Notification.is_active == True
+            ).all()
+            ruleset = compile_rules(notifications)
+            with self._lock:
+                # Don't cache a rule set that was invalidated while loading
+                if self._generations[key] == generation:
+                    self._cache.set(key, ruleset)
+        return ruleset
+
+    def invalidate(self, user_id):
+        key = str(user_id)
+        with self._lock:
+            self._generations[key] += 1
+            self._cache.invalidate(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def evaluate(self, db: Session, user_id, heartbeat):
+        ruleset = self.rules_for_user(db, user_id)
+        values = {metric: getattr(heartbeat, metric, None) for metric in METRICS}
+        return ruleset.match(heartbeat.device_id, values)
+
+rule_engine = RuleEngine()
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr, Field
-from typing import Optional, List
+from pydantic import BaseModel, EmailStr, Field, model_validator
+from typing import Literal, Optional, List
 from datetime import datetime
 import uuid
 
@@ -67,6 +67,54 @@ class Heartbeat(HeartbeatBase):
     class Config:
         from_attributes = True
 
+class DeviceStatus(HeartbeatBase):
+    device_id: uuid.UUID
+    heartbeat_id: uuid.UUID
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class HeartbeatSeries(BaseModel):
+    # Downsampled history: one array per metric, aligned with `timestamps`
+    device_id: uuid.UUID
+    bucket: str
+    agg: str
+    timestamps: List[datetime]
+    count: List[int]
+    cpu_usage: List[Optional[float]]
+    ram_usage: List[Optional[float]]
+    disk_free: List[Optional[float]]
+    temperature: List[Optional[float]]
+    dns_latency: List[Optional[float]]
+    connectivity: List[Optional[float]]
+
+class HeartbeatBatchCreate(BaseModel):
+    heartbeats: List[HeartbeatCreate] = Field(..., min_length=1, max_length=5000)
+
+class HeartbeatBatchItem(BaseModel):
+    index: int
+    device_sn: str
+    success: bool
+    id: Optional[uuid.UUID] = None
+    error: Optional[str] = None
+
+class HeartbeatBatchResult(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[HeartbeatBatchItem]
+
+# Frames on the device WebSocket: one reading, or several under "heartbeats"
+class HeartbeatFrame(BaseModel):
+    seq: Optional[int] = None
+    heartbeats: List[HeartbeatBase] = Field(..., min_length=1, max_length=5000)
+
+class HeartbeatAck(BaseModel):
+    seq: Optional[int] = None
+    accepted: int
+    ids: List[uuid.UUID] = []
+    error: Optional[str] = None
+
 # Notification schemas
 class NotificationBase(BaseModel):
     name: str
@@ -74,10 +122,27 @@ class NotificationBase(BaseModel):
     condition: str
     threshold: float
     device_ids: Optional[str] = None
+    for_seconds: float = Field(0.0, ge=0)
+    for_readings: int = Field(1, ge=1)
+    cooldown_seconds: float = Field(0.0, ge=0)
+    hysteresis: float = Field(0.0, ge=0)
+    aggregate: Optional[Literal["avg", "min", "max", "rate", "count"]] = None
+    window_seconds: Optional[float] = Field(None, gt=0)
+    window_readings: Optional[int] = Field(None, ge=1)
+    window_count: Optional[int] = Field(None, ge=1)
     is_active: bool = True
 
 class NotificationCreate(NotificationBase):
-    pass
+    @model_validator(mode="after")
+    def check_window(self):
+        if self.condition == "anomaly" and self.aggregate is not None:
+            raise ValueError("anomaly rules score single readings and take no aggregate")
+        if self.aggregate == "count":
+            if self.window_readings is None or self.window_count is None or self.window_count > self.window_readings:
+                raise ValueError("count rules need window_readings and a window_count no larger than it")
+        elif self.aggregate is not None and self.window_seconds is None:
+            raise ValueError(f"{self.aggregate} rules need window_seconds")
+        return self
 
 class NotificationUpdate(BaseModel):
     name: Optional[str] = None
@@ -85,6 +150,14 @@ class NotificationUpdate(BaseModel):
     condition: Optional[str] = None
     threshold: Optional[float] = None
     device_ids: Optional[str] = None
+    for_seconds: Optional[float] = Field(None, ge=0)
+    for_readings: Optional[int] = Field(None, ge=1)
+    cooldown_seconds: Optional[float] = Field(None, ge=0)
+    hysteresis: Optional[float] = Field(None, ge=0)
+    aggregate: Optional[Literal["avg", "min", "max", "rate", "count"]] = None
+    window_seconds: Optional[float] = Field(None, gt=0)
+    window_readings: Optional[int] = Field(None, ge=1)
+    window_count: Optional[int] = Field(None, ge=1)
     is_active: Optional[bool] = None
 
 class Notification(NotificationBase):
@@ -102,6 +175,7 @@ class NotificationAlert(BaseModel):
     message: str
     value: float
     created_at: datetime
+    resolved_at: Optional[datetime] = None
     
     class Config:
         from_attributes = True
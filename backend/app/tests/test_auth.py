@@ -1,9 +1,15 @@
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from app.main import app
-from app.database import get_db, Base
+from app.database import get_db, get_async_db, Base
+from app import models
+from app.hashing import HasherBusy, PasswordHasher
 import tempfile
 import os
 
@@ -11,6 +17,9 @@ import os
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Each TestClient runs its own event loop, so don't pool async connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 
 def override_get_db():
     try:
@@ -19,7 +28,12 @@ def override_get_db():
     finally:
         db.close()
 
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 @pytest.fixture
 def client():
@@ -49,4 +63,50 @@ def test_login_user(client):
         json={"email": "test@example.com", "password": "testpassword"}
     )
     assert response.status_code == 200
-    assert "access_token" in response.json()
\ No newline at end of file
+    assert "access_token" in response.json()
+
+def test_authenticated_requests_hit_cache(client):
+    client.post(
+        "/api/auth/register",
+        json={"name": "Test User", "email": "test@example.com", "password": "testpassword"}
+    )
+    token = client.post(
+        "/api/auth/login",
+        json={"email": "test@example.com", "password": "testpassword"}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/api/auth/me", headers=headers).status_code == 200
+
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(Engine, "before_cursor_execute", count)
+    try:
+        response = client.get("/api/auth/me", headers=headers)
+    finally:
+        event.remove(Engine, "before_cursor_execute", count)
+    assert response.json()["name"] == "Test User"
+    assert statements == []
+
+    # Changing the user drops the cached copy
+    db = TestingSessionLocal()
+    db.query(models.User).one().name = "Renamed"
+    db.commit()
+    db.close()
+    assert client.get("/api/auth/me", headers=headers).json()["name"] == "Renamed"
+
+def test_invalid_token_rejected(client):
+    response = client.get("/api/auth/me", headers={"Authorization": "Bearer not-a-token"})
+    assert response.status_code == 401
+
+def test_password_hasher_rejects_when_queue_full():
+    hasher = PasswordHasher(workers=1, queue_size=1)
+
+    async def burst():
+        return await asyncio.gather(*(hasher.hash("secret") for _ in range(4)), return_exceptions=True)
+
+    results = asyncio.run(burst())
+    hasher.shutdown()
+    assert sum(isinstance(r, HasherBusy) for r in results) == 2
+    assert sum(isinstance(r, str) for r in results) == 2
+    assert hasher.stats()["rejected"] == 2
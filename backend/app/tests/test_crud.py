@@ -0,0 +1,116 @@
+import asyncio
+import uuid
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from app.database import Base
+from app import async_crud, cache, crud, models, schemas
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+# Same options as app.database.SessionLocal
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+# Same options as app.database.AsyncSessionLocal
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    yield session
+    session.close()
+    Base.metadata.drop_all(bind=engine)
+
+@pytest.fixture
+def statements():
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement.split()[0].upper())
+    for target in (engine, async_engine.sync_engine):
+        event.listen(target, "before_cursor_execute", record)
+    yield executed
+    for target in (engine, async_engine.sync_engine):
+        event.remove(target, "before_cursor_execute", record)
+
+def written(statements, write, schema):
+    # The write, then serializing its result as the route would
+    statements.clear()
+    result = write()
+    schema.model_validate(result)
+    return list(statements)
+
+def create_user(email):
+    async def create():
+        async with AsyncSessionLocal() as session:
+            return await async_crud.create_user(session, schemas.UserCreate(email=email, name="Crud", password="secret"))
+    return asyncio.run(create())
+
+def test_writes_take_one_statement_each(db, statements):
+    # The writes the routes and the alert pipeline serve, each followed by
+    # serializing its result
+    user = None
+    def register():
+        nonlocal user
+        user = create_user("crud@example.com")
+        return user
+    assert written(statements, register, schemas.User) == ["INSERT"]
+
+    device = None
+    def create_device():
+        nonlocal device
+        device = crud.create_device(db, schemas.DeviceCreate(name="D", location="L", sn="CRUD00000001"), str(user.id))
+        return device
+    assert written(statements, create_device, schemas.Device) == ["INSERT"]
+    assert written(statements, lambda: crud.update_device(
+        db, str(device.id), schemas.DeviceUpdate(name="Renamed"), str(user.id)
+    ), schemas.Device) == ["UPDATE"]
+    assert device.name == "Renamed" and device.updated_at is not None
+
+    notification = None
+    def create_notification():
+        nonlocal notification
+        notification = crud.create_notification(db, schemas.NotificationCreate(
+            name="Hot", metric="temperature", condition=">", threshold=80
+        ), str(user.id))
+        return notification
+    assert written(statements, create_notification, schemas.Notification) == ["INSERT"]
+    assert written(statements, lambda: crud.update_notification(
+        db, str(notification.id), schemas.NotificationUpdate(threshold=90), str(user.id)
+    ), schemas.Notification) == ["UPDATE"]
+    assert notification.threshold == 90
+
+    heartbeat = schemas.HeartbeatCreate(
+        device_sn=device.sn, cpu_usage=1, ram_usage=2, disk_free=3, temperature=4,
+        dns_latency=5, connectivity=1, boot_time="2025-01-01T00:00:00Z"
+    )
+    rows, results = async_crud.heartbeat_rows([heartbeat] * 3, {device.sn: cache.CachedDevice(device.id, device.user_id, device.name)})
+    async def insert_rows():
+        async with AsyncSessionLocal() as session:
+            await async_crud.insert_heartbeat_rows(session, rows)
+        return results[0]
+    executed = written(statements, lambda: asyncio.run(insert_rows()), schemas.Heartbeat)
+    # One multi-row INSERT into heartbeats plus the rollup and latest-status upserts
+    derived = crud.derived_statements("sqlite", [models.Heartbeat(**row) for row in rows])
+    assert executed == ["INSERT"] * (1 + len(derived))
+
+    def alert():
+        return models.NotificationAlert(
+            id=uuid.uuid4(), notification_id=notification.id, device_id=device.id,
+            message="Too hot", value=95.0, created_at=models.utcnow()
+        )
+    fired = [alert(), alert()]
+    assert written(statements, lambda: crud.save_alert_transitions(db, fired, [], None)[0], schemas.NotificationAlert) == ["INSERT"]
+    # Firings and resolutions of one batch: one UPDATE, then the INSERT at commit
+    assert written(statements, lambda: crud.save_alert_transitions(
+        db, [alert()], [resolved.id for resolved in fired], models.utcnow()
+    )[0], schemas.NotificationAlert) == ["UPDATE", "INSERT"]
+
+def test_update_of_someone_elses_row_returns_none(db):
+    owner = create_user("owner@example.com")
+    device = crud.create_device(db, schemas.DeviceCreate(name="D", location="L", sn="CRUD00000002"), str(owner.id))
+    assert crud.update_device(db, str(device.id), schemas.DeviceUpdate(name="Stolen"), str(uuid.uuid4())) is None
+    assert crud.get_device(db, str(device.id), str(owner.id)).name == "D"
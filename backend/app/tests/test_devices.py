@@ -1,13 +1,18 @@
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from app.main import app
-from app.database import get_db, Base
+from app.database import get_db, get_async_db, Base
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Each TestClient runs its own event loop, so don't pool async connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 
 def override_get_db():
     try:
@@ -16,7 +21,12 @@ def override_get_db():
     finally:
         db.close()
 
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 @pytest.fixture
 def client():
@@ -70,4 +80,20 @@ def test_get_devices(client, auth_headers):
     
     response = client.get("/api/devices/", headers=auth_headers)
     assert response.status_code == 200
-    assert len(response.json()) == 1
\ No newline at end of file
+    assert len(response.json()) == 1
+
+def test_get_devices_paginated(client, auth_headers):
+    for i in range(5):
+        client.post(
+            "/api/devices/",
+            json={"name": f"Device {i}", "location": "Test Location", "sn": f"TEST0000000{i}"},
+            headers=auth_headers
+        )
+
+    first = client.get("/api/devices/", params={"limit": 3}, headers=auth_headers)
+    assert [d["name"] for d in first.json()] == ["Device 0", "Device 1", "Device 2"]
+    cursor = first.headers["X-Next-Cursor"]
+
+    second = client.get("/api/devices/", params={"limit": 3, "cursor": cursor}, headers=auth_headers)
+    assert [d["name"] for d in second.json()] == ["Device 3", "Device 4"]
+    assert "X-Next-Cursor" not in second.headers
@@ -0,0 +1,460 @@
+import json
+import statistics
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import msgpack
+import pytest
+from starlette.websockets import WebSocketDisconnect
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, func
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from app.main import app
+from app.database import get_db, get_async_db, Base
+from app.cache import device_cache
+from app.alerts import alert_pipeline
+from app.hashing import password_hasher
+from app.ingest import IngestBuffer
+from app import ingest, models, rollups
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Each TestClient runs its own event loop, so don't pool async connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
+alert_pipeline.session_factory = TestingSessionLocal
+
+@pytest.fixture
+def client():
+    Base.metadata.create_all(bind=engine)
+    with TestClient(app) as c:
+        yield c
+    Base.metadata.drop_all(bind=engine)
+
+@pytest.fixture
+def device(client):
+    client.post(
+        "/api/auth/register",
+        json={"name": "Test User", "email": "test@example.com", "password": "testpassword"}
+    )
+    response = client.post(
+        "/api/auth/login",
+        json={"email": "test@example.com", "password": "testpassword"}
+    )
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = client.post(
+        "/api/devices/",
+        json={"name": "Test Device", "location": "Test Location", "sn": "TEST12345678"},
+        headers=headers
+    )
+    return dict(response.json(), headers=headers)
+
+def make_heartbeat(sn, cpu_usage=50.0):
+    return {
+        "device_sn": sn,
+        "cpu_usage": cpu_usage,
+        "ram_usage": 40.0,
+        "disk_free": 70.0,
+        "temperature": 45.0,
+        "dns_latency": 9.5,
+        "connectivity": 1,
+        "boot_time": "2025-09-01T00:00:00+00:00"
+    }
+
+def test_create_heartbeat(client, device):
+    response = client.post("/api/heartbeat/", json=make_heartbeat(device["sn"]))
+    assert response.status_code == 200
+    assert response.json()["device_id"] == device["id"]
+
+def test_create_heartbeat_unknown_device(client, device):
+    response = client.post("/api/heartbeat/", json=make_heartbeat("UNKNOWN00000"))
+    assert response.status_code == 404
+
+def test_create_heartbeat_batch(client, device):
+    heartbeats = [make_heartbeat(device["sn"], cpu_usage=i) for i in range(50)]
+    heartbeats.insert(10, make_heartbeat("UNKNOWN00000"))
+
+    response = client.post("/api/heartbeat/batch", json={"heartbeats": heartbeats})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["accepted"] == 50
+    assert body["rejected"] == 1
+    assert body["results"][10] == {
+        "index": 10,
+        "device_sn": "UNKNOWN00000",
+        "success": False,
+        "id": None,
+        "error": "Device not found"
+    }
+    assert all(item["success"] for i, item in enumerate(body["results"]) if i != 10)
+
+    history = client.get(f"/api/heartbeat/{device['id']}/history")
+    assert len(history.json()) == 50
+
+def test_device_cache_hit_and_invalidation(client, device):
+    hits = device_cache.stats()["hits"]
+    client.post("/api/heartbeat/", json=make_heartbeat(device["sn"]))
+    client.post("/api/heartbeat/", json=make_heartbeat(device["sn"]))
+    assert device_cache.stats()["hits"] >= hits + 1
+
+    client.put(f"/api/devices/{device['id']}", json={"name": "Renamed"}, headers=device["headers"])
+    assert device_cache.get(device["sn"]) is None
+
+def test_history_downsampled(client, device):
+    for cpu_usage in (10.0, 20.0, 30.0, 40.0):
+        client.post("/api/heartbeat/", json=make_heartbeat(device["sn"], cpu_usage=cpu_usage))
+
+    response = client.get(f"/api/heartbeat/{device['id']}/history", params={"bucket": "1d"})
+    assert response.status_code == 200
+    series = response.json()
+    assert series["bucket"] == "1d"
+    assert series["count"] == [4]
+    assert series["cpu_usage"] == [25.0]
+    assert series["ram_usage"] == [40.0]
+    assert len(series["timestamps"]) == 1
+
+    series = client.get(
+        f"/api/heartbeat/{device['id']}/history", params={"bucket": "1d", "agg": "p95"}
+    ).json()
+    assert series["cpu_usage"][0] == pytest.approx(38.5)
+
+    response = client.get(f"/api/heartbeat/{device['id']}/history", params={"bucket": "2m"})
+    assert response.status_code == 422
+
+def test_history_edge_buckets_cover_their_width(client, device):
+    client.post("/api/heartbeat/", json=make_heartbeat(device["sn"], cpu_usage=10.0))
+    created_at = datetime.fromisoformat(client.get(f"/api/heartbeat/{device['id']}/history").json()[0]["created_at"])
+    # A range ending in the last second of the reading's 5m bucket still
+    # gets all of that bucket, not only its last minute
+    edge = rollups.bucket_start(created_at, 300) + timedelta(seconds=299)
+    series = client.get(
+        f"/api/heartbeat/{device['id']}/history",
+        params={"bucket": "5m", "start_date": edge.isoformat(), "end_date": edge.isoformat()}
+    ).json()
+    assert series["count"] == [1]
+    assert series["cpu_usage"] == [10.0]
+
+def test_rollups_updated_at_ingest(client, device):
+    heartbeats = [make_heartbeat(device["sn"], cpu_usage=cpu) for cpu in (10.0, 50.0, 90.0)]
+    client.post("/api/heartbeat/batch", json={"heartbeats": heartbeats})
+    client.post("/api/heartbeat/", json=make_heartbeat(device["sn"], cpu_usage=30.0))
+
+    db = TestingSessionLocal()
+    try:
+        for model in (models.HeartbeatRollup1m, models.HeartbeatRollup1h, models.HeartbeatRollup1d):
+            total = db.query(func.sum(model.count), func.sum(model.cpu_usage_sum)).one()
+            assert total == (4, 180.0)
+            assert db.query(func.min(model.cpu_usage_min)).scalar() == 10.0
+            assert db.query(func.max(model.cpu_usage_max)).scalar() == 90.0
+    finally:
+        db.close()
+
+def test_fleet_status_returns_latest_per_device(client, device):
+    client.post(
+        "/api/devices/",
+        json={"name": "Quiet Device", "location": "Test Location", "sn": "QUIET1234567"},
+        headers=device["headers"]
+    )
+    client.post("/api/heartbeat/", json=make_heartbeat("QUIET1234567", cpu_usage=5.0))
+    heartbeats = [make_heartbeat(device["sn"], cpu_usage=cpu) for cpu in (10.0, 20.0, 30.0)]
+    client.post("/api/heartbeat/batch", json={"heartbeats": heartbeats})
+    client.post("/api/heartbeat/", json=make_heartbeat(device["sn"], cpu_usage=70.0))
+
+    response = client.get("/api/devices/status", headers=device["headers"])
+    assert response.status_code == 200
+    statuses = {status["device_id"]: status for status in response.json()}
+    assert len(statuses) == 2
+    assert statuses[device["id"]]["cpu_usage"] == 70.0
+    assert 5.0 in [status["cpu_usage"] for status in statuses.values()]
+
+def test_history_keyset_pagination(client, device):
+    # A batch shares one created_at, so pages are split on the id tie-breaker
+    heartbeats = [make_heartbeat(device["sn"], cpu_usage=i) for i in range(25)]
+    client.post("/api/heartbeat/batch", json={"heartbeats": heartbeats})
+
+    seen = []
+    params = {"limit": 10}
+    while True:
+        response = client.get(f"/api/heartbeat/{device['id']}/history", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page) <= 10
+        seen.extend(item["id"] for item in page)
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+        params["cursor"] = cursor
+    assert len(seen) == 25
+    assert len(set(seen)) == 25
+
+    response = client.get(f"/api/heartbeat/{device['id']}/history", params={"cursor": "garbage"})
+    assert response.status_code == 400
+
+def test_history_streaming_formats(client, device):
+    heartbeats = [make_heartbeat(device["sn"], cpu_usage=i) for i in range(3)]
+    client.post("/api/heartbeat/batch", json={"heartbeats": heartbeats})
+
+    response = client.get(f"/api/heartbeat/{device['id']}/history", params={"format": "ndjson"})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(row["cpu_usage"] for row in rows) == [0.0, 1.0, 2.0]
+
+    response = client.get(f"/api/heartbeat/{device['id']}/history", params={"format": "csv"})
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.splitlines()
+    assert "cpu_usage" in lines[0].split(",")
+    assert len(lines) == 4
+
+def test_history_columnar_formats(client, device):
+    for cpu_usage in (10.0, 20.0, 30.0):
+        client.post("/api/heartbeat/", json=make_heartbeat(device["sn"], cpu_usage=cpu_usage))
+    url = f"/api/heartbeat/{device['id']}/history"
+
+    response = client.get(url, headers={"Accept": "application/vnd.iot.columnar+json"})
+    assert response.headers["content-type"] == "application/vnd.iot.columnar+json"
+    payload = response.json()
+    assert sorted(payload["cpu_usage"]) == [10.0, 20.0, 30.0]
+    assert len(payload["timestamps"]) == 3
+    assert all(isinstance(t, int) for t in payload["timestamps"])
+
+    response = client.get(url, params={"bucket": "1d"}, headers={"Accept": "application/msgpack"})
+    assert response.headers["content-type"] == "application/msgpack"
+    payload = msgpack.unpackb(response.content)
+    assert payload["bucket"] == "1d"
+    assert payload["count"] == [3]
+    assert payload["cpu_usage"] == [20.0]
+
+    # Plain JSON still wins when preferred
+    response = client.get(url, headers={"Accept": "application/json, application/msgpack;q=0.5"})
+    assert isinstance(response.json(), list)
+
+def test_ingest_latency_flat_during_login_burst(client, device):
+    def ingest_latency():
+        start = time.perf_counter()
+        assert client.post("/api/heartbeat/", json=make_heartbeat(device["sn"])).status_code == 200
+        return time.perf_counter() - start
+
+    baseline = statistics.median(ingest_latency() for _ in range(10))
+    credentials = {"email": "test@example.com", "password": "testpassword"}
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        logins = [pool.submit(client.post, "/api/auth/login", json=credentials) for _ in range(8)]
+        during = []
+        while not all(login.done() for login in logins) or len(during) < 5:
+            during.append(ingest_latency())
+        statuses = [login.result().status_code for login in logins]
+
+    assert set(statuses) <= {200, 503}
+    assert password_hasher.stats()["max_pending"] >= 2
+    # A bcrypt call on the event loop would stall ingest for ~100ms or more
+    assert statistics.median(during) < max(baseline * 5, 0.05)
+
+def test_device_channel_ingests_frames(client, device):
+    token = client.post(f"/api/devices/{device['id']}/token", headers=device["headers"]).json()["access_token"]
+    reading = {k: v for k, v in make_heartbeat(device["sn"]).items() if k != "device_sn"}
+
+    with client.websocket_connect(f"/api/heartbeat/ws?token={token}") as websocket:
+        websocket.send_json(dict(reading, seq=1))
+        ack = websocket.receive_json()
+        assert ack["seq"] == 1 and ack["accepted"] == 1 and len(ack["ids"]) == 1
+
+        websocket.send_json({"seq": 2, "heartbeats": [reading] * 3})
+        assert websocket.receive_json()["accepted"] == 3
+
+        websocket.send_json({"seq": 3, "cpu_usage": 500})
+        ack = websocket.receive_json()
+        assert ack["seq"] == 3 and ack["accepted"] == 0 and ack["error"] == "Invalid frame"
+
+    history = client.get(f"/api/heartbeat/{device['id']}/history")
+    assert len(history.json()) == 4
+
+def test_device_channel_requires_device_token(client, device):
+    user_token = device["headers"]["Authorization"].split()[1]
+    for token in ("invalid", user_token):
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect(f"/api/heartbeat/ws?token={token}") as websocket:
+                websocket.receive_text()
+
+    # ...and a device token is no good as a user token
+    token = client.post(f"/api/devices/{device['id']}/token", headers=device["headers"]).json()["access_token"]
+    response = client.get("/api/devices/", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+
+def test_device_channel_closes_on_server_error(client, device, monkeypatch):
+    token = client.post(f"/api/devices/{device['id']}/token", headers=device["headers"]).json()["access_token"]
+    async def broken_store(*args):
+        raise RuntimeError("buffer is broken")
+    monkeypatch.setattr(ingest, "store", broken_store)
+    reading = {k: v for k, v in make_heartbeat(device["sn"]).items() if k != "device_sn"}
+
+    with client.websocket_connect(f"/api/heartbeat/ws?token={token}") as websocket:
+        websocket.send_json(dict(reading, seq=1))
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_json()
+    assert closed.value.code == 1011
+
+def test_device_token_dies_with_its_device(client, device):
+    old_token = client.post(f"/api/devices/{device['id']}/token", headers=device["headers"]).json()["access_token"]
+    client.delete(f"/api/devices/{device['id']}", headers=device["headers"])
+
+    # Someone else registers the same SN
+    client.post("/api/auth/register", json={"name": "Other", "email": "other@example.com", "password": "otherpassword"})
+    response = client.post("/api/auth/login", json={"email": "other@example.com", "password": "otherpassword"})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    new_device = client.post(
+        "/api/devices/", json={"name": "Other Device", "location": "Elsewhere", "sn": device["sn"]}, headers=headers
+    ).json()
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(f"/api/heartbeat/ws?token={old_token}") as websocket:
+            websocket.receive_text()
+
+    new_token = client.post(f"/api/devices/{new_device['id']}/token", headers=headers).json()["access_token"]
+    reading = {k: v for k, v in make_heartbeat(device["sn"]).items() if k != "device_sn"}
+    with client.websocket_connect(f"/api/heartbeat/ws?token={new_token}") as websocket:
+        websocket.send_json(dict(reading, seq=1))
+        assert websocket.receive_json()["accepted"] == 1
+
+@pytest.fixture
+def wal_buffer(client, monkeypatch, tmp_path):
+    # Flushes only when the test asks, so the buffered state can be checked
+    buffer = IngestBuffer(durability="log", flush_interval_ms=60000, wal_dir=str(tmp_path))
+    buffer.session_factory = TestingAsyncSessionLocal
+    monkeypatch.setattr(ingest, "ingest_buffer", buffer)
+    yield buffer
+    client.portal.call(buffer.stop)
+
+def test_buffered_ingest_commits_in_groups(client, device, wal_buffer, tmp_path):
+    for i in range(5):
+        assert client.post("/api/heartbeat/", json=make_heartbeat(device["sn"], cpu_usage=i)).status_code == 200
+    response = client.post("/api/heartbeat/batch", json={"heartbeats": [make_heartbeat(device["sn"])] * 20})
+    assert response.json()["accepted"] == 20
+
+    # Acknowledged and in the log, not in the database yet
+    history = client.get(f"/api/heartbeat/{device['id']}/history")
+    assert history.json() == []
+    [wal_dir] = list(tmp_path.iterdir())
+    [segment] = list(wal_dir.glob("*.log"))
+    assert len(segment.read_bytes().splitlines()) == 25
+    assert wal_buffer.stats()["fsyncs"] >= 1
+
+    client.portal.call(wal_buffer.flush)
+    history = client.get(f"/api/heartbeat/{device['id']}/history")
+    assert len(history.json()) == 25
+    assert wal_buffer.stats()["flushes"] == 1
+    # The flushed segment is gone, only the fresh one remains
+    [fresh] = list(wal_dir.glob("*.log"))
+    assert fresh != segment and fresh.read_bytes() == b""
+
+def test_unflushed_segments_replayed_on_start(client, device, wal_buffer, tmp_path):
+    heartbeats = [make_heartbeat(device["sn"], cpu_usage=i) for i in range(10)]
+    assert client.post("/api/heartbeat/batch", json={"heartbeats": heartbeats}).json()["accepted"] == 10
+    # Crash: the flusher dies without committing
+    wal_buffer._flusher.cancel()
+    wal_buffer.rows.clear()
+    wal_buffer.wal.close()
+    [wal_dir] = list(tmp_path.iterdir())
+    [segment] = list(wal_dir.glob("*.log"))
+    copy = wal_dir / "999999999999.log"
+    copy.write_bytes(segment.read_bytes() + b'{"id": "torn')
+
+    restarted = IngestBuffer(durability="sync", wal_dir=str(tmp_path))
+    restarted.session_factory = TestingAsyncSessionLocal
+    client.portal.call(restarted.start)
+
+    # The copy repeats rows already replayed from the first segment
+    assert restarted.stats()["replayed"] == 10
+    assert list(tmp_path.iterdir()) == []
+    history = client.get(f"/api/heartbeat/{device['id']}/history")
+    assert sorted(h["cpu_usage"] for h in history.json()) == list(range(10))
+    db = TestingSessionLocal()
+    assert db.query(func.sum(models.HeartbeatRollup1m.count)).scalar() == 10
+    db.close()
+
+def test_full_ingest_buffer_answers_503(client, device, wal_buffer):
+    wal_buffer.maxsize = 3
+    response = client.post("/api/heartbeat/batch", json={"heartbeats": [make_heartbeat(device["sn"])] * 4})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert wal_buffer.stats()["rejected"] == 4
+
+def test_live_wal_not_replayed(client, device, wal_buffer, tmp_path):
+    assert client.post("/api/heartbeat/", json=make_heartbeat(device["sn"])).status_code == 200
+
+    # Another worker starting on the same directory leaves the live log alone
+    other = IngestBuffer(durability="sync", wal_dir=str(tmp_path))
+    other.session_factory = TestingAsyncSessionLocal
+    client.portal.call(other.start)
+    assert other.stats()["replayed"] == 0
+    [wal_dir] = list(tmp_path.iterdir())
+    assert len(list(wal_dir.glob("*.log"))) == 1
+
+    client.portal.call(wal_buffer.stop)
+    assert list(tmp_path.iterdir()) == []
+    assert len(client.get(f"/api/heartbeat/{device['id']}/history").json()) == 1
+
+def test_failed_flush_requeues_uncommitted_chunks(client, device, wal_buffer, monkeypatch):
+    heartbeats = [make_heartbeat(device["sn"], cpu_usage=i) for i in range(25)]
+    assert client.post("/api/heartbeat/batch", json={"heartbeats": heartbeats}).json()["accepted"] == 25
+    wal_buffer.flush_rows = 10
+
+    insert_heartbeat_rows = ingest.async_crud.insert_heartbeat_rows
+    calls = []
+    async def second_chunk_fails(db, rows, skip_existing=False):
+        calls.append((len(rows), skip_existing))
+        if len(calls) == 2:
+            raise ConnectionError("database went away")
+        return await insert_heartbeat_rows(db, rows, skip_existing)
+    monkeypatch.setattr(ingest.async_crud, "insert_heartbeat_rows", second_chunk_fails)
+
+    with pytest.raises(ConnectionError):
+        client.portal.call(wal_buffer.flush)
+    # The first chunk is committed, the other two are buffered again
+    assert wal_buffer.stats()["buffered"] == 15
+    assert len(client.get(f"/api/heartbeat/{device['id']}/history").json()) == 10
+
+    client.portal.call(wal_buffer.flush)
+    assert calls[2:] == [(10, True), (5, True)]
+    assert wal_buffer.stats()["buffered"] == 0
+    history = client.get(f"/api/heartbeat/{device['id']}/history").json()
+    assert sorted(h["cpu_usage"] for h in history) == list(range(25))
+
+@pytest.fixture
+def foreign_keys():
+    # SQLite only checks foreign keys when asked to, per connection
+    def enable(connection, _):
+        connection.execute("PRAGMA foreign_keys=ON")
+    event.listen(async_engine.sync_engine, "connect", enable)
+    yield
+    event.remove(async_engine.sync_engine, "connect", enable)
+
+def test_rows_of_deleted_device_dropped(client, device, wal_buffer, foreign_keys):
+    other = client.post(
+        "/api/devices/",
+        json={"name": "Doomed Device", "location": "Test Location", "sn": "DOOMED123456"},
+        headers=device["headers"]
+    ).json()
+    heartbeats = [make_heartbeat(sn) for sn in (device["sn"], other["sn"]) * 3]
+    assert client.post("/api/heartbeat/batch", json={"heartbeats": heartbeats}).json()["accepted"] == 6
+    client.delete(f"/api/devices/{other['id']}", headers=device["headers"])
+
+    client.portal.call(wal_buffer.flush)
+    stats = wal_buffer.stats()
+    assert stats["buffered"] == 0 and stats["dropped"] == 3 and stats["failed_flushes"] == 0
+    assert len(client.get(f"/api/heartbeat/{device['id']}/history").json()) == 3
@@ -0,0 +1,89 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from app.main import app
+from app.database import get_db, get_async_db, Base
+from app import metrics
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+metrics.instrument(engine)
+metrics.instrument(async_engine.sync_engine)
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+@pytest.fixture
+def client():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    Base.metadata.create_all(bind=engine)
+    with TestClient(app) as c:
+        yield c
+    Base.metadata.drop_all(bind=engine)
+
+def sample(name, **labels):
+    return metrics.registry.get_sample_value(name, labels) or 0
+
+def test_metrics_are_labelled_by_route_template(client):
+    route = "/api/heartbeat/{device_id}/history"
+    before = sample("http_request_duration_seconds_count", method="GET", route=route, status="200")
+    queries = sample("db_queries_per_request_sum", route=route)
+    for device_id in ("6f1c1a52-8d5e-4a63-9a43-2f2b0c6f4e11", "0d4b5e1e-4a39-4bd1-9a59-0c0e0e3d7a21"):
+        assert client.get(f"/api/heartbeat/{device_id}/history").status_code == 200
+
+    assert sample("http_request_duration_seconds_count", method="GET", route=route, status="200") == before + 2
+    assert sample("http_requests_in_progress", method="GET", route=route) == 0
+    # The history query runs on the async engine, in the request's context
+    assert sample("db_queries_per_request_sum", route=route) >= queries + 2
+    assert client.get("/no-such-page").status_code == 404
+    assert sample("http_request_duration_seconds_count", method="GET", route="unmatched", status="404") >= 1
+
+    body = client.get("/metrics").text
+    assert 'route="/api/heartbeat/{device_id}/history"' in body
+    assert "6f1c1a52" not in body
+    assert "alert_queue_depth" in body and "websocket_connections" in body
+
+def test_repeated_statement_counts_as_n_plus_one():
+    loop_app = FastAPI()
+    loop_app.add_middleware(metrics.MetricsMiddleware, router=loop_app.router)
+    database = create_engine("sqlite://")
+    metrics.instrument(database)
+
+    @loop_app.get("/items/{count}")
+    def items(count: int):
+        with database.connect() as conn:
+            return [conn.execute(text("SELECT :i"), {"i": i}).scalar() for i in range(count)]
+
+    with TestClient(loop_app) as c:
+        c.get("/items/3")
+        assert sample("db_n_plus_one_total", route="/items/{count}") == 0
+        c.get(f"/items/{metrics.N_PLUS_ONE_THRESHOLD}")
+        assert sample("db_n_plus_one_total", route="/items/{count}") == 1
+    assert sample("db_queries_per_request_sum", route="/items/{count}") == 3 + metrics.N_PLUS_ONE_THRESHOLD
+
+def test_readiness_reports_pool_saturation(client, monkeypatch):
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json()["checks"]["db_pool_sync"]["saturation"] < 1
+
+    monkeypatch.setattr(metrics, "READY_POOL_SATURATION", 0.0)
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"]["db_pool_sync"]["ok"] is False
+    assert client.get("/health").json()["ready"] is False
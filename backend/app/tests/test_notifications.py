@@ -0,0 +1,460 @@
+import asyncio
+import json
+import uuid
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from app.main import app
+from app.database import get_db, get_async_db, Base
+from app.rules import METRICS, compile_rules, rule_engine
+from app.alerts import Reading, alert_pipeline
+from app.alert_state import AlertTracker, FIRING, RESOLVED, alert_tracker
+from app.windows import RollingWindow, WindowStore, window_store
+from app.anomaly import FleetStats, anomaly_detector
+from app.backplane import MemoryBackplane
+from app.websocket import ConnectionManager
+from app.cache import CachedDevice
+from app import crud, models
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Each TestClient runs its own event loop, so don't pool async connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
+alert_pipeline.session_factory = TestingSessionLocal
+
+@pytest.fixture
+def client():
+    Base.metadata.create_all(bind=engine)
+    alert_tracker.clear()
+    window_store.clear()
+    with TestClient(app) as c:
+        yield c
+    Base.metadata.drop_all(bind=engine)
+
+@pytest.fixture
+def auth_headers(client):
+    client.post(
+        "/api/auth/register",
+        json={"name": "Test User", "email": "test@example.com", "password": "testpassword"}
+    )
+    response = client.post(
+        "/api/auth/login",
+        json={"email": "test@example.com", "password": "testpassword"}
+    )
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+@pytest.fixture
+def device(client, auth_headers):
+    response = client.post(
+        "/api/devices/",
+        json={"name": "Test Device", "location": "Test Location", "sn": "TEST12345678"},
+        headers=auth_headers
+    )
+    return response.json()
+
+def send_heartbeat(client, sn, cpu_usage):
+    response = client.post("/api/heartbeat/", json={
+        "device_sn": sn,
+        "cpu_usage": cpu_usage,
+        "ram_usage": 40.0,
+        "disk_free": 70.0,
+        "temperature": 45.0,
+        "dns_latency": 9.5,
+        "connectivity": 1,
+        "boot_time": "2025-09-01T00:00:00+00:00"
+    })
+    # Alerts are evaluated in the background; wait for the queue to drain
+    client.portal.call(alert_pipeline.join)
+    return response
+
+def make_notification(metric, condition, threshold, device_ids=None, **options):
+    return models.Notification(
+        id=uuid.uuid4(), name=f"{metric} {condition} {threshold}", metric=metric,
+        condition=condition, threshold=threshold, device_ids=device_ids, is_active=True, **options
+    )
+
+def states_over(tracker, ruleset, device_id, readings):
+    """Feed (seconds, cpu_usage) readings; returns the transitions at each step."""
+    return [
+        [transition.state for transition in tracker.evaluate(ruleset, device_id, {"cpu_usage": cpu}, now)]
+        for now, cpu in readings
+    ]
+
+def test_compiled_rules_match_only_firing_rules():
+    device_id = uuid.uuid4()
+    other_device = uuid.uuid4()
+    ruleset = compile_rules([
+        make_notification("cpu_usage", ">", 80),
+        make_notification("cpu_usage", ">", 95),
+        make_notification("cpu_usage", "<=", 10),
+        make_notification("temperature", "==", 45),
+        make_notification("cpu_usage", ">=", 90, json.dumps([str(device_id)])),
+        make_notification("cpu_usage", ">", 0, json.dumps([str(other_device)])),
+        make_notification("cpu_usage", "!=", 0),
+    ])
+
+    matches = ruleset.match(device_id, {"cpu_usage": 90.0, "temperature": 45.0})
+    assert sorted(rule.name for rule, value in matches) == [
+        "cpu_usage > 80", "cpu_usage >= 90", "temperature == 45"
+    ]
+
+def test_alert_fires_once_and_resolves():
+    ruleset = compile_rules([make_notification("cpu_usage", ">", 80)])
+    steps = states_over(AlertTracker(), ruleset, uuid.uuid4(), [(0, 95), (1, 96), (2, 97), (3, 50), (4, 50), (5, 90)])
+    assert steps == [[FIRING], [], [], [RESOLVED], [], [FIRING]]
+
+def test_alert_waits_for_readings_and_seconds():
+    device_id = uuid.uuid4()
+    by_readings = compile_rules([make_notification("cpu_usage", ">", 80, for_readings=3)])
+    steps = states_over(AlertTracker(), by_readings, device_id, [(0, 90), (1, 90), (2, 50), (3, 90), (4, 90), (5, 90)])
+    assert steps == [[], [], [], [], [], [FIRING]]
+
+    by_seconds = compile_rules([make_notification("cpu_usage", ">", 80, for_seconds=60)])
+    steps = states_over(AlertTracker(), by_seconds, device_id, [(0, 90), (30, 90), (59, 90), (60, 90)])
+    assert steps == [[], [], [], [FIRING]]
+
+def test_alert_hysteresis_and_cooldown():
+    device_id = uuid.uuid4()
+    ruleset = compile_rules([make_notification("cpu_usage", ">", 80, hysteresis=5)])
+    # 78 is under the threshold but inside the band, so the alert keeps firing
+    steps = states_over(AlertTracker(), ruleset, device_id, [(0, 85), (1, 78), (2, 76), (3, 74)])
+    assert steps == [[FIRING], [], [], [RESOLVED]]
+
+    ruleset = compile_rules([make_notification("cpu_usage", ">", 80, cooldown_seconds=300)])
+    steps = states_over(AlertTracker(), ruleset, device_id, [(0, 90), (10, 50), (20, 90), (100, 50), (200, 90), (300, 90)])
+    assert steps == [[FIRING], [RESOLVED], [], [], [], [FIRING]]
+
+def test_deleted_rule_resolves_its_alert():
+    device_id = uuid.uuid4()
+    tracker = AlertTracker()
+    notification = make_notification("cpu_usage", ">", 80)
+    assert states_over(tracker, compile_rules([notification]), device_id, [(0, 90)]) == [[FIRING]]
+    transitions = tracker.evaluate(compile_rules([]), device_id, {"cpu_usage": 90}, 1)
+    assert [(t.state, t.rule, t.rule_id) for t in transitions] == [(RESOLVED, None, notification.id)]
+    assert tracker.firing() == 0
+
+def test_rolling_window_aggregates_and_eviction():
+    window = RollingWindow(60)
+    for at, value in [(0, 5.0), (10, 9.0), (20, 1.0), (30, 4.0)]:
+        window.append(at, value)
+    assert (window.aggregate("avg"), window.aggregate("min"), window.aggregate("max")) == (4.75, 1.0, 9.0)
+    # 0 and 10 fall out of the last 60 seconds
+    window.append(75, 3.0)
+    assert window.aggregate("avg") == pytest.approx(8 / 3)
+    assert (window.aggregate("min"), window.aggregate("max")) == (1.0, 4.0)
+    assert window.aggregate("rate") == (3.0 - 1.0) / 55 * 3600
+
+    capped = RollingWindow(3600, capacity=2)
+    for at, value in [(0, 10.0), (1, 1.0), (2, 2.0)]:
+        capped.append(at, value)
+    assert capped.aggregate("max") == 2.0 and len(capped.readings) == 2
+
+def windowed_transitions(notifications, readings):
+    """Feed (seconds, values) readings through windows and alert state."""
+    ruleset = compile_rules(notifications)
+    device_id = uuid.uuid4()
+    store, tracker = WindowStore(), AlertTracker()
+    steps = []
+    for now, values in readings:
+        windowed = store.update(ruleset, device_id, values, now)
+        steps.append([t.state for t in tracker.evaluate(ruleset, device_id, values, now, windowed)])
+    return steps
+
+def test_windowed_average_and_rate_rules():
+    average = make_notification("cpu_usage", ">", 80, aggregate="avg", window_seconds=300)
+    readings = [(0, 70), (60, 70), (120, 95), (180, 95), (600, 60)]
+    steps = windowed_transitions([average], [(at, {"cpu_usage": cpu}) for at, cpu in readings])
+    assert steps == [[], [], [], [FIRING], [RESOLVED]]
+
+    # Disk filling up faster than 10 points per hour
+    draining = make_notification("disk_free", "<", -10, aggregate="rate", window_seconds=3600)
+    readings = [(0, 80), (600, 79), (1200, 77), (1800, 72), (5400, 72)]
+    steps = windowed_transitions([draining], [(at, {"disk_free": disk}) for at, disk in readings])
+    assert steps == [[], [], [], [FIRING], [RESOLVED]]
+
+def test_count_rule_fires_for_k_of_last_m():
+    offline = make_notification("connectivity", "==", 0, aggregate="count", window_readings=5, window_count=3)
+    readings = [1, 0, 1, 0, 0, 1, 1, 1, 1]
+    steps = windowed_transitions([offline], [(at, {"connectivity": c}) for at, c in enumerate(readings)])
+    assert steps == [[], [], [], [], [FIRING], [], [RESOLVED], [], []]
+
+def test_windowed_rule_needs_its_window(client, auth_headers):
+    response = client.post(
+        "/api/notifications/",
+        json={"name": "Offline", "metric": "connectivity", "condition": "==", "threshold": 0, "aggregate": "count"},
+        headers=auth_headers
+    )
+    assert response.status_code == 422
+
+def test_windowed_rule_alerts_from_heartbeats(client, auth_headers, device):
+    client.post(
+        "/api/notifications/",
+        json={
+            "name": "Sustained CPU", "metric": "cpu_usage", "condition": ">", "threshold": 80,
+            "aggregate": "max", "window_seconds": 600
+        },
+        headers=auth_headers
+    )
+    for cpu_usage in (50.0, 90.0, 50.0):
+        send_heartbeat(client, device["sn"], cpu_usage)
+    alerts = client.get("/api/notifications/alerts", headers=auth_headers).json()
+    assert len(alerts) == 1
+    assert alerts[0]["value"] == 90.0
+    assert "max cpu_usage over 600s" in alerts[0]["message"]
+
+def test_fleet_stats_flag_outliers_per_device():
+    rng = np.random.default_rng(0)
+    devices = [uuid.uuid4(), uuid.uuid4()]
+    fleet = FleetStats(alpha=0.1, warmup=10)
+    for _ in range(50):
+        values = np.column_stack([rng.normal(center, 2, 2) for center in (40, 60, 50, 45, 10, 1)])
+        fleet.update(devices, values)
+
+    values = np.array([[95, 60, 50, 45, 10, 1], [40, 60, 50, 45, 10, np.nan]], dtype=float)
+    scores = fleet.update(devices, values)
+    assert scores[0, 0] > 10
+    # Device 1 usually sits at 40, device 0's spike doesn't shift it
+    assert abs(scores[1, 0]) < 3
+    assert np.isnan(scores[1, 5])
+
+    newcomer = fleet.update([uuid.uuid4()], values[:1])
+    assert np.isnan(newcomer).all()
+    assert fleet.stats()["devices"] == 3
+
+def test_fleet_stats_repeated_device_in_batch_matches_sequential():
+    device_id = uuid.uuid4()
+    readings = np.arange(1, 13, dtype=float).reshape(4, 3).repeat(2, axis=1)
+    sequential = FleetStats(warmup=1, slots=1)
+    expected = np.vstack([sequential.update([device_id], row[None, :]) for row in readings])
+
+    batched = FleetStats(warmup=1, slots=1)
+    scores = batched.update([device_id] * 4, readings)
+    np.testing.assert_allclose(scores, expected)
+    np.testing.assert_allclose(batched.mean[0], sequential.mean[0])
+    np.testing.assert_allclose(batched.var[0], sequential.var[0])
+
+def test_anomaly_rule_alerts_from_heartbeats(client, auth_headers, device, monkeypatch):
+    monkeypatch.setattr(anomaly_detector, "enabled", True)
+    monkeypatch.setattr(anomaly_detector, "fleet", FleetStats(alpha=0.2, warmup=5))
+    client.post(
+        "/api/notifications/",
+        json={"name": "Unusual CPU", "metric": "cpu_usage", "condition": "anomaly", "threshold": 4},
+        headers=auth_headers
+    )
+    for cpu_usage in (40.0, 42.0, 41.0, 39.0, 40.0, 41.0, 40.0, 95.0):
+        send_heartbeat(client, device["sn"], cpu_usage)
+    alerts = client.get("/api/notifications/alerts", headers=auth_headers).json()
+    assert len(alerts) == 1
+    assert alerts[0]["value"] == 95.0
+    assert "z-score" in alerts[0]["message"]
+
+def test_stuck_device_writes_one_alert_until_resolved(client, auth_headers, device):
+    client.post(
+        "/api/notifications/",
+        json={"name": "High CPU", "metric": "cpu_usage", "condition": ">", "threshold": 80, "hysteresis": 10},
+        headers=auth_headers
+    )
+    token = auth_headers["Authorization"].split()[1]
+    with client.websocket_connect(f"/api/notifications/ws?token={token}") as websocket:
+        for cpu_usage in (95.0, 96.0, 97.0, 75.0):
+            send_heartbeat(client, device["sn"], cpu_usage)
+        alerts = client.get("/api/notifications/alerts", headers=auth_headers).json()
+        assert len(alerts) == 1
+        assert alerts[0]["value"] == 95.0 and alerts[0]["resolved_at"] is None
+        assert websocket.receive_json()["type"] == "notification"
+
+        send_heartbeat(client, device["sn"], 60.0)
+        message = websocket.receive_json()
+        assert message["type"] == "resolved"
+        assert message["alert"]["id"] == alerts[0]["id"]
+    alerts = client.get("/api/notifications/alerts", headers=auth_headers).json()
+    assert len(alerts) == 1 and alerts[0]["resolved_at"] is not None
+
+def test_alert_fires_again_when_saving_it_failed(client, auth_headers, device, monkeypatch):
+    client.post(
+        "/api/notifications/",
+        json={"name": "High CPU", "metric": "cpu_usage", "condition": ">", "threshold": 80},
+        headers=auth_headers
+    )
+    save_alert_transitions = crud.save_alert_transitions
+    def fails_once(*args):
+        monkeypatch.setattr(crud, "save_alert_transitions", save_alert_transitions)
+        raise ConnectionError("database went away")
+    monkeypatch.setattr(crud, "save_alert_transitions", fails_once)
+
+    send_heartbeat(client, device["sn"], 90.0)
+    assert client.get("/api/notifications/alerts", headers=auth_headers).json() == []
+    assert alert_tracker.firing() == 0
+
+    send_heartbeat(client, device["sn"], 91.0)
+    alerts = client.get("/api/notifications/alerts", headers=auth_headers).json()
+    assert len(alerts) == 1 and alerts[0]["value"] == 91.0
+
+def test_failed_batch_rolls_back_alert_states_and_windows(client, auth_headers, device, monkeypatch):
+    for rule in (
+        {"name": "High CPU", "metric": "cpu_usage", "condition": ">", "threshold": 80},
+        {"name": "Hot average", "metric": "cpu_usage", "condition": ">", "threshold": 80, "aggregate": "avg", "window_seconds": 600},
+    ):
+        client.post("/api/notifications/", json=rule, headers=auth_headers)
+    device_id = uuid.UUID(device["id"])
+    owner = CachedDevice(device_id, uuid.UUID(device["user_id"]), device["name"])
+    broken = CachedDevice(uuid.uuid4(), uuid.uuid4(), "Broken")
+    def reading(device_id, cpu_usage):
+        values = dict.fromkeys(METRICS, 50.0)
+        values["cpu_usage"] = cpu_usage
+        return Reading(device_id, **values)
+
+    # The second device's rules can't be loaded after the first one fired
+    rules_for_user = rule_engine.rules_for_user
+    def fails_for_broken(db, user_id):
+        if user_id == broken.user_id:
+            raise ConnectionError("database went away")
+        return rules_for_user(db, user_id)
+    monkeypatch.setattr(rule_engine, "rules_for_user", fails_for_broken)
+    with pytest.raises(ConnectionError):
+        alert_pipeline.process_batch([(owner, reading(device_id, 100.0)), (broken, reading(broken.id, 50.0))])
+    assert alert_tracker.firing() == 0 and window_store.devices() == 0
+
+    messages = [json.loads(message) for _, message in alert_pipeline.process_batch([(owner, reading(device_id, 90.0))])]
+    # Both fire again, and the average doesn't include the failed batch's reading
+    assert [message["alert"]["value"] for message in messages] == [90.0, 90.0]
+
+def test_heartbeat_triggers_alert_and_rule_updates_apply(client, auth_headers, device):
+    response = client.post(
+        "/api/notifications/",
+        json={"name": "High CPU", "metric": "cpu_usage", "condition": ">", "threshold": 80},
+        headers=auth_headers
+    )
+    notification_id = response.json()["id"]
+
+    send_heartbeat(client, device["sn"], 90.0)
+    send_heartbeat(client, device["sn"], 50.0)
+    alerts = client.get("/api/notifications/alerts", headers=auth_headers).json()
+    assert len(alerts) == 1
+    assert alerts[0]["value"] == 90.0
+
+    client.put(
+        f"/api/notifications/{notification_id}",
+        json={"threshold": 95},
+        headers=auth_headers
+    )
+    send_heartbeat(client, device["sn"], 90.0)
+    alerts = client.get("/api/notifications/alerts", headers=auth_headers).json()
+    assert len(alerts) == 1
+
+def test_websocket_requires_token(client):
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/api/notifications/ws?token=invalid") as websocket:
+            websocket.receive_text()
+
+def test_websocket_receives_own_alerts(client, auth_headers, device):
+    client.post(
+        "/api/notifications/",
+        json={"name": "High CPU", "metric": "cpu_usage", "condition": ">", "threshold": 80},
+        headers=auth_headers
+    )
+    token = auth_headers["Authorization"].split()[1]
+    with client.websocket_connect(f"/api/notifications/ws?token={token}") as websocket:
+        send_heartbeat(client, device["sn"], 90.0)
+        message = websocket.receive_json()
+        assert message["type"] == "notification"
+        assert message["alert"]["value"] == 90.0
+
+class FakeWebSocket:
+    def __init__(self):
+        self.messages = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        self.messages.append(message)
+
+    async def close(self, code=None):
+        pass
+
+class StuckWebSocket(FakeWebSocket):
+    """Takes the first message and never finishes sending it."""
+
+    def __init__(self):
+        super().__init__()
+        self.closed_with = None
+
+    async def send_text(self, message):
+        self.messages.append(message)
+        await asyncio.Event().wait()
+
+    async def close(self, code=None):
+        self.closed_with = code
+
+def fill_stuck_socket(policy):
+    async def scenario():
+        manager = ConnectionManager(queue_size=2, send_timeout=60, slow_consumer_policy=policy)
+        socket = StuckWebSocket()
+        connection = await manager.connect(socket, "user-1")
+        manager.send_to_user("user-1", "m0")
+        # Let the sender pick up m0 and block on it
+        await asyncio.sleep(0.01)
+        for i in range(1, 5):
+            manager.send_to_user("user-1", f"m{i}")
+        if connection.closer is not None:
+            await connection.closer
+        await asyncio.sleep(0.01)
+        queued = list(connection.queue._queue)
+        for connections in list(manager.active_connections.values()):
+            for open_connection in list(connections):
+                manager.disconnect(open_connection)
+        return manager, socket, queued
+
+    return asyncio.run(scenario())
+
+def test_slow_consumer_drops_oldest_messages():
+    manager, socket, queued = fill_stuck_socket("drop_oldest")
+    assert socket.messages == ["m0"]
+    assert queued == ["m3", "m4"]
+    assert manager.stats()["dropped_messages"] == 2
+    assert manager.slow_disconnects == 0 and socket.closed_with is None
+
+def test_slow_consumer_is_disconnected():
+    manager, socket, queued = fill_stuck_socket("disconnect")
+    assert manager.slow_disconnects == 1
+    assert manager.stats()["connections"] == 0
+    assert socket.closed_with == 1013
+    # m4 arrived after the socket was gone
+    assert manager.stats()["dropped_messages"] == 1
+
+def test_backplane_delivers_to_sockets_on_other_workers():
+    async def scenario():
+        backplane = MemoryBackplane()
+        worker_a, worker_b = ConnectionManager(), ConnectionManager()
+        backplane.subscribe(worker_a.send_to_user)
+        backplane.subscribe(worker_b.send_to_user)
+        socket = FakeWebSocket()
+        await worker_b.connect(socket, "user-1")
+
+        await backplane.publish_many([("user-1", "alert"), ("user-2", "other")])
+        await asyncio.sleep(0.01)
+        return socket.messages
+
+    assert asyncio.run(scenario()) == ["alert"]
@@ -0,0 +1,40 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Sequence
+import math
+from sqlalchemy import Integer, cast, func, literal_column
+from .rules import METRICS
+
+# Supported history bucket widths, in seconds
+BUCKETS = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+AGGREGATES = ("avg", "min", "max", "p95")
+
+def bucket_expr(dialect_name: str, column, seconds: int):
+    """Start of the `seconds`-wide bucket holding `column`, as epoch seconds."""
+    # Rendered inline so the SELECT and GROUP BY expressions stay identical
+    width = literal_column(str(int(seconds)))
+    if dialect_name == "postgresql":
+        return func.floor(func.extract("epoch", column) / width) * width
+    # Not `/ width * width`: SQLAlchemy 2.0 renders / as true division
+    epoch = cast(func.strftime("%s", column), Integer)
+    return epoch - epoch % width
+
+def percentile(values: Sequence[float], q: float):
+    # Linear interpolation between closest ranks, like percentile_cont
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    if lower == upper:
+        return ordered[lower]
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def to_datetime(epoch_seconds) -> datetime:
+    return datetime.fromtimestamp(float(epoch_seconds), tz=timezone.utc)
+
+def empty_series() -> Dict[str, List]:
+    series = {"timestamps": [], "count": []}
+    for metric in METRICS:
+        series[metric] = []
+    return series
@@ -0,0 +1,125 @@
+from typing import Dict, Set
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "30"))
+# What to do when a client's send queue is full: "drop_oldest" or "disconnect"
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+
+PING_MESSAGE = json.dumps({"type": "ping"})
+
+class Connection:
+    """One authenticated socket with its own bounded send queue and sender task."""
+
+    def __init__(self, websocket, user_id: str, queue_size: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.sender = None
+        # Closes a slow consumer; kept so the task isn't collected mid-close
+        self.closer = None
+        self.dropped = 0
+
+# WebSocket manager for real-time notifications
+class ConnectionManager:
+    """Keeps sockets per user and delivers to each one from its own task.
+
+    Enqueueing never awaits a client, so one slow or dead socket cannot hold
+    up delivery to any other. Sockets that fail or time out a send are
+    dropped, and idle sockets get a ping every WS_PING_INTERVAL seconds.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = WS_SEND_QUEUE_SIZE,
+        send_timeout: float = WS_SEND_TIMEOUT,
+        ping_interval: float = WS_PING_INTERVAL,
+        slow_consumer_policy: str = WS_SLOW_CONSUMER_POLICY,
+    ):
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.ping_interval = ping_interval
+        self.slow_consumer_policy = slow_consumer_policy
+        self.active_connections: Dict[str, Set[Connection]] = {}
+        self.dropped_messages = 0
+        self.slow_disconnects = 0
+
+    async def connect(self, websocket, user_id) -> Connection:
+        await websocket.accept()
+        connection = Connection(websocket, str(user_id), self.queue_size)
+        connection.sender = asyncio.create_task(self._sender(connection))
+        self.active_connections.setdefault(connection.user_id, set()).add(connection)
+        return connection
+
+    def disconnect(self, connection: Connection):
+        connections = self.active_connections.get(connection.user_id)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self.active_connections[connection.user_id]
+        if connection.sender is not None and connection.sender is not asyncio.current_task():
+            connection.sender.cancel()
+
+    def send_to_user(self, user_id, message: str) -> int:
+        connections = list(self.active_connections.get(str(user_id), ()))
+        for connection in connections:
+            self._enqueue(connection, message)
+        return len(connections)
+
+    def broadcast(self, message: str):
+        for connections in list(self.active_connections.values()):
+            for connection in list(connections):
+                self._enqueue(connection, message)
+
+    def _enqueue(self, connection: Connection, message: str):
+        try:
+            connection.queue.put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            pass
+        self.dropped_messages += 1
+        connection.dropped += 1
+        if self.slow_consumer_policy == "disconnect":
+            self.slow_disconnects += 1
+            self.disconnect(connection)
+            connection.closer = asyncio.create_task(self._close(connection, code=1013))
+        else:
+            connection.queue.get_nowait()
+            connection.queue.put_nowait(message)
+
+    async def _sender(self, connection: Connection):
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(connection.queue.get(), self.ping_interval)
+                except asyncio.TimeoutError:
+                    message = PING_MESSAGE
+                await asyncio.wait_for(connection.websocket.send_text(message), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info("Dropping WebSocket for user %s: %r", connection.user_id, e)
+            self.disconnect(connection)
+            await self._close(connection)
+
+    async def _close(self, connection: Connection, code: int = 1011):
+        try:
+            await connection.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stats(self):
+        return {
+            "users": len(self.active_connections),
+            "connections": sum(len(c) for c in self.active_connections.values()),
+            "dropped_messages": self.dropped_messages,
+            "slow_disconnects": self.slow_disconnects,
+        }
+
+manager = ConnectionManager()
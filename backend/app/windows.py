@@ -0,0 +1,213 @@
+"""Rolling per-device windows behind windowed alert rules.
+
+Each device keeps one RollingWindow per (metric, window_seconds) used by
+its rules, shared by every avg/min/max/rate rule on that pair, and one
+MatchCounter per count rule shape. Both are updated in amortized O(1) per
+reading, so evaluating a windowed rule never reads `heartbeats` back:
+
+    RollingWindow  readings of the last `seconds`, with a running sum and
+                   monotonic deques whose heads are the window's min and max
+    MatchCounter   whether each of the last M readings satisfied a
+                   condition, with a running count
+
+Windows hold at most WINDOW_MAX_READINGS readings; devices reporting faster
+than that get a shorter effective window. Like the alert state, windows live
+in the alert worker's memory, start empty after a restart and are per
+process.
+"""
+from collections import deque
+import os
+from .rules import Rule, RuleSet, satisfies, still_holds
+
+WINDOW_MAX_READINGS = int(os.getenv("WINDOW_MAX_READINGS", "3600"))
+
+class RollingWindow:
+    __slots__ = ("seconds", "capacity", "readings", "total", "_seq", "_min", "_max")
+
+    def __init__(self, seconds: float, capacity: int = WINDOW_MAX_READINGS):
+        self.seconds = seconds
+        self.capacity = capacity
+        self.readings = deque()
+        self.total = 0.0
+        # Readings are numbered so the min/max deques can tell which of
+        # their entries have left the window
+        self._seq = 0
+        self._min = deque()
+        self._max = deque()
+
+    def append(self, at: float, value: float):
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._min.append((self._seq, value))
+        self._max.append((self._seq, value))
+        self.readings.append((self._seq, at, value))
+        self.total += value
+        self._seq += 1
+        self._evict(at - self.seconds)
+
+    def _evict(self, cutoff: float):
+        readings = self.readings
+        while readings and (readings[0][1] < cutoff or len(readings) > self.capacity):
+            seq, _, value = readings.popleft()
+            self.total -= value
+            if self._min[0][0] == seq:
+                self._min.popleft()
+            if self._max[0][0] == seq:
+                self._max.popleft()
+        if not readings:
+            # Start over from an exact zero instead of carrying rounding error
+            self.total = 0.0
+
+    def copy(self) -> "RollingWindow":
+        window = RollingWindow(self.seconds, self.capacity)
+        window.readings = deque(self.readings)
+        window.total = self.total
+        window._seq = self._seq
+        window._min = deque(self._min)
+        window._max = deque(self._max)
+        return window
+
+    def aggregate(self, kind: str):
+        """The window's avg, min, max or rate (units per hour); None when
+        there isn't enough data."""
+        if not self.readings:
+            return None
+        if kind == "avg":
+            return self.total / len(self.readings)
+        if kind == "min":
+            return self._min[0][1]
+        if kind == "max":
+            return self._max[0][1]
+        _, first_at, first = self.readings[0]
+        _, last_at, last = self.readings[-1]
+        if last_at <= first_at:
+            return None
+        return (last - first) / (last_at - first_at) * 3600
+
+class MatchCounter:
+    __slots__ = ("flags", "count")
+
+    def __init__(self, size: int):
+        self.flags = deque(maxlen=size)
+        self.count = 0
+
+    def append(self, matched: bool):
+        if len(self.flags) == self.flags.maxlen:
+            self.count -= self.flags[0]
+        self.flags.append(matched)
+        self.count += matched
+
+    def copy(self) -> "MatchCounter":
+        counter = MatchCounter(self.flags.maxlen)
+        counter.flags.extend(self.flags)
+        counter.count = self.count
+        return counter
+
+def _counter_key(rule: Rule):
+    # Rules with the same shape share a counter, and an edited rule gets a
+    # fresh one
+    return (rule.metric, rule.condition, rule.threshold, rule.window_readings)
+
+class DeviceWindows:
+    __slots__ = ("ruleset", "series", "counters")
+
+    def __init__(self):
+        self.ruleset = None
+        self.series = {}
+        self.counters = {}
+
+    def prune(self, ruleset: RuleSet, rules):
+        """Drop windows no rule uses anymore; run when the rule set changes."""
+        series = {(rule.metric, rule.window_seconds) for rule in rules if rule.aggregate != "count"}
+        counters = {_counter_key(rule) for rule in rules if rule.aggregate == "count"}
+        self.series = {key: window for key, window in self.series.items() if key in series}
+        self.counters = {key: counter for key, counter in self.counters.items() if key in counters}
+        self.ruleset = ruleset
+
+    def copy(self) -> "DeviceWindows":
+        device = DeviceWindows()
+        device.ruleset = self.ruleset
+        device.series = {key: window.copy() for key, window in self.series.items()}
+        device.counters = {key: counter.copy() for key, counter in self.counters.items()}
+        return device
+
+class WindowStore:
+    """Rolling windows of every device with windowed rules, keyed by device id."""
+
+    def __init__(self, capacity: int = WINDOW_MAX_READINGS):
+        self.capacity = capacity
+        self._devices = {}
+
+    def update(self, ruleset: RuleSet, device_id, values: dict, at: float) -> dict:
+        """Add one reading taken at `at` (epoch seconds) to the device's
+        windows and evaluate its windowed rules.
+
+        Returns {rule_id: (value, matches, holds)}: the aggregate, whether
+        the rule's condition is met and whether a firing rule stays firing
+        (the condition with hysteresis applied). Rules whose window has no
+        value yet are left out.
+        """
+        rules = ruleset.windowed_for(device_id)
+        if not rules:
+            if self._devices:
+                self._devices.pop(device_id, None)
+            return {}
+        device = self._devices.get(device_id)
+        if device is None:
+            device = self._devices[device_id] = DeviceWindows()
+        if device.ruleset is not ruleset:
+            device.prune(ruleset, rules)
+
+        # Every window is fed once per reading, however many rules share it
+        updated = set()
+        results = {}
+        for rule in rules:
+            value = values.get(rule.metric)
+            if value is None:
+                continue
+            if rule.aggregate == "count":
+                counter_key = _counter_key(rule)
+                counter = device.counters.get(counter_key)
+                if counter is None:
+                    counter = device.counters[counter_key] = MatchCounter(rule.window_readings)
+                if counter_key not in updated:
+                    counter.append(satisfies(rule, value))
+                    updated.add(counter_key)
+                count = counter.count
+                results[rule.id] = (count, count >= rule.window_count, count >= rule.window_count - rule.hysteresis)
+                continue
+            series_key = (rule.metric, rule.window_seconds)
+            window = device.series.get(series_key)
+            if window is None:
+                window = device.series[series_key] = RollingWindow(rule.window_seconds, self.capacity)
+            if series_key not in updated:
+                window.append(at, value)
+                updated.add(series_key)
+            aggregate = window.aggregate(rule.aggregate)
+            if aggregate is not None:
+                results[rule.id] = (aggregate, satisfies(rule, aggregate), still_holds(rule, aggregate))
+        return results
+
+    def snapshot(self, device_id):
+        """A copy of the device's windows, for `rollback`."""
+        device = self._devices.get(device_id)
+        return device.copy() if device is not None else None
+
+    def rollback(self, snapshots: dict):
+        """Put devices back to their {device_id: snapshot} windows, forgetting
+        the readings added since."""
+        for device_id, device in snapshots.items():
+            if device is not None:
+                self._devices[device_id] = device
+            else:
+                self._devices.pop(device_id, None)
+
+    def devices(self) -> int:
+        return len(self._devices)
+
+    def clear(self):
+        self._devices.clear()
+
+window_store = WindowStore()
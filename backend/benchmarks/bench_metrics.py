@@ -0,0 +1,100 @@
+"""Overhead of the Prometheus instrumentation in app/metrics.py.
+
+Times the same work with and without it: a trivial GET through a FastAPI
+app with and without MetricsMiddleware (called as raw ASGI, so only the
+framework and the middleware are measured), and `SELECT 1` on an engine
+with and without the query hooks, outside and inside a request context.
+
+    python -m benchmarks.bench_metrics --repeat 20000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from fastapi import FastAPI
+from sqlalchemy import create_engine, text
+from app import metrics
+
+def make_app(instrumented):
+    app = FastAPI()
+    if instrumented:
+        app.add_middleware(metrics.MetricsMiddleware, router=app.router)
+
+    @app.get("/devices/{device_id}")
+    async def read_device(device_id: str):
+        return {"id": device_id}
+    return app
+
+async def call(app, path):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": b"", "headers": [], "client": ("bench", 1), "server": ("bench", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+    await app(scope, receive, send)
+
+def time_requests(app, repeat):
+    async def run():
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            await call(app, f"/devices/{i}")
+            timings.append((time.perf_counter() - start) * 1e6)
+        return timings
+    return asyncio.run(run())
+
+def time_queries(engines, repeat, rounds=20):
+    """Interleave the engines in rounds so drift in the machine hits all alike."""
+    timings = {name: [] for name in engines}
+    for _ in range(rounds):
+        for name, (engine, in_request) in engines.items():
+            with engine.connect() as conn:
+                token = metrics.request_stats.set(metrics.RequestStats()) if in_request else None
+                for _ in range(repeat // rounds):
+                    start = time.perf_counter()
+                    conn.execute(text("SELECT 1"))
+                    timings[name].append((time.perf_counter() - start) * 1e6)
+                if token is not None:
+                    metrics.request_stats.reset(token)
+    return timings
+
+def row(label, timings, base=None):
+    median = statistics.median(timings)
+    overhead = f"{median - base:+10.1f}" if base is not None else f"{'':>10}"
+    print(f"{label:>28} {median:>10.1f} {overhead}")
+    return median
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'':>28} {'median us':>10} {'overhead':>10}")
+    plain = make_app(False)
+    instrumented = make_app(True)
+    # Warm up both so imports and route compilation don't count
+    time_requests(plain, 100)
+    time_requests(instrumented, 100)
+    base = row("request, plain", time_requests(plain, args.repeat))
+    row("request, instrumented", time_requests(instrumented, args.repeat), base)
+
+    instrumented = create_engine("sqlite://")
+    metrics.instrument(instrumented)
+    timings = time_queries({
+        "SELECT 1, plain": (create_engine("sqlite://"), False),
+        "SELECT 1, hooks": (instrumented, False),
+        "SELECT 1, hooks in request": (instrumented, True),
+    }, args.repeat)
+    base = None
+    for label, values in timings.items():
+        median = row(label, values, base)
+        base = median if base is None else base
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Benchmark suites behind `python -m benchmarks.run`.
+
+Imports the app, so DATABASE_URL must be set before this module is loaded;
+run.py does that from --database-url. Every suite returns a flat dict of
+metrics: names ending in _ms or _us are latencies (lower is better), names
+ending in _per_s are throughputs (higher is better), anything else is
+context that isn't compared against the baseline.
+"""
+from datetime import datetime, timedelta, timezone
+import asyncio
+import random
+import time
+import uuid
+from fastapi.security import HTTPAuthorizationCredentials
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, insert
+from app import cache, models, retention, rules
+from app.alert_state import alert_tracker
+from app.alerts import alert_pipeline, Reading
+from app.cache import CachedDevice
+from app.database import Base, SessionLocal, engine
+from app.main import app
+from app.websocket import ConnectionManager
+from . import synthetic
+from .bench_auth import time_calls
+
+BENCH_EMAIL = "bench@example.com"
+BENCH_PASSWORD = "bench-password"
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+def latency(prefix, seconds):
+    ordered = sorted(seconds)
+    return {
+        f"{prefix}_p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        f"{prefix}_p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+    }
+
+# Readings are uniform over these ranges, so thresholds can be placed to fire
+# for a known share of them
+RANGES = {
+    "cpu_usage": (0, 100),
+    "ram_usage": (0, 100),
+    "disk_free": (0, 100),
+    "temperature": (20, 90),
+    "dns_latency": (1, 200),
+}
+RULE_FIRE_RATE = 0.01
+
+def heartbeat(sn):
+    values = {metric: round(random.uniform(low, high), 2) for metric, (low, high) in RANGES.items()}
+    return dict(values, device_sn=sn, connectivity=random.choice((0, 1, 1, 1)), boot_time="2024-01-01T00:00:00Z")
+
+class Context:
+    """One registered user with `devices` devices, driven through TestClient."""
+
+    def __init__(self, client: TestClient, devices: int):
+        self.client = client
+        credentials = {"email": BENCH_EMAIL, "password": BENCH_PASSWORD}
+        client.post("/api/auth/register", json=dict(credentials, name="Bench"))
+        response = client.post("/api/auth/login", json=credentials)
+        response.raise_for_status()
+        self.token = response.json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+        self.devices = []
+        for i in range(devices):
+            response = client.post(
+                "/api/devices/",
+                json={"name": f"Bench {i}", "location": "Bench", "sn": f"BENCH{i:07d}"},
+                headers=self.headers
+            )
+            response.raise_for_status()
+            self.devices.append(response.json())
+        self.user_id = uuid.UUID(self.devices[0]["user_id"])
+
+    def drain_alerts(self):
+        self.client.portal.call(alert_pipeline.join)
+
+def bench_ingest(ctx: Context, repeat: int, batch_size: int) -> dict:
+    sns = [device["sn"] for device in ctx.devices]
+    timings = []
+    for i in range(repeat):
+        body = heartbeat(sns[i % len(sns)])
+        start = time.perf_counter()
+        ctx.client.post("/api/heartbeat/", json=body).raise_for_status()
+        timings.append(time.perf_counter() - start)
+    ctx.drain_alerts()
+    result = latency("single", timings)
+    result["single_per_s"] = round(len(timings) / sum(timings), 1)
+
+    timings = []
+    for _ in range(max(1, repeat // 20)):
+        body = {"heartbeats": [heartbeat(sns[i % len(sns)]) for i in range(batch_size)]}
+        start = time.perf_counter()
+        ctx.client.post("/api/heartbeat/batch", json=body).raise_for_status()
+        timings.append(time.perf_counter() - start)
+    ctx.drain_alerts()
+    result.update(latency("batch", timings))
+    result["batch_rows_per_s"] = round(batch_size * len(timings) / sum(timings), 1)
+    result["batch_size"] = batch_size
+    return result
+
+def seed_rules(user_id, devices, count, rng):
+    # Each rule fires for about RULE_FIRE_RATE of the readings it sees
+    metrics = list(RANGES)
+    with SessionLocal() as db:
+        db.execute(delete(models.Notification).where(models.Notification.user_id == user_id))
+        rows = []
+        for i in range(count):
+            metric = metrics[i % len(metrics)]
+            low, high = RANGES[metric]
+            rows.append({
+                "id": uuid.uuid4(),
+                "name": f"Bench rule {i}",
+                "metric": metric,
+                "condition": ">",
+                "threshold": high - (high - low) * RULE_FIRE_RATE * rng.uniform(0.5, 1.5),
+                # Half the rules are scoped to one device, as users tend to do
+                "device_ids": f'["{devices[i % len(devices)]["id"]}"]' if i % 2 else None,
+                "is_active": True,
+                "user_id": user_id,
+            })
+        db.execute(insert(models.Notification), rows)
+        db.commit()
+    rules.rule_engine.invalidate(user_id)
+
+def stuck_heartbeat(sn):
+    values = {metric: high for metric, (low, high) in RANGES.items()}
+    return dict(values, device_sn=sn, connectivity=1, boot_time="2024-01-01T00:00:00Z")
+
+def time_alert_batches(ctx: Context, batch_size: int, repeat: int, make_heartbeat):
+    timings, alerts = [], 0
+    for _ in range(repeat):
+        batch = []
+        for i in range(batch_size):
+            device = ctx.devices[i % len(ctx.devices)]
+            values = make_heartbeat(device["sn"])
+            batch.append((
+                CachedDevice(uuid.UUID(device["id"]), ctx.user_id, device["name"]),
+                Reading(uuid.UUID(device["id"]), *(values[metric] for metric in rules.METRICS)),
+            ))
+        start = time.perf_counter()
+        alerts += len(alert_pipeline.process_batch(batch))
+        timings.append(time.perf_counter() - start)
+    return timings, alerts
+
+def bench_alerts(ctx: Context, rule_counts, batch_size: int, repeat: int) -> dict:
+    rng = random.Random(0)
+    result = {}
+    for count in rule_counts:
+        seed_rules(ctx.user_id, ctx.devices, count, rng)
+        # Independent readings: nearly every firing resolves on the next one,
+        # the worst case for alert writes
+        timings, alerts = time_alert_batches(ctx, batch_size, repeat, heartbeat)
+        result.update(latency(f"rules_{count}_batch", timings))
+        result[f"rules_{count}_readings_per_s"] = round(batch_size * repeat / sum(timings), 1)
+        result[f"rules_{count}_alerts_per_batch"] = round(alerts / repeat, 1)
+        # Every device stuck above every threshold: only the first batch writes
+        timings, alerts = time_alert_batches(ctx, batch_size, repeat, stuck_heartbeat)
+        result[f"rules_{count}_sustained_readings_per_s"] = round(batch_size * repeat / sum(timings), 1)
+        result[f"rules_{count}_sustained_alerts"] = alerts
+    with SessionLocal() as db:
+        db.execute(delete(models.NotificationAlert))
+        db.execute(delete(models.Notification).where(models.Notification.user_id == ctx.user_id))
+        db.commit()
+    rules.rule_engine.invalidate(ctx.user_id)
+    alert_tracker.clear()
+    result["batch_size"] = batch_size
+    return result
+
+def grow_history(devices, start, end, seed):
+    for fleet, times, readings in synthetic.generate(devices, start, end, 60, seed):
+        synthetic.ensure_devices(engine, fleet)
+        data = synthetic.to_copy(fleet, times, readings)
+        if engine.dialect.name == "postgresql":
+            synthetic.write_copy(engine, data)
+        else:
+            synthetic.write_insert(engine, data)
+    return fleet
+
+def bench_history(ctx: Context, sizes, devices: int, repeat: int) -> dict:
+    """Query the last hour of one device while older history piles up behind it.
+
+    Steps are cumulative: `size` is the total number of heartbeats in the
+    table when its step is timed, not the number the step added.
+    """
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    oldest = now
+    query = {"start_date": (now - timedelta(hours=1)).isoformat(), "end_date": now.isoformat()}
+    variants = {
+        "raw": ({}, {}),
+        "columnar": ({}, {"Accept": "application/vnd.iot.columnar+json"}),
+        "p95_5m": ({"bucket": "5m", "agg": "p95"}, {}),
+    }
+    result = {}
+    loaded = 0
+    for step, size in enumerate(sorted(sizes)):
+        minutes = -(-(size - loaded) // devices)
+        start = oldest - timedelta(minutes=minutes)
+        if engine.dialect.name == "postgresql":
+            retention.ensure_partitions(engine, today=start.date(), days_ahead=(now.date() - start.date()).days + 1)
+        fleet = grow_history(devices, start, oldest, seed=step)
+        loaded += minutes * devices
+        oldest = start
+        # Device ids come from the SN index, so every step extends the same
+        # devices further into the past. The queried device's own history
+        # grows with the table, while its last hour only holds step 0 data.
+        if step == 0:
+            url = f"/api/heartbeat/{fleet.ids[0]}/history"
+        for name, (params, headers) in variants.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                ctx.client.get(url, params=dict(query, **params), headers=headers).raise_for_status()
+                timings.append(time.perf_counter() - started)
+            result.update(latency(f"{name}_{size}", timings))
+    return result
+
+def bench_auth(ctx: Context, repeat: int) -> dict:
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=ctx.token)
+    result = {}
+    for mode, cached in (("uncached", False), ("cached", True)):
+        mean, median, p99 = time_calls(SessionLocal, credentials, repeat, cached)
+        result[f"{mode}_p50_us"] = round(median, 1)
+        result[f"{mode}_p99_us"] = round(p99, 1)
+    return result
+
+class FanoutSocket:
+    def __init__(self, delivered):
+        self.delivered = delivered
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        self.delivered()
+
+    async def close(self, code=1000):
+        pass
+
+def bench_fanout(client_counts, messages: int) -> dict:
+    """Time from send_to_user until every socket of that user has the message."""
+    async def scenario(clients):
+        manager = ConnectionManager()
+        received = 0
+        done = asyncio.Event()
+
+        def delivered():
+            nonlocal received
+            received += 1
+            if received == clients:
+                done.set()
+
+        for _ in range(clients):
+            await manager.connect(FanoutSocket(delivered), "fanout")
+        timings = []
+        for i in range(messages):
+            received = 0
+            done.clear()
+            start = time.perf_counter()
+            manager.send_to_user("fanout", f'{{"type": "notification", "seq": {i}}}')
+            await done.wait()
+            timings.append(time.perf_counter() - start)
+        for connections in list(manager.active_connections.values()):
+            for connection in list(connections):
+                manager.disconnect(connection)
+        return timings
+
+    result = {}
+    for clients in client_counts:
+        timings = asyncio.run(scenario(clients))
+        result.update(latency(f"clients_{clients}", timings))
+        result[f"clients_{clients}_deliveries_per_s"] = round(clients * len(timings) / sum(timings), 1)
+    return result
+
+def run(args) -> dict:
+    random.seed(args.seed)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    cache.token_cache.clear()
+    cache.user_cache.clear()
+    results = {}
+    try:
+        with TestClient(app) as client:
+            ctx = Context(client, args.devices)
+            suites = {
+                "ingest": lambda: bench_ingest(ctx, args.repeat, args.batch_size),
+                "alerts": lambda: bench_alerts(ctx, args.rules, args.batch_size, max(3, args.repeat // 40)),
+                "history": lambda: bench_history(ctx, args.history_sizes, args.devices, max(5, args.repeat // 20)),
+                "auth": lambda: bench_auth(ctx, args.repeat),
+                "fanout": lambda: bench_fanout(args.clients, max(5, args.repeat // 20)),
+            }
+            for name in args.suites:
+                start = time.perf_counter()
+                results[name] = suites[name]()
+                print(f"{name:>8}  {time.perf_counter() - start:6.1f}s")
+    finally:
+        Base.metadata.drop_all(bind=engine)
+    return results
@@ -0,0 +1,65 @@
+-- Convert an existing, unpartitioned `heartbeats` table to the time-series
+-- layout used by app/models.py: range partitions by created_at, primary key
+-- (id, created_at) and a (device_id, created_at DESC) index.
+--
+-- Fresh databases get this layout from Base.metadata.create_all; run this
+-- once on databases created before it, during a maintenance window:
+--
+--   psql "$DATABASE_URL" -f migrations/001_partition_heartbeats.sql
+--
+-- Afterwards app/retention.py keeps creating daily partitions ahead of time
+-- and drops the ones older than HEARTBEAT_RETENTION_DAYS.
+
+BEGIN;
+
+ALTER TABLE heartbeats RENAME TO heartbeats_legacy;
+ALTER TABLE heartbeats_legacy RENAME CONSTRAINT heartbeats_pkey TO heartbeats_legacy_pkey;
+
+UPDATE heartbeats_legacy SET created_at = now() WHERE created_at IS NULL;
+
+CREATE TABLE heartbeats (
+    id UUID NOT NULL,
+    device_id UUID NOT NULL REFERENCES devices (id),
+    cpu_usage DOUBLE PRECISION NOT NULL,
+    ram_usage DOUBLE PRECISION NOT NULL,
+    disk_free DOUBLE PRECISION NOT NULL,
+    temperature DOUBLE PRECISION NOT NULL,
+    dns_latency DOUBLE PRECISION NOT NULL,
+    connectivity INTEGER NOT NULL,
+    boot_time TIMESTAMP WITH TIME ZONE NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE INDEX ix_heartbeats_device_id_created_at ON heartbeats (device_id, created_at DESC);
+
+-- Historical rows go to one partition per day, like new data, so retention
+-- can drop them partition by partition.
+DO $$
+DECLARE
+    day DATE;
+BEGIN
+    FOR day IN
+        SELECT DISTINCT (created_at AT TIME ZONE 'UTC')::date FROM heartbeats_legacy
+        UNION
+        SELECT generate_series(current_date, current_date + 7, interval '1 day')::date
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF heartbeats FOR VALUES FROM (%L) TO (%L)',
+            'heartbeats_p' || to_char(day, 'YYYYMMDD'),
+            day::timestamp AT TIME ZONE 'UTC',
+            (day + 1)::timestamp AT TIME ZONE 'UTC'
+        );
+    END LOOP;
+END $$;
+
+CREATE TABLE heartbeats_default PARTITION OF heartbeats DEFAULT;
+
+INSERT INTO heartbeats SELECT
+    id, device_id, cpu_usage, ram_usage, disk_free, temperature,
+    dns_latency, connectivity, boot_time, created_at
+FROM heartbeats_legacy;
+
+DROP TABLE heartbeats_legacy;
+
+COMMIT;
@@ -0,0 +1,7 @@
+-- Index behind keyset pagination of the alert feed (newest first on
+-- (created_at, id)). Fresh databases get it from Base.metadata.create_all.
+--
+--   psql "$DATABASE_URL" -f migrations/002_pagination_indexes.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_notification_alerts_created_at_id
+    ON notification_alerts (created_at DESC, id DESC);
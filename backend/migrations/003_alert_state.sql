@@ -0,0 +1,24 @@
+-- Columns behind stateful alert evaluation (app/alert_state.py): how long a
+-- rule's condition must hold before it fires, the cooldown between firings,
+-- the hysteresis band and when a firing alert resolved. Fresh databases get
+-- them from Base.metadata.create_all.
+--
+--   psql "$DATABASE_URL" -f migrations/003_alert_state.sql
+--
+-- Existing alerts were written one per matching heartbeat and are closed
+-- here, so they aren't reloaded as firing on startup.
+
+BEGIN;
+
+ALTER TABLE notifications
+    ADD COLUMN IF NOT EXISTS for_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS for_readings INTEGER NOT NULL DEFAULT 1,
+    ADD COLUMN IF NOT EXISTS cooldown_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS hysteresis DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+ALTER TABLE notification_alerts
+    ADD COLUMN IF NOT EXISTS resolved_at TIMESTAMP WITH TIME ZONE;
+
+UPDATE notification_alerts SET resolved_at = created_at WHERE resolved_at IS NULL;
+
+COMMIT;
@@ -0,0 +1,11 @@
+-- Columns behind rolling-window alert rules (app/windows.py). Rules keep
+-- comparing single readings while `aggregate` is NULL, so existing rows need
+-- no backfill. Fresh databases get them from Base.metadata.create_all.
+--
+--   psql "$DATABASE_URL" -f migrations/004_alert_windows.sql
+
+ALTER TABLE notifications
+    ADD COLUMN IF NOT EXISTS aggregate VARCHAR,
+    ADD COLUMN IF NOT EXISTS window_seconds DOUBLE PRECISION,
+    ADD COLUMN IF NOT EXISTS window_readings INTEGER,
+    ADD COLUMN IF NOT EXISTS window_count INTEGER;
@@ -28,6 +28,16 @@ ChartJS.register(
   TimeScale
 );
 
+// Pick a server-side bucket so a chart gets at most a few hundred points per device
+const pickBucket = (startDate, endDate) => {
+  const hours = (endDate - startDate) / (60 * 60 * 1000);
+  if (hours <= 6) return undefined;
+  if (hours <= 24) return '1m';
+  if (hours <= 72) return '5m';
+  if (hours <= 24 * 31) return '1h';
+  return '1d';
+};
+
 const DeviceAnalytics = () => {
   const [searchParams, setSearchParams] = useSearchParams();
   const [devices, setDevices] = useState([]);
@@ -70,7 +80,8 @@ const DeviceAnalytics = () => {
         const response = await heartbeatAPI.getHistory(
           deviceId,
           startDate.toISOString(),
-          endDate.toISOString()
+          endDate.toISOString(),
+          pickBucket(startDate, endDate)
         );
         data[deviceId] = response.data;
       }
@@ -96,14 +107,16 @@ const DeviceAnalytics = () => {
     
     selectedDevices.forEach((deviceId, index) => {
       const device = devices.find(d => d.id === deviceId);
-      const data = heartbeatData[deviceId] || [];
+      const data = heartbeatData[deviceId];
+      // Columnar history: timestamps are already epoch ms, values one array per metric
+      const values = data ? data[metric] : [];
+      const points = data
+        ? data.timestamps.map((t, i) => ({ x: t, y: values[i] }))
+        : [];
       
       datasets.push({
         label: device?.name || 'Unknown Device',
-        data: data.map(h => ({ 
-          x: new Date(h.created_at).getTime(), 
-          y: h[metric] 
-        })),
+        data: points,
         borderColor: colors[index % colors.length],
         backgroundColor: colors[index % colors.length] + '20',
         tension: 0.1,
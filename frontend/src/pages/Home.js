@@ -14,20 +14,17 @@ const Home = () => {
 
   const fetchDevices = async () => {
     try {
-      const response = await devicesAPI.getAll();
-      setDevices(response.data);
-      // In a real app, you'd fetch latest heartbeats for each device
-      // For now, we'll simulate some data
-      const mockHeartbeats = {};
-      response.data.forEach(device => {
-        mockHeartbeats[device.id] = {
-          cpu_usage: Math.floor(Math.random() * 100),
-          ram_usage: Math.floor(Math.random() * 100),
-          temperature: Math.floor(Math.random() * 40) + 30,
-          connectivity: Math.random() > 0.2 ? 1 : 0
-        };
+      const [devicesRes, statusRes] = await Promise.all([
+        devicesAPI.getAll(),
+        devicesAPI.getStatus()
+      ]);
+      setDevices(devicesRes.data);
+      // Latest heartbeat of each device, one row per device
+      const latestHeartbeats = {};
+      statusRes.data.forEach(status => {
+        latestHeartbeats[status.device_id] = status;
       });
-      setHeartbeats(mockHeartbeats);
+      setHeartbeats(latestHeartbeats);
     } catch (error) {
       console.error('Error fetching devices:', error);
     } finally {
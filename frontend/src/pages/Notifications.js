@@ -45,7 +45,7 @@ const Notifications = () => {
 
   const setupWebSocket = () => {
     const token = localStorage.getItem('token');
-    const wsUrl = `ws://localhost:8000/api/notifications/ws`;
+    const wsUrl = `ws://localhost:8000/api/notifications/ws?token=${encodeURIComponent(token)}`;
     const websocket = new WebSocket(wsUrl);
 
     websocket.onmessage = (event) => {
@@ -35,6 +35,7 @@ export const authAPI = {
 
 export const devicesAPI = {
   getAll: () => api.get('/api/devices'),
+  getStatus: () => api.get('/api/devices/status'),
   create: (device) => api.post('/api/devices', device),
   update: (id, device) => api.put(`/api/devices/${id}`, device),
   delete: (id) => api.delete(`/api/devices/${id}`),
@@ -42,9 +43,11 @@ export const devicesAPI = {
 };
 
 export const heartbeatAPI = {
-  getHistory: (deviceId, startDate, endDate) => 
+  // Columnar payload: one array per metric plus epoch-ms timestamps
+  getHistory: (deviceId, startDate, endDate, bucket, agg = 'avg') => 
     api.get(`/api/heartbeat/${deviceId}/history`, {
-      params: { start_date: startDate, end_date: endDate }
+      params: { start_date: startDate, end_date: endDate, bucket, agg },
+      headers: { Accept: 'application/vnd.iot.columnar+json' }
     }),
 };
 
@@ -53,7 +56,8 @@ export const notificationsAPI = {
   create: (notification) => api.post('/api/notifications', notification),
   update: (id, notification) => api.put(`/api/notifications/${id}`, notification),
   delete: (id) => api.delete(`/api/notifications/${id}`),
-  getAlerts: () => api.get('/api/notifications/alerts'),
+  // Next page's cursor comes back in the X-Next-Cursor response header
+  getAlerts: (cursor, limit) => api.get('/api/notifications/alerts', { params: { cursor, limit } }),
 };
 
 export default api;
\ No newline at end of file
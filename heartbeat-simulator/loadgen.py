@@ -0,0 +1,253 @@
+"""Asyncio load generator: thousands of simulated devices from one process.
+
+Every device is a HeartbeatSimulator producing readings on its own schedule;
+all of them share one HTTP connection pool (or hold one WebSocket each with
+--transport ws). Prints achieved throughput and latency percentiles while it
+runs and a summary at the end.
+
+Profiles:
+    steady  each device sends every interval (+/- jitter), spread evenly
+    burst   every device sends at the same instant once per interval
+    ramp    fleet rate grows linearly from 5% to 100% over the run
+
+Example, 5000 devices at 1000 heartbeats/s for a minute:
+
+    python loadgen.py --register --devices 5000 --rate 1000 --duration 60
+"""
+from array import array
+from collections import Counter
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import random
+import time
+import httpx
+import websockets
+from simulator import HeartbeatSimulator
+
+PROFILES = ("steady", "burst", "ramp")
+TRANSPORTS = ("http", "ws")
+# Upper bounds (ms) of the latency histogram buckets
+HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+def device_sn(index):
+    return f"LOAD{index:08d}"
+
+class LoadStats:
+    def __init__(self):
+        self.latencies = array('d')
+        self.statuses = Counter()
+        self.errors = 0
+        self.started = time.monotonic()
+
+    def record(self, status, seconds):
+        self.statuses[status] += 1
+        self.latencies.append(seconds * 1000)
+
+    def error(self):
+        self.errors += 1
+
+    def percentiles(self, latencies=None):
+        ordered = sorted(self.latencies if latencies is None else latencies)
+        if not ordered:
+            return {"p50": None, "p95": None, "p99": None, "max": None}
+        pick = lambda q: round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 2)
+        return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 2)}
+
+    def histogram(self):
+        counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        for latency in self.latencies:
+            counts[bisect.bisect_left(HISTOGRAM_BOUNDS, latency)] += 1
+        labels = [f"<={bound}ms" for bound in HISTOGRAM_BOUNDS] + [f">{HISTOGRAM_BOUNDS[-1]}ms"]
+        return dict(zip(labels, counts))
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        completed = len(self.latencies)
+        ok = sum(count for status, count in self.statuses.items() if 200 <= status < 300)
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "completed": completed,
+            "ok": ok,
+            "errors": self.errors,
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+            "throughput_rps": round(completed / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": self.percentiles(),
+            "histogram": self.histogram(),
+        }
+
+def next_delay(profile, interval, jitter, elapsed, duration):
+    if profile == "burst":
+        # Back on the next interval boundary, like devices on synced clocks
+        return interval - elapsed % interval + random.uniform(0, jitter * interval)
+    delay = interval * random.uniform(1 - jitter, 1 + jitter)
+    if profile == "ramp":
+        delay /= max(0.05, min(1.0, elapsed / duration))
+    return delay
+
+async def run_device(send, simulator, args, stats, stop_at):
+    start = stats.started
+    if args.profile == "burst":
+        next_at = start + args.interval
+    else:
+        # Spread first readings so the steady fleet doesn't start as a burst
+        next_at = start + random.uniform(0, args.interval)
+    while True:
+        delay = min(next_at, stop_at) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if time.monotonic() >= stop_at:
+            return
+        await send(simulator.generate_heartbeat(), stats)
+        # Schedule on absolute times so slow responses don't lower the offered rate
+        next_at += next_delay(args.profile, args.interval, args.jitter, next_at - start, args.duration)
+
+def http_sender(client):
+    async def send(heartbeat, stats):
+        start = time.perf_counter()
+        try:
+            response = await client.post("/api/heartbeat/", json=heartbeat)
+        except httpx.HTTPError:
+            stats.error()
+            return
+        stats.record(response.status_code, time.perf_counter() - start)
+    return send
+
+async def ws_device(url, token, simulator, args, stats, stop_at):
+    seq = 0
+    try:
+        async with websockets.connect(f"{url}/api/heartbeat/ws?token={token}") as websocket:
+            async def send(heartbeat, stats):
+                nonlocal seq
+                seq += 1
+                heartbeat = dict(heartbeat, seq=seq)
+                heartbeat.pop("device_sn")
+                start = time.perf_counter()
+                await websocket.send(json.dumps(heartbeat))
+                ack = json.loads(await websocket.recv())
+                stats.record(200 if ack.get("accepted") else 400, time.perf_counter() - start)
+            await run_device(send, simulator, args, stats, stop_at)
+    except (OSError, websockets.WebSocketException):
+        stats.error()
+
+async def login(client, email, password):
+    credentials = {"email": email, "password": password}
+    response = await client.post("/api/auth/login", json=credentials)
+    if response.status_code == 401:
+        await client.post("/api/auth/register", json=dict(credentials, name="Load generator"))
+        response = await client.post("/api/auth/login", json=credentials)
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+async def register_devices(client, headers, sns, concurrency):
+    # Creates missing devices; existing serial numbers answer 400 and are kept
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create(sn):
+        async with semaphore:
+            await client.post(
+                "/api/devices/",
+                json={"name": f"Load {sn}", "location": "Load test", "sn": sn},
+                headers=headers
+            )
+    await asyncio.gather(*(create(sn) for sn in sns))
+
+async def device_tokens(client, headers, sns, concurrency):
+    response = await client.get("/api/devices/", headers=headers)
+    response.raise_for_status()
+    ids = {device["sn"]: device["id"] for device in response.json()}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def token(sn):
+        async with semaphore:
+            response = await client.post(f"/api/devices/{ids[sn]}/token", headers=headers)
+            response.raise_for_status()
+            return response.json()["access_token"]
+    return await asyncio.gather(*(token(sn) for sn in sns))
+
+async def report(stats, every):
+    last_count = 0
+    while True:
+        await asyncio.sleep(every)
+        count = len(stats.latencies)
+        window = stats.latencies[last_count:count]
+        p = stats.percentiles(window)
+        print(f"[{time.monotonic() - stats.started:7.1f}s] {(count - last_count) / every:8.1f} req/s  "
+              f"p50={p['p50']}ms p95={p['p95']}ms p99={p['p99']}ms errors={stats.errors}")
+        last_count = count
+
+async def main(args):
+    if args.rate:
+        args.interval = args.devices / args.rate
+    sns = [device_sn(args.first + i) for i in range(args.devices)]
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=args.api_url, limits=limits, timeout=args.timeout) as client:
+        tokens = None
+        if args.register or args.transport == "ws":
+            headers = await login(client, args.email, args.password)
+            if args.register:
+                await register_devices(client, headers, sns, args.setup_concurrency)
+            if args.transport == "ws":
+                tokens = await device_tokens(client, headers, sns, args.setup_concurrency)
+
+        print(f"{args.devices} devices, {args.devices / args.interval:.1f} heartbeats/s offered, "
+              f"profile={args.profile}, transport={args.transport}, duration={args.duration}s")
+        stats = LoadStats()
+        stop_at = stats.started + args.duration
+        simulators = [
+            HeartbeatSimulator({
+                'API_URL': args.api_url,
+                'DEVICE_SN': sn,
+                'BASE_CPU': random.uniform(10, 60),
+                'BASE_RAM': random.uniform(20, 70),
+                'BASE_TEMP': random.uniform(35, 60),
+            })
+            for sn in sns
+        ]
+        if args.transport == "ws":
+            ws_url = args.api_url.replace("http", "ws", 1)
+            devices = [ws_device(ws_url, token, sim, args, stats, stop_at) for sim, token in zip(simulators, tokens)]
+        else:
+            send = http_sender(client)
+            devices = [run_device(send, sim, args, stats, stop_at) for sim in simulators]
+
+        reporter = asyncio.create_task(report(stats, args.report_interval))
+        await asyncio.gather(*devices)
+        reporter.cancel()
+
+    summary = stats.summary()
+    summary["config"] = {
+        "devices": args.devices, "interval_s": args.interval, "profile": args.profile,
+        "jitter": args.jitter, "transport": args.transport, "connections": args.connections,
+    }
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-url", default=os.getenv("API_URL", "http://localhost:8000"))
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--first", type=int, default=0, help="index of the first device serial number")
+    parser.add_argument("--interval", type=float, default=60.0, help="seconds between readings per device")
+    parser.add_argument("--rate", type=float, help="total heartbeats/s; overrides --interval")
+    parser.add_argument("--jitter", type=float, default=0.1, help="fraction of the interval")
+    parser.add_argument("--profile", choices=PROFILES, default="steady")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="http")
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--connections", type=int, default=100, help="size of the shared HTTP pool")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--report-interval", type=float, default=5.0)
+    parser.add_argument("--register", action="store_true", help="create the LOAD* devices first")
+    parser.add_argument("--setup-concurrency", type=int, default=10, help="parallel requests while registering devices")
+    parser.add_argument("--email", default=os.getenv("LOADGEN_EMAIL", "loadgen@example.com"))
+    parser.add_argument("--password", default=os.getenv("LOADGEN_PASSWORD", "loadgen"))
+    parser.add_argument("--json", help="also write the summary to this file")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
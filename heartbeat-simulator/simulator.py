@@ -7,19 +7,24 @@ from datetime import datetime, timezone
 import threading
 
 class HeartbeatSimulator:
-    def __init__(self):
-        self.api_url = os.getenv('API_URL', 'http://localhost:8000')
-        self.device_sn = os.getenv('DEVICE_SN', 'TEST12345678')
-        self.device_name = os.getenv('DEVICE_NAME', 'Test Device')
-        self.device_location = os.getenv('DEVICE_LOCATION', 'Test Location')
-        self.interval = int(os.getenv('HEARTBEAT_INTERVAL', '60'))  # seconds
+    def __init__(self, config=None):
+        # Settings come from `config` first, then the environment, so many
+        # simulators can run in one process without touching os.environ
+        config = config or {}
+        setting = lambda key, default: str(config.get(key, os.getenv(key, default)))
+
+        self.api_url = setting('API_URL', 'http://localhost:8000')
+        self.device_sn = setting('DEVICE_SN', 'TEST12345678')
+        self.device_name = setting('DEVICE_NAME', 'Test Device')
+        self.device_location = setting('DEVICE_LOCATION', 'Test Location')
+        self.interval = int(setting('HEARTBEAT_INTERVAL', '60'))  # seconds
         self.boot_time = datetime.now(timezone.utc)
         
         # Simulation parameters
-        self.base_cpu = float(os.getenv('BASE_CPU', '30'))
-        self.base_ram = float(os.getenv('BASE_RAM', '40'))
-        self.base_temp = float(os.getenv('BASE_TEMP', '45'))
-        self.base_disk_free = float(os.getenv('BASE_DISK_FREE', '75'))
+        self.base_cpu = float(setting('BASE_CPU', '30'))
+        self.base_ram = float(setting('BASE_RAM', '40'))
+        self.base_temp = float(setting('BASE_TEMP', '45'))
+        self.base_disk_free = float(setting('BASE_DISK_FREE', '75'))
         
         # Add randomness and trends
         self.cpu_trend = 0
@@ -164,12 +169,7 @@ def run_multiple_simulators():
     threads = []
     
     for config in device_configs:
-        # Set environment variables for this simulator
-        for key, value in config.items():
-            os.environ[key] = value
-        
-        # Create and start simulator
-        simulator = HeartbeatSimulator()
+        simulator = HeartbeatSimulator(config)
         thread = threading.Thread(target=simulator.run)
         thread.daemon = True
         thread.start()